@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+##############################################################################
+# DeviceRegistry.py
+# -----------------
+#
+# A small, persistent (SQLite) record of every device we've heard of:
+#    - when it was first and last seen in the traffic data
+#    - the names it's been known by, and when (validity intervals)
+#    - the IP addresses it's had, and when
+#
+# Each run feeds it the current name sources (custom_clientlist, nt_center)
+# in priority order and it records only what has CHANGED, closing the old
+# name/IP interval and opening a new one. Lookups for encoding come from a
+# plain dict built once per run, so they're O(1).
+#
+# Because every rename of a device otherwise creates a whole new set of
+# Influx series (name is a tag), the registry can instead hand out a
+# "stable" name: the first name a device was known by, which then never
+# changes. The name history stays here for anyone who wants it.
+###############################################################################
+import sqlite3
+import time
+
+class DeviceRegistry(object):
+    """Persistent MAC registry with first/last seen times, name and IP history"""
+
+    def __init__(self, registryfile):
+        """Open (creating if need be) the registry database"""
+        self.registryfile = registryfile
+        self.conn = sqlite3.connect(registryfile)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS devices(mac TEXT PRIMARY KEY, first_seen INTEGER,
+                                               last_seen INTEGER, stable_name TEXT);
+            CREATE TABLE IF NOT EXISTS names(mac TEXT, name TEXT, source TEXT,
+                                             valid_from INTEGER, valid_to INTEGER);
+            CREATE INDEX IF NOT EXISTS names_current ON names(mac, valid_to);
+            CREATE TABLE IF NOT EXISTS ips(mac TEXT, ip TEXT, valid_from INTEGER, valid_to INTEGER);
+            CREATE INDEX IF NOT EXISTS ips_current ON ips(mac, valid_to);
+        """)
+        self.conn.commit()
+
+    def __del__(self):
+        self.conn.close()
+
+    def _ensureDevice(self, mac):
+        self.conn.execute("INSERT OR IGNORE INTO devices(mac) VALUES (?)", (mac,))
+
+    def _current(self, table, column):
+        """mac -> currently valid value from the names or ips table"""
+        return {mac: val for mac, val in
+                self.conn.execute(f"SELECT mac, {column} FROM {table} WHERE valid_to IS NULL")}
+
+    def updateNames(self, sources, when=None):
+        """sources is a list of (sourcename, {mac: name}) pairs, highest priority
+           first. Records a new name interval for any device whose name changed.
+           Returns the number of names that changed."""
+        when = int(time.time()) if when is None else when
+        effective = {}
+        for sourcename, mapping in reversed(sources):
+            for mac in mapping:
+                effective[mac] = (mapping[mac], sourcename)
+        current = self._current("names", "name")
+        changed = 0
+        for mac, (name, sourcename) in effective.items():
+            if current.get(mac) == name:
+                continue
+            self._ensureDevice(mac)
+            self.conn.execute("UPDATE names SET valid_to=? WHERE mac=? AND valid_to IS NULL", (when, mac))
+            self.conn.execute("INSERT INTO names(mac, name, source, valid_from) VALUES (?,?,?,?)",
+                              (mac, name, sourcename, when))
+            #The first name a device is known by becomes its stable name
+            self.conn.execute("UPDATE devices SET stable_name=? WHERE mac=? AND stable_name IS NULL", (name, mac))
+            changed += 1
+        self.conn.commit()
+        return changed
+
+    def updateIPs(self, mapping, when=None):
+        """Record a new IP interval for any device whose {mac: ip} changed"""
+        when = int(time.time()) if when is None else when
+        current = self._current("ips", "ip")
+        changed = 0
+        for mac, ip in mapping.items():
+            if current.get(mac) == ip:
+                continue
+            self._ensureDevice(mac)
+            self.conn.execute("UPDATE ips SET valid_to=? WHERE mac=? AND valid_to IS NULL", (when, mac))
+            self.conn.execute("INSERT INTO ips(mac, ip, valid_from) VALUES (?,?,?)", (mac, ip, when))
+            changed += 1
+        self.conn.commit()
+        return changed
+
+    def updateSeen(self, combos):
+        """Widen first/last seen from TrafficAnalyzerExtractor.combos
+           ((mac,app,cat) -> [earliest, latest, ...])"""
+        seen = {}
+        for (mac, app, cat), (tmin, tmax, *rest) in combos.items():
+            s = seen.get(mac)
+            seen[mac] = (tmin, tmax) if s is None else (min(s[0], tmin), max(s[1], tmax))
+        for mac, (tmin, tmax) in seen.items():
+            self._ensureDevice(mac)
+            self.conn.execute("UPDATE devices SET first_seen=MIN(COALESCE(first_seen, ?), ?), "
+                              "last_seen=MAX(COALESCE(last_seen, ?), ?) WHERE mac=?",
+                              (tmin, tmin, tmax, tmax, mac))
+        self.conn.commit()
+
+    def getNameMap(self, stable=False):
+        """mac -> name for encoding: the current name, or the stable one"""
+        if stable:
+            return {mac: name for mac, name in
+                    self.conn.execute("SELECT mac, stable_name FROM devices WHERE stable_name IS NOT NULL")}
+        return self._current("names", "name")
+
+    def nameAt(self, mac, timestamp):
+        """The name a device had at a given time, or None"""
+        r = self.conn.execute("SELECT name FROM names WHERE mac=? AND valid_from<=? "
+                              "AND (valid_to IS NULL OR valid_to>?) ORDER BY valid_from DESC LIMIT 1",
+                              (mac, timestamp, timestamp)).fetchone()
+        return None if r is None else r[0]
+
+    def getDevices(self):
+        """List of (mac, first_seen, last_seen, stable_name, current name, current ip)"""
+        return list(self.conn.execute(
+            "SELECT d.mac, d.first_seen, d.last_seen, d.stable_name, n.name, i.ip FROM devices d "
+            "LEFT JOIN names n ON n.mac=d.mac AND n.valid_to IS NULL "
+            "LEFT JOIN ips i ON i.mac=d.mac AND i.valid_to IS NULL ORDER BY d.mac"))
+
+    def getNameHistory(self, mac):
+        """List of (name, source, valid_from, valid_to) for one device"""
+        return list(self.conn.execute("SELECT name, source, valid_from, valid_to FROM names "
+                                      "WHERE mac=? ORDER BY valid_from", (mac,)))
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from os.path import isfile
+    from sys import argv
+    def fmt(ts):
+        return time.strftime("%Y-%m-%d %H:%M", time.localtime(ts)) if ts is not None else "-"
+    if len(argv) == 2 and isfile(argv[1]):
+        registry = DeviceRegistry(argv[1])
+        for mac, first, last, stable, name, ip in registry.getDevices():
+            print(f"{mac}  {fmt(first)} - {fmt(last)}  {name or '(no name)'} [{stable or '-'}] {ip or ''}")
+            history = registry.getNameHistory(mac)
+            if len(history) > 1:
+                for hname, source, vfrom, vto in history:
+                    print(f"        {fmt(vfrom)} - {fmt(vto)}  {hname} ({source})")
+    else :
+        print("When called directly, supply the path to a device registry database on the command line")
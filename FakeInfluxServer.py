@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+##############################################################################
+# FakeInfluxServer.py
+# -------------------
+#
+# A local stand-in for an Influx (1.x) server, good enough to run the whole
+# ingest against without a real one - for benchmarks and for trying changes
+# out before they go anywhere near the real database.
+#
+# It understands:
+#    POST /write   - line-protocol, optionally gzip-compressed. Points are
+#                    counted (and the newest timestamp per measurement kept)
+#                    but otherwise thrown away unless keepLines is set.
+#    GET/POST /query - just the statements read_traffic_database.py issues:
+#                    SHOW DATABASES, the CREATE/GRANT bootstrap, and
+#                    "select * from <m> ... ORDER BY time desc limit 1".
+#    GET /ping
+#
+# failRate makes that fraction of writes fail with a 503, to exercise the
+# writer's retry logic.
+###############################################################################
+import gzip
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class FakeInfluxServer(object):
+    """Minimal in-process Influx /write and /query endpoint"""
+
+    def __init__(self, host="127.0.0.1", port=0, keepLines=False, failRate=0.0):
+        """port 0 picks a free port; see .port once started"""
+        self.keepLines = keepLines
+        self.failRate = failRate
+        self.lines = []
+        self.points = 0
+        self.requests = 0
+        self.bytesReceived = 0
+        self.databases = set()
+        self.latest = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._makeHandler())
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _recordWrite(self, body):
+        """Count the points in a /write body and note the newest per measurement"""
+        latest = {}
+        count = 0
+        for line in body.splitlines():
+            if len(line) < 1 or line.startswith(b"#"):
+                continue
+            count += 1
+            #Measurement ends at the first unescaped comma or space
+            measurement = re.split(rb"(?<!\\)[, ]", line, maxsplit=1)[0].decode()
+            ts = int(line.rsplit(b" ", 1)[1])
+            if ts > latest.get(measurement, 0):
+                latest[measurement] = ts
+        with self._lock:
+            self.points += count
+            self.requests += 1
+            self.bytesReceived += len(body)
+            for m in latest:
+                if latest[m] > self.latest.get(m, 0):
+                    self.latest[m] = latest[m]
+            if self.keepLines:
+                self.lines.extend(l.decode() for l in body.splitlines() if len(l) > 0)
+
+    def _answerQuery(self, q):
+        """Just enough InfluxQL to keep InfluxDBClient happy"""
+        q = q.strip()
+        if re.match(r"(?i)show\s+databases", q):
+            return {"statement_id": 0, "series": [{"name": "databases", "columns": ["name"],
+                                                   "values": [[d] for d in sorted(self.databases)]}]}
+        m = re.match(r'(?i)create\s+database\s+"?([^"\s;]+)', q)
+        if m:
+            self.databases.add(m.group(1))
+            return {"statement_id": 0}
+        m = re.match(r'(?i)select\s+\*\s+from\s+"?([^"\s;]+)', q)
+        if m:
+            if m.group(1) not in self.latest:
+                return {"statement_id": 0}
+            return {"statement_id": 0, "series": [{"name": m.group(1), "columns": ["time"],
+                                                   "values": [[self.latest[m.group(1)]]]}]}
+        return {"statement_id": 0}
+
+    def _makeHandler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, payload=None):
+                body = json.dumps(payload).encode() if payload is not None else b""
+                self.send_response(code)
+                if payload is not None:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return body
+
+            def _query(self, params):
+                qs = params.get("q", [""])[0]
+                results = [server._answerQuery(q) for q in qs.split(";") if len(q.strip()) > 0]
+                self._reply(200, {"results": results})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/ping":
+                    self._reply(204)
+                elif url.path == "/query":
+                    self._query(parse_qs(url.query))
+                else :
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self._body()
+                if url.path == "/write":
+                    if server.failRate > 0 and random.random() < server.failRate:
+                        self._reply(503, {"error": "simulated failure"})
+                        return
+                    server._recordWrite(body)
+                    self._reply(204)
+                elif url.path == "/query":
+                    params = parse_qs(url.query)
+                    params.update(parse_qs(body.decode()))
+                    self._query(params)
+                else :
+                    self._reply(404, {"error": "not found"})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+if __name__ == "__main__":
+    import time
+    from sys import argv
+    port = int(argv[1]) if len(argv) == 2 else 8086
+    server = FakeInfluxServer(port=port).start()
+    print(f"Fake Influx listening on {server.host}:{server.port} (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"{server.requests} writes, {server.points} points, {server.bytesReceived} bytes")
+    except KeyboardInterrupt:
+        server.stop()
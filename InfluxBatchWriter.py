@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+##############################################################################
+# InfluxBatchWriter.py
+# --------------------
+#
+# InfluxDBClient.write_points() sends one uncompressed batch at a time and
+# waits for each to be acknowledged before building the next. For the hourly
+# top-up that's fine; for a first load or a backfill after an outage the
+# link sits idle most of the time.
+#
+# This is a small writer that talks to the Influx (1.x) /write endpoint
+# directly:
+#    - line-protocol is accumulated and cut into batches by SIZE in bytes
+#      (always on a line boundary), not by number of points
+#    - each batch is gzip-compressed before sending
+#    - several batches can be in flight at once on a thread pool
+#    - the queue of batches waiting to be sent is bounded, so a producer
+#      that's faster than the network blocks instead of eating memory
+#    - failed sends are retried with exponential backoff (server errors and
+#      connection problems only; a 4xx means the data itself is bad)
+#    - every batch records how long it took and how big it was
+#
+# Because batches complete out of order, callers that need to know when
+# their data is safely stored (e.g. to move a checkpoint on) register a
+# callback with mark(). It fires once everything written BEFORE the mark has
+# been acknowledged.
+#
+# With a WriteSpool, each batch is written to disk before it's sent and
+# dropped from the spool once acknowledged. A spooled batch counts as
+# safely stored (it will be sent again by replaySpool() at the next start
+# if need be), so marks fire as soon as the data is in the spool, and a
+# run that loses Influx part way through doesn't have to be re-extracted.
+###############################################################################
+import base64
+import gzip
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlencode
+
+class InfluxWriteError(Exception):
+    """Raised when one or more batches could not be written to Influx"""
+    pass
+
+class InfluxBatchWriter(object):
+    """Pipelined, gzip-compressed, retrying writer for the Influx /write endpoint"""
+
+    def __init__(self, host, port, database, username=None, password=None,
+                 precision='s', maxInFlight=4, queueDepth=8, batchBytes=1048576,
+                 useGzip=True, gzipLevel=1, retries=5, backoff=0.5, timeout=30,
+                 verbose=True, spool=None):
+        """Set up the connection details and worker pool. Nothing is sent yet.
+           spool is an optional WriteSpool to keep batches in until they're
+           acknowledged."""
+        self.url = f"http://{host}:{port}/write?" + urlencode({'db': database, 'precision': precision})
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if username is not None:
+            creds = base64.b64encode(f"{username}:{password}".encode()).decode()
+            self.headers['Authorization'] = f"Basic {creds}"
+        if useGzip:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.useGzip = useGzip
+        self.gzipLevel = gzipLevel
+        self.batchBytes = batchBytes
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.verbose = verbose
+        self.spool = spool
+        self.stats = []
+        self._pool = ThreadPoolExecutor(max_workers=maxInFlight)
+        #Slots cover batches being sent AND those queued behind them:
+        self._slots = threading.BoundedSemaphore(maxInFlight + queueDepth)
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._markLock = threading.Lock()
+        self._nextSeq = 0
+        self._pending = set()
+        self._futures = []
+        self._marks = []
+        self._errors = []
+        self._failed = set()
+        #Batches (by seq) that are safely in the spool
+        self._spooled = set()
+        self._spoolFull = False
+        #Influx didn't answer at all; leave spooled batches for next time
+        self._unreachable = False
+
+    def write(self, lines):
+        """Queue line-protocol for sending. Accepts bytes (newline separated)
+           or an iterable of str lines. May block if the send queue is full."""
+        if not isinstance(lines, (bytes, bytearray)):
+            lines = "\n".join(lines).encode()
+        if len(lines) < 1:
+            return
+        self._buffer += lines
+        if not lines.endswith(b"\n"):
+            self._buffer += b"\n"
+        while len(self._buffer) >= self.batchBytes:
+            cut = self._buffer.rfind(b"\n", 0, self.batchBytes)
+            if cut < 0:
+                #A single line longer than a batch; send it on its own
+                cut = self._buffer.find(b"\n")
+            self._dispatch(bytes(self._buffer[:cut+1]))
+            del self._buffer[:cut+1]
+
+    def mark(self, callback):
+        """Arrange for callback() to run once everything written so far has
+           been acknowledged by Influx (or spooled). Marks fire in the order
+           they're made, and never fire if an unspooled batch before them has
+           failed."""
+        with self._lock:
+            #Anything still in the buffer will go out as batch _nextSeq
+            seq = self._nextSeq if len(self._buffer) > 0 else self._nextSeq - 1
+            self._marks.append((seq, callback))
+        self._fireMarks()
+
+    def flush(self):
+        """Send whatever is buffered and wait for every batch to complete.
+           Raises InfluxWriteError if anything couldn't be written."""
+        if len(self._buffer) > 0:
+            self._dispatch(bytes(self._buffer))
+            self._buffer = bytearray()
+        wait(self._futures)
+        self._futures = []
+        self._fireMarks()
+        if len(self._errors) > 0:
+            #Marks made after a failed batch can never be honoured
+            errors = self._errors
+            with self._lock:
+                kept = len(self._failed & self._spooled)
+                self._errors = []
+                self._failed = set()
+                self._spooled = set()
+                self._unreachable = False
+                self._marks = []
+            raise InfluxWriteError(f"{len(errors)} batch(es) failed"
+                                   + (f" ({kept} kept in the spool for next time)" if kept > 0 else "")
+                                   + f", first error: {errors[0]}")
+
+    def replaySpool(self):
+        """Send the batches left in the spool by earlier runs, oldest first,
+           and wait for them. Returns the number still waiting to be sent."""
+        if self.spool is None or len(self.spool.segments()) < 1:
+            return 0
+        merged = self.spool.compact(self.batchBytes)
+        segments = self.spool.segments()
+        print(f"Write spool:        replaying {len(segments)} batch(es), {self.spool.size} bytes"
+              + (f" ({merged} merged)" if merged > 0 else ""))
+        for segId in segments:
+            self._dispatch(self.spool.read(segId), segId)
+        try:
+            self.flush()
+        except InfluxWriteError as e:
+            print(f"WARN Write spool not fully replayed: {e}")
+        return len(self.spool.segments())
+
+    def close(self):
+        """Flush and shut the worker pool down"""
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def summary(self):
+        """Totals over all batches sent so far"""
+        lines = sum(s['lines'] for s in self.stats)
+        rawBytes = sum(s['bytes'] for s in self.stats)
+        sentBytes = sum(s['sent'] for s in self.stats)
+        return {'batches': len(self.stats), 'lines': lines,
+                'bytes': rawBytes, 'sent': sentBytes,
+                'retries': sum(s['attempts'] - 1 for s in self.stats)}
+
+    def _dispatch(self, body, segId=None):
+        """Hand a batch to the pool, blocking while the queue is full. Unless
+           it's already there (segId), the batch is spooled first."""
+        if self.spool is not None and segId is None:
+            segId = self.spool.append(body)
+            if segId is None and not self._spoolFull:
+                print(f"WARN Write spool {self.spool.spoolDir} is full, batches are no longer being spooled")
+                self._spoolFull = True
+        self._slots.acquire()
+        with self._lock:
+            seq = self._nextSeq
+            self._nextSeq += 1
+            self._pending.add(seq)
+            if segId is not None:
+                self._spooled.add(seq)
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(self._pool.submit(self._send, seq, body, segId))
+        if segId is not None:
+            #Marks waiting only on this batch can go now
+            self._fireMarks()
+
+    def _send(self, seq, body, segId=None):
+        """Worker: compress and POST one batch, retrying where it makes sense"""
+        try:
+            sT = time.perf_counter()
+            if segId is not None and self._unreachable:
+                #No point waiting out the retries for every batch in turn;
+                #it stays in the spool
+                with self._lock:
+                    self._errors.append(InfluxWriteError("not sent, Influx unreachable"))
+                    self._failed.add(seq)
+                return
+            payload = gzip.compress(body, compresslevel=self.gzipLevel) if self.useGzip else body
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    req = urllib.request.Request(self.url, data=payload, headers=self.headers, method='POST')
+                    with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                        resp.read()
+                    break
+                except urllib.error.HTTPError as e:
+                    #4xx is a problem with the data or credentials; retrying won't help
+                    if (e.code < 500 and e.code != 429) or attempt > self.retries:
+                        if segId is not None and e.code < 500 and e.code != 429:
+                            #Sending it again at every start won't help either
+                            self.spool.reject(segId)
+                            with self._lock:
+                                self._spooled.discard(seq)
+                        raise InfluxWriteError(f"HTTP {e.code} {e.read()[:200]}")
+                except (urllib.error.URLError, OSError) as e:
+                    if attempt > self.retries:
+                        if self.spool is not None:
+                            self._unreachable = True
+                        raise InfluxWriteError(f"{e}")
+                time.sleep(self.backoff * (2 ** (attempt-1)) * (0.5 + random.random()))
+            if segId is not None:
+                self.spool.ack(segId)
+            elapsed = time.perf_counter() - sT
+            lines = body.count(b"\n")
+            self.stats.append({'seq': seq, 'lines': lines, 'bytes': len(body),
+                               'sent': len(payload), 'secs': elapsed, 'attempts': attempt})
+            if self.verbose:
+                print(f"Batch {seq}: {lines} lines, {len(body)} bytes ({len(payload)} sent) "
+                      f"in {elapsed:.3f}s, {lines/elapsed:.0f} lines/second"
+                      + (f", {attempt-1} retries" if attempt > 1 else ""))
+        except InfluxWriteError as e:
+            print(f"ERROR writing batch {seq}: {e}")
+            with self._lock:
+                self._errors.append(e)
+                self._failed.add(seq)
+        finally:
+            with self._lock:
+                self._pending.discard(seq)
+                if seq not in self._failed:
+                    self._spooled.discard(seq)
+            self._slots.release()
+            self._fireMarks()
+
+    def _fireMarks(self):
+        """Run the callbacks of any marks whose batches are all acknowledged"""
+        with self._markLock:
+            while True:
+                with self._lock:
+                    if len(self._marks) < 1:
+                        return
+                    #(a spooled batch is as good as acknowledged)
+                    outstanding = (self._pending | self._failed) - self._spooled
+                    doneThrough = (min(outstanding) if len(outstanding) > 0 else self._nextSeq) - 1
+                    seq, callback = self._marks[0]
+                    if seq > doneThrough:
+                        return
+                    self._marks.pop(0)
+                callback()
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+##############################################################################
+# IngestCheckpoint.py
+# -------------------
+#
+# Rather than asking Influx "what's the newest point you've got?" every run
+# (an ORDER BY time DESC over the whole measurement) we keep a small local
+# record of how far we've got. For each measurement and each source file it
+# holds the (timestamp, rowid) of the last record written successfully.
+#
+# The rowid is there because the Traffic Analyzer writes many records with
+# the same timestamp; filtering on timestamp alone either drops or repeats
+# the records sharing the last second.
+#
+# The file is JSON and is replaced atomically on every update, so a crash
+# part-way through a write leaves either the old or the new checkpoint,
+# never a mangled one.
+###############################################################################
+import json
+import os
+from os.path import isfile
+
+class IngestCheckpoint(object):
+    """Persistent last-ingested (timestamp,rowid) per measurement and source"""
+
+    def __init__(self, checkpointfile):
+        """Load any existing checkpoints from the file given"""
+        self.cpfile = checkpointfile
+        #measurement -> source -> [timestamp, rowid]
+        self.checkpoints = {}
+        if isfile(self.cpfile):
+            with open(self.cpfile) as cf:
+                try:
+                    self.checkpoints = json.load(cf)
+                except json.decoder.JSONDecodeError as e:
+                    #Not fatal; we'll fall back to asking Influx.
+                    print(f"WARN Ignoring unreadable checkpoint file {self.cpfile}, {e}")
+
+    def get(self, measurement, source):
+        """Return (timestamp,rowid) last ingested from source, or None if unknown"""
+        cp = self.checkpoints.get(measurement, {}).get(source)
+        if cp is None:
+            return None
+        return cp[0], cp[1]
+
+    def update(self, measurement, source, timestamp, rowid):
+        """Record a new high-water mark and persist it straight away"""
+        self.checkpoints.setdefault(measurement, {})[source] = [int(timestamp), int(rowid)]
+        self._save()
+
+    def _save(self):
+        """Write-then-rename so the checkpoint file is never half-written"""
+        tmpfile = self.cpfile + ".tmp"
+        with open(tmpfile, "w") as cf:
+            json.dump(self.checkpoints, cf, indent=1)
+            cf.flush()
+            os.fsync(cf.fileno())
+        os.replace(tmpfile, self.cpfile)
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from sys import argv
+    if len(argv) == 2 and isfile(argv[1]):
+        cps = IngestCheckpoint(argv[1]).checkpoints
+        for measurement in cps:
+            for source in cps[measurement]:
+                ts, rowid = cps[measurement][source]
+                print(f"{measurement}\t{source}\ttimestamp={ts} rowid={rowid}")
+    else :
+        print("When called directly, supply the path to a checkpoint file on the command line")
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+##############################################################################
+# IngestStats.py
+# --------------
+#
+# Where does an ingest run spend its time, and how does that change as the
+# router's database grows? Each stage of the run (metadata load, each name
+# source, extraction, encoding, writing, RStats...) is timed and counted
+# here, along with the process's peak memory at the end of the stage.
+#
+# The figures can be printed as a table and/or encoded as line-protocol
+# points - one per stage plus a "total" - for an ingest_stats measurement,
+# so they go wherever the data itself goes and can be trended in Grafana.
+#
+# Stages can be entered many times (e.g. once per chunk); the times and
+# counts accumulate.
+###############################################################################
+import threading
+import time
+from contextlib import contextmanager
+from LineProtocol import escapeMeasurement, escapeTag
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peakRSSMB(who=None):
+    """Peak resident memory (MB) of this process (or its finished children)"""
+    if resource is None:
+        return 0.0
+    #ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss / 1024
+
+class IngestStats(object):
+    """Accumulated time, item counts and peak memory for each stage of a run"""
+
+    def __init__(self):
+        #(stages can run on several threads at once)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self._startedPerf = time.perf_counter()
+        #stage -> {'seconds', 'count', 'calls', 'peakRSSMB'}, in first-seen order
+        self.stages = {}
+
+    def add(self, name, seconds, count=0):
+        with self._lock:
+            s = self.stages.get(name)
+            if s is None:
+                s = self.stages[name] = {'seconds': 0.0, 'count': 0, 'calls': 0, 'peakRSSMB': 0.0}
+            s['seconds'] += seconds
+            s['count'] += count
+            s['calls'] += 1
+            s['peakRSSMB'] = peakRSSMB()
+
+    @contextmanager
+    def stage(self, name, count=0):
+        """with stats.stage("encode", len(chunk)): ... - or, if the count
+           isn't known until the end, set st['count'] in "as st" """
+        rec = {'count': count}
+        sT = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            self.add(name, time.perf_counter() - sT, rec['count'])
+
+    def iterate(self, name, iterable):
+        """Pass an iterable through, timing how long each item took to produce
+           (and counting the items, or their lengths if they have one)"""
+        it = iter(iterable)
+        while True:
+            sT = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - sT, len(item) if hasattr(item, '__len__') else 1)
+            yield item
+
+    def encode(self, measurement, extraTags=None):
+        """Line-protocol: a point per stage and one for the whole run"""
+        ts = int(self.started)
+        base = dict(extraTags) if extraTags is not None else {}
+        lines = []
+        for name, s in list(self.stages.items()) + [('total', None)]:
+            tags = dict(base, stage=name)
+            tagStr = "".join(f",{escapeTag(k)}={escapeTag(tags[k])}" for k in sorted(tags))
+            if s is None:
+                fields = (f"seconds={time.perf_counter()-self._startedPerf},peak_rss_mb={peakRSSMB()}"
+                          + (f",children_peak_rss_mb={peakRSSMB(resource.RUSAGE_CHILDREN)}" if resource is not None else ""))
+            else :
+                fields = f"seconds={s['seconds']},count={s['count']},calls={s['calls']},peak_rss_mb={s['peakRSSMB']}"
+            lines.append(f"{escapeMeasurement(measurement)}{tagStr} {fields} {ts}\n")
+        return "".join(lines).encode()
+
+    def report(self):
+        """Print the stages as a table"""
+        print(f"{'stage':24} {'seconds':>10} {'count':>10} {'per sec':>12} {'calls':>7} {'peak RSS MB':>12}")
+        for name, s in self.stages.items():
+            rate = s['count'] / s['seconds'] if s['seconds'] > 0 else 0
+            print(f"{name:24} {s['seconds']:10.3f} {s['count']:10d} {rate:12.0f} {s['calls']:7d} {s['peakRSSMB']:12.1f}")
+        print(f"{'total':24} {time.perf_counter()-self._startedPerf:10.3f} {'':10} {'':12} {'':7} {peakRSSMB():12.1f}")
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    stats = IngestStats()
+    for chunk in stats.iterate("produce", ([i] * 1000 for i in range(50))):
+        with stats.stage("consume", len(chunk)):
+            sum(x * x for x in chunk)
+    stats.report()
+    print(stats.encode("ingest_stats").decode(), end="")
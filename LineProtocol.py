@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+##############################################################################
+# LineProtocol.py
+# ---------------
+#
+# Influx line-protocol encoding for the traffic measurement.
+#
+# There are only a few hundred distinct (mac, app, cat) combinations in even
+# a big TrafficAnalyzer database, but millions of rows. So rather than
+# escaping and joining the tag set for every row, TrafficEncoder builds the
+# "measurement,tag=value,... " prefix once per combination, caches it, and
+# then each row only needs its fields and timestamp appending. A chunk of
+# rows comes back as a single bytes buffer ready to hand to the writer.
+#
+# Escaping follows the Influx rules: in measurement names commas and spaces
+# need a backslash, in tag keys and values commas, equals signs and spaces
+# do. (App names like "Apple, Inc=Push" used to produce broken points.)
+# Tag keys are emitted in sorted order, which saves Influx sorting them.
+#
+# A SeriesSchema can change the tag set (name as a field or not at all,
+# dictionary-coded app/cat, long-tail apps folded into "other"). Folded rows
+# for the same tag set and second are summed into one point; as records
+# arrive in timestamp order a sum is complete, and emitted, once a later
+# second has been seen - finish() emits whatever is left at the end.
+#
+# A columnar sink (Parquet/Arrow) has no use for the text: encodeColumns()
+# gives the same points as a PointColumns - a list per tag/field - built
+# from the same cached tag sets. parseLine() goes from text back to a point,
+# for the odd line (RStats, stats) that only comes as text.
+###############################################################################
+from SeriesSchema import SeriesSchema
+
+def escapeMeasurement(inString):
+    """Escape a measurement name for line-protocol"""
+    return inString.replace(",", "\\,").replace(" ", "\\ ")
+
+def escapeTag(inString):
+    """Escape a tag key or tag value for line-protocol"""
+    return inString.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def _splitUnescaped(inString, sep, maxsplit=-1):
+    """Split on sep where it isn't backslash-escaped (or inside double quotes)"""
+    parts = []
+    current = []
+    escaped = False
+    quoted = False
+    for ch in inString:
+        if escaped:
+            current.append(ch)
+            escaped = False
+        elif ch == "\\":
+            current.append(ch)
+            escaped = True
+        elif ch == '"':
+            current.append(ch)
+            quoted = not quoted
+        elif ch == sep and not quoted and maxsplit != 0:
+            parts.append("".join(current))
+            current = []
+            maxsplit -= 1
+        else :
+            current.append(ch)
+    parts.append("".join(current))
+    return parts
+
+def _unescape(inString):
+    return inString.replace("\\,", ",").replace("\\=", "=").replace("\\ ", " ")
+
+def _parseFieldValue(value, exactInts=False):
+    if value.startswith('"'):
+        return value[1:-1].replace('\\"', '"')
+    if value.endswith("i"):
+        return int(value[:-1])
+    if exactInts and value.lstrip("-").isdigit():
+        return int(value)
+    if value in ("t", "T", "true", "True", "TRUE"):
+        return True
+    if value in ("f", "F", "false", "False", "FALSE"):
+        return False
+    return float(value)
+
+def parseLine(line, exactInts=False):
+    """Inverse of the encoding: returns (measurement, {tags}, {fields}, timestamp)
+       for one line of line-protocol. Timestamp is None if the line has none.
+       Un-suffixed numbers are floats, as Influx would store them, unless
+       exactInts is set, when whole ones (e.g. tx/rx) stay ints."""
+    sections = _splitUnescaped(line.rstrip("\n"), " ")
+    keyPart, fieldPart = sections[0], sections[1]
+    timestamp = int(sections[2]) if len(sections) > 2 else None
+    keys = _splitUnescaped(keyPart, ",")
+    tags = {}
+    for tag in keys[1:]:
+        k, v = _splitUnescaped(tag, "=", 1)
+        tags[_unescape(k)] = _unescape(v)
+    fields = {}
+    for field in _splitUnescaped(fieldPart, ","):
+        k, v = _splitUnescaped(field, "=", 1)
+        fields[_unescape(k)] = _parseFieldValue(v, exactInts)
+    return _unescape(keys[0]), tags, fields, timestamp
+
+class PointColumns(object):
+    """Points of one measurement as columns: 'time', then one list per tag
+       or field name, None where a point doesn't have it"""
+
+    def __init__(self, measurement):
+        self.measurement = measurement
+        self.cols = {'time': []}
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, ts, tags, fields):
+        n = self.n
+        cols = self.cols
+        cols['time'].append(ts)
+        for values in (tags, fields):
+            for k, v in values.items():
+                col = cols.get(k)
+                if col is None:
+                    col = cols[k] = [None] * n
+                col.append(v)
+        self.n = n + 1
+        for col in cols.values():
+            if len(col) < self.n:
+                col.append(None)
+
+    def extend(self, other, indices=None):
+        """Add other's points (only those at indices, if given)"""
+        n = self.n
+        for name, col in other.cols.items():
+            target = self.cols.get(name)
+            if target is None:
+                target = self.cols[name] = [None] * n
+            target.extend(col if indices is None else [col[i] for i in indices])
+        self.n = n + (len(other) if indices is None else len(indices))
+        for col in self.cols.values():
+            if len(col) < self.n:
+                col.extend([None] * (self.n - len(col)))
+
+    def take(self, indices):
+        """A new PointColumns of just the points at indices"""
+        points = PointColumns(self.measurement)
+        points.extend(self, indices)
+        return points
+
+class TrafficEncoder(object):
+    """Line-protocol encoder for traffic records with a per-tag-set prefix cache"""
+
+    def __init__(self, measurement, macNameList, extraTags=None, schema=None):
+        """measurement is the Influx measurement name, macNameList maps MAC->friendly name.
+           extraTags (e.g. {'router': 'rt-ax88u'}) are added to every point.
+           schema is a SeriesSchema (default: every record its own point,
+           tagged with app, cat, mac and name)."""
+        self.measurement = escapeMeasurement(measurement)
+        self.measurementName = measurement
+        self.macNameList = macNameList
+        self.extraTags = extraTags if extraTags is not None else {}
+        self.schema = schema if schema is not None else SeriesSchema()
+        #(mac,app,cat) -> (prefix, field tail, folded?)
+        self._prefixes = {}
+        #(prefix, field tail, ts) -> [tx, rx] for folded rows not yet emitted
+        self._pending = {}
+        #(prefix, field tail) -> ({tags}, {fields besides tx/rx}), for encodeColumns
+        self._tagSets = {}
+
+    def _buildPrefix(self, mac, app, cat):
+        """Encode (and cache) the measurement+tag set for one combination"""
+        name = self.macNameList.get(mac, mac)
+        tags = dict(self.extraTags)
+        tags.update(self.schema.tags(mac, app, cat, name))
+        prefix = self.measurement + "".join(f",{escapeTag(k)}={escapeTag(tags[k])}" for k in sorted(tags)) + " "
+        tail = ""
+        if self.schema.nameMode == 'field':
+            tail = ',name="' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        self._tagSets[(prefix, tail)] = ({k: str(v) for k, v in tags.items()},
+                                         {'name': name} if self.schema.nameMode == 'field' else {})
+        entry = (prefix, tail, self.schema.folds(app))
+        self._prefixes[(mac, app, cat)] = entry
+        return entry
+
+    def _fold(self, prefix, tail, m):
+        key = (prefix, tail, m['ts'])
+        sums = self._pending.get(key)
+        if sums is None:
+            self._pending[key] = [m['tx'], m['rx']]
+        else :
+            sums[0] += m['tx']
+            sums[1] += m['rx']
+
+    def encode(self, metrics):
+        """Encode a chunk of records into one newline-terminated bytes buffer"""
+        prefixes = self._prefixes
+        out = []
+        for m in metrics:
+            mac, app, cat = m['mac'], m['app'], m['cat']
+            entry = prefixes.get((mac, app, cat))
+            if entry is None:
+                entry = self._buildPrefix(mac, app, cat)
+            prefix, tail, folded = entry
+            if folded:
+                self._fold(prefix, tail, m)
+                continue
+            out.append(f"{prefix}tx={m['tx']},rx={m['rx']}{tail} {m['ts']}\n")
+        if len(self._pending) > 0 and len(metrics) > 0:
+            for prefix, tail, ts, tx, rx in self._takePending(metrics[-1]['ts']):
+                out.append(f"{prefix}tx={tx},rx={rx}{tail} {ts}\n")
+        return "".join(out).encode()
+
+    def encodeColumns(self, metrics):
+        """encode(), but the points as a PointColumns, for a columnar sink"""
+        prefixes = self._prefixes
+        tagSets = self._tagSets
+        points = PointColumns(self.measurementName)
+        for m in metrics:
+            mac, app, cat = m['mac'], m['app'], m['cat']
+            entry = prefixes.get((mac, app, cat))
+            if entry is None:
+                entry = self._buildPrefix(mac, app, cat)
+            prefix, tail, folded = entry
+            if folded:
+                self._fold(prefix, tail, m)
+                continue
+            tags, extra = tagSets[(prefix, tail)]
+            points.append(m['ts'], tags, dict(tx=m['tx'], rx=m['rx'], **extra))
+        if len(self._pending) > 0 and len(metrics) > 0:
+            self._appendPending(points, metrics[-1]['ts'])
+        return points
+
+    def _takePending(self, beforeTs=None):
+        """Remove and return the folded sums for seconds before beforeTs
+           (all, if None), as (prefix, tail, ts, tx, rx)"""
+        pending = self._pending
+        return [key + tuple(pending.pop(key)) for key in [k for k in pending if beforeTs is None or k[2] < beforeTs]]
+
+    def _appendPending(self, points, beforeTs=None):
+        for prefix, tail, ts, tx, rx in self._takePending(beforeTs):
+            tags, extra = self._tagSets[(prefix, tail)]
+            points.append(ts, tags, dict(tx=tx, rx=rx, **extra))
+
+    def finish(self):
+        """The folded points still being summed (empty unless folding)"""
+        return "".join(f"{prefix}tx={tx},rx={rx}{tail} {ts}\n"
+                       for prefix, tail, ts, tx, rx in self._takePending()).encode()
+
+    def finishColumns(self):
+        """finish(), as a PointColumns"""
+        points = PointColumns(self.measurementName)
+        self._appendPending(points)
+        return points
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    print("Micro-benchmark: TrafficEncoder against fmtTrafficDataPoint")
+    import random
+    import time
+    from sys import argv
+    from read_traffic_database import fmtTrafficDataPoint, opt
+    numRows = int(argv[1]) if len(argv) == 2 else 200000
+    macs = [f"AA:BB:CC:DD:{i//256:02X}:{i%256:02X}" for i in range(40)]
+    apps = [f"App Number {i}" for i in range(150)] + ["Apple, Inc=Push"]
+    cats = [f"Category {i}" for i in range(20)]
+    names = {m: f"Device {i}" for i,m in enumerate(macs[:30])}
+    #Like the real thing: each app has one category, each device a handful of apps
+    appCat = {a: random.choice(cats) for a in apps}
+    macApps = {m: random.sample(apps, 15) for m in macs}
+    rows = []
+    for i in range(numRows):
+        mac = random.choice(macs)
+        app = random.choice(macApps[mac])
+        rows.append({'ts': 1600000000 + i//100*3600, 'mac': mac, 'app': app, 'cat': appCat[app],
+                     'tx': random.randint(0, 10**8), 'rx': random.randint(0, 10**9)})
+
+    sT = time.perf_counter()
+    old = "\n".join(fmtTrafficDataPoint(r, names) for r in rows).encode()
+    oldT = time.perf_counter() - sT
+    print(f"fmtTrafficDataPoint: {numRows} rows in {oldT:.3f}s, {numRows/oldT:.0f} rows/second")
+
+    encoder = TrafficEncoder(opt['inMeasurement'], names)
+    sT = time.perf_counter()
+    new = encoder.encode(rows)
+    newT = time.perf_counter() - sT
+    print(f"TrafficEncoder:      {numRows} rows in {newT:.3f}s, {numRows/newT:.0f} rows/second "
+          f"({oldT/newT:.1f}x, {len(encoder._prefixes)} cached tag sets)")
@@ -13,9 +13,18 @@
 # This script exists to extract all MAC->Name mappings from this table
 # and return as a standard Python dict.
 #
+# The notification history only ever grows, and old events never change, so
+# optionally (pass a cachefile) the resulting maps are saved along with the
+# newest event timestamp processed. The next run loads them and only looks
+# at events from that timestamp on. The filtering for events that carry a
+# macaddr is done by SQLite (JSON1) rather than json.loads'ing every row.
+#
 ###############################################################################
 import sqlite3
 import json
+import os
+from os.path import isfile
+from RouterDB import routerDB
 
 class NtCenterMacParser(object):
     """Extract all MAC->Name mappings from an ASUS nt_center.db SQLLIte database"""
@@ -28,24 +37,90 @@ class NtCenterMacParser(object):
         """This is a secondary data set, the source is less reliable but it's serviceable"""
         return self.mactoip
 
-    def __init__(self,ntcenterdbfile):
+    def __init__(self,ntcenterdbfile,cachefile=None):
         """Load and actually do the parsing of the SQLLite database"""
         self.mactoname = {}
         self.mactoip = {}
+        self.lasttstamp = None
         self.dbfile = ntcenterdbfile
-        self._parsentcentertable()
+        self.cachefile = cachefile
+        if self.cachefile is None:
+            self._parsentcentertable()
+        else :
+            self._loadcache()
+            self._parsentcentertable(self.lasttstamp)
+            self._savecache()
 
-    def _parsentcentertable(self):
-        """Connects and queries NT Center records"""
-        conn = sqlite3.connect(self.dbfile)
+    def _parsentcentertable(self, fromtstamp=None):
+        """Connects and queries NT Center records (only those at or after
+           fromtstamp if given - re-reading the last second is harmless)"""
+        conn = routerDB.connect(self.dbfile)
         try:
-            cursor = conn.execute("SELECT msg FROM nt_center ORDER BY tstamp ASC")
-            for r in cursor:
-                self._extractmacnamefromevent(r[0])
+            try:
+                self._parsefiltered(conn, fromtstamp)
+            except sqlite3.OperationalError as e:
+                if "no such function" not in str(e):
+                    raise
+                #SQLite without JSON1; do the filtering ourselves.
+                cursor = conn.execute("SELECT tstamp, msg FROM nt_center WHERE msg LIKE '%macaddr%' "
+                                      f"{self._since(fromtstamp)} ORDER BY tstamp ASC")
+                for r in cursor:
+                    self._extractmacnamefromevent(r[1])
+                    self.lasttstamp = r[0]
         except sqlite3.OperationalError as e:
             raise TypeError(f"{self.dbfile} does not contain nt_center records ({e})")
-        finally:
-            conn.close()
+
+    @staticmethod
+    def _since(fromtstamp):
+        """Extra WHERE clause for an incremental parse"""
+        return "" if fromtstamp is None else f"AND tstamp >= {int(fromtstamp)}"
+
+    def _parsefiltered(self, conn, fromtstamp):
+        """Let SQLite pick out (and pick apart) just the events with a MAC in"""
+        cursor = conn.execute("SELECT tstamp, json_extract(msg,'$.macaddr'), json_extract(msg,'$.cname'), "
+                              "json_extract(msg,'$.ip') FROM nt_center WHERE msg LIKE '%macaddr%' "
+                              "AND (msg LIKE '%cname%' OR msg LIKE '%\"ip\"%') AND json_valid(msg) "
+                              f"{self._since(fromtstamp)} ORDER BY tstamp ASC")
+        for tstamp, mac, cname, ip in cursor:
+            self._recordmapping(mac, cname, ip)
+            self.lasttstamp = tstamp
+
+    def _loadcache(self):
+        """Pick up the maps saved last time, if they're for this database"""
+        if not isfile(self.cachefile):
+            return
+        try:
+            with open(self.cachefile) as cf:
+                cache = json.load(cf)
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            print(f"WARN Ignoring unreadable nt_center cache {self.cachefile}, {e}")
+            return
+        if cache.get('dbfile') != os.path.realpath(self.dbfile):
+            return
+        #If the newest event is older than our cache the database has been
+        #reset or replaced; start again.
+        try:
+            newest, = routerDB.connect(self.dbfile).execute("SELECT MAX(tstamp) FROM nt_center").fetchone()
+        except sqlite3.OperationalError as e:
+            raise TypeError(f"{self.dbfile} does not contain nt_center records ({e})")
+        if newest is None or newest < cache['tstamp']:
+            return
+        self.mactoname = cache['mactoname']
+        self.mactoip = cache['mactoip']
+        self.lasttstamp = cache['tstamp']
+
+    def _savecache(self):
+        """Save maps and the last tstamp processed (write-then-rename)"""
+        if self.lasttstamp is None:
+            return
+        try:
+            tmpfile = self.cachefile + ".tmp"
+            with open(tmpfile, "w") as cf:
+                json.dump({'dbfile': os.path.realpath(self.dbfile), 'tstamp': self.lasttstamp,
+                           'mactoname': self.mactoname, 'mactoip': self.mactoip}, cf)
+            os.replace(tmpfile, self.cachefile)
+        except OSError as e:
+            print(f"WARN Could not write nt_center cache {self.cachefile}, {e}")
 
     def _extractmacnamefromevent(self,jsonmsg) :
         """Parses the JSON nt_center message and extracts mac,name,ip if available"""
@@ -53,30 +128,34 @@ class NtCenterMacParser(object):
             msg = json.loads(jsonmsg)
         except json.decoder.JSONDecodeError as e:
             return #it's an invalid record, not the end of the world. Skip it.
-        if ('cname' in msg and 'macaddr' in msg and
-            len(msg['cname'])>0 and len(msg['macaddr'])==17) :
+        if 'macaddr' in msg:
+            self._recordmapping(msg['macaddr'], msg.get('cname'), msg.get('ip'))
+
+    def _recordmapping(self, mac, cname, ip) :
+        """Store name and/or IP for a MAC from one event (either may be None)"""
+        if not isinstance(mac, str) or len(mac) != 17 :
+            return
+        if isinstance(cname, str) and len(cname)>0 :
             #We're parsing by date so we can ALWAYS overwrite the value with a "newer" one:
-            self.mactoname[msg['macaddr']] = msg['cname']
-        if ('ip' in msg and 'macaddr' in msg and
-            len(msg['ip'])>0 and len(msg['macaddr'])==17) :
+            self.mactoname[mac] = cname
+        if isinstance(ip, str) and len(ip)>0 :
             #There's a bug in the data. Octet data isn't scrubbed, so if a
             #record has 2 digits in an octet but comes after a 3-digit octet,
             #it'll appear as a 3-digit octet quite frequently outside the 255
             #range. We can attempt to correct for this by scrubbing the
             #octets before loading:
-            octets=msg['ip'].split('.')
+            octets=ip.split('.')
             for i in range(len(octets)) :
                 if int(octets[i]) > 255 :
                     octets[i] = octets[i][0:2]
-            self.mactoip[msg['macaddr']] = '.'.join(octets)
+            self.mactoip[mac] = '.'.join(octets)
 
 if __name__ == "__main__":
     print("This is a TEST PROGRAM")
     print("(you probably don't want to be here)")
-    from os.path import isfile
     from sys import argv
-    if len(argv) == 2 and isfile(argv[1]):
-        ntMapObj = NtCenterMacParser(argv[1])
+    if len(argv) in (2,3) and isfile(argv[1]):
+        ntMapObj = NtCenterMacParser(argv[1], argv[2] if len(argv) == 3 else None)
         namemappings = ntMapObj.getMappings()
         ipmappings = ntMapObj.getIPMappings()
         print(f"Extracted {len(namemappings)} MAC-to-Name Mappings, and {len(ipmappings)} MAC-to-IP mappings")
@@ -88,3 +167,4 @@ if __name__ == "__main__":
                 print(" (no IP found)")
     else :
         print("When called directly, supply the path to an ASUS Router nt_center.db file on the command line")
+        print("(and optionally a cache file to parse incrementally against)")
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+##############################################################################
+# OutputSinks.py
+# --------------
+#
+# Places other than a live Influx server that line-protocol can be sent to.
+# Every sink looks like InfluxBatchWriter - write(), mark(), flush(),
+# close(), summary() - so the update functions don't care which they have:
+#
+#    LineProtocolFileSink - gzip-compressed line-protocol files, rotated by
+#                           size and/or age, for bulk loading later with
+#                           "influx write" / "influx -import" (far quicker
+#                           than HTTP batches for big historical imports)
+#    StdoutSink           - line-protocol to stdout, for dry runs and pipes
+#    ColumnarSink         - Parquet or Arrow (Feather) files partitioned by
+#                           measurement and day, for offline analysis.
+#                           Needs pyarrow. It's columnar: the traffic comes
+#                           to it as PointColumns (writeColumns) rather than
+#                           text; anything else is parsed back from the text.
+#
+# Files are written under a ".part" name and renamed when complete, so a
+# loader picking files up never sees one half-written. Marks fire when the
+# data they cover is safely on disk (i.e. on flush or rotation); stdout
+# never fires them, so a dry run doesn't move any checkpoints on.
+#
+# None of the sinks (nor InfluxBatchWriter) expect to be written to from
+# more than one thread; LockedSink wraps any of them so they can be.
+###############################################################################
+import abc
+import gzip
+import os
+import sys
+import threading
+import time
+from LineProtocol import parseLine, PointColumns
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class OutputSink(abc.ABC):
+    """Common plumbing: line counting and marks that fire on flush"""
+    #Whether writeColumns() can be used instead of write()
+    columnar = False
+
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+        self._marks = []
+
+    @staticmethod
+    def _asBytes(lines):
+        if not isinstance(lines, (bytes, bytearray)):
+            lines = "\n".join(lines).encode()
+        if len(lines) > 0 and not lines.endswith(b"\n"):
+            lines += b"\n"
+        return lines
+
+    def write(self, lines):
+        data = self._asBytes(lines)
+        self.lines += data.count(b"\n")
+        self.bytes += len(data)
+        self._write(data)
+
+    def mark(self, callback):
+        """callback() runs once everything written so far is safely stored"""
+        self._marks.append(callback)
+
+    def _fireMarks(self):
+        marks = self._marks
+        self._marks = []
+        for callback in marks:
+            callback()
+
+    def flush(self):
+        self._flush()
+        self._fireMarks()
+
+    def close(self):
+        self.flush()
+
+    def summary(self):
+        return {'batches': 0, 'lines': self.lines, 'bytes': self.bytes, 'sent': self.bytes, 'retries': 0}
+
+    @abc.abstractmethod
+    def _write(self, data):
+        """Store a newline-terminated buffer of line-protocol"""
+
+    def _flush(self):
+        pass
+
+class LockedSink(object):
+    """Any sink, shared between threads: each write(), mark() or flush()
+       happens whole, one at a time"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._lock = threading.RLock()
+
+    def write(self, lines):
+        with self._lock:
+            self.sink.write(lines)
+
+    def writeColumns(self, points):
+        with self._lock:
+            self.sink.writeColumns(points)
+
+    def mark(self, callback):
+        with self._lock:
+            self.sink.mark(callback)
+
+    def flush(self):
+        with self._lock:
+            self.sink.flush()
+
+    def close(self):
+        with self._lock:
+            self.sink.close()
+
+    def summary(self):
+        with self._lock:
+            return self.sink.summary()
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+class StdoutSink(OutputSink):
+    """Line-protocol straight to a stream (stdout by default)"""
+
+    def __init__(self, stream=None):
+        super().__init__()
+        self.stream = stream if stream is not None else sys.stdout.buffer
+
+    def _write(self, data):
+        self.stream.write(data)
+
+    def flush(self):
+        #Deliberately no marks: nothing has been stored anywhere.
+        self._marks = []
+        self.stream.flush()
+
+class LineProtocolFileSink(OutputSink):
+    """gzip-compressed line-protocol files, rotated by size or age"""
+
+    def __init__(self, directory, database, prefix="influx", rotateBytes=64*1048576, rotateSeconds=3600):
+        super().__init__()
+        self.directory = directory
+        self.database = database
+        self.prefix = prefix
+        self.rotateBytes = rotateBytes
+        self.rotateSeconds = rotateSeconds
+        self.files = []
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        self._opened = time.time()
+        self._written = 0
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self._opened))
+        self._path = os.path.join(self.directory, f"{self.prefix}-{stamp}-{len(self.files):04d}.lp.gz")
+        self._raw = open(self._path + ".part", "wb")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        #Header understood by "influx -import"; newer "influx write" skips comments
+        self._file.write(f"# DML\n# CONTEXT-DATABASE: {self.database}\n".encode())
+
+    def _rotate(self):
+        """Finish the current file and make it visible under its real name"""
+        self._file.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        os.replace(self._path + ".part", self._path)
+        self.files.append(self._path)
+        self._file = None
+        self._fireMarks()
+
+    def _write(self, data):
+        if self._file is None:
+            self._open()
+        self._file.write(data)
+        self._written += len(data)
+        if (self._written >= self.rotateBytes or
+            (self.rotateSeconds and time.time() - self._opened >= self.rotateSeconds)):
+            self._rotate()
+
+    def _flush(self):
+        #A finished file is what a loader wants, so flushing completes it.
+        if self._file is not None:
+            self._rotate()
+
+class ColumnarSink(OutputSink):
+    """Parquet/Arrow files partitioned as <measurement>/date=YYYY-MM-DD/"""
+    columnar = True
+
+    def __init__(self, directory, fileFormat="parquet", rowsPerFile=1000000):
+        super().__init__()
+        if pyarrow is None:
+            raise TypeError("The parquet/arrow output sinks need pyarrow installed")
+        if fileFormat not in ("parquet", "arrow"):
+            raise ValueError(f"Unknown columnar format {fileFormat}")
+        self.directory = directory
+        self.fileFormat = fileFormat
+        self.rowsPerFile = rowsPerFile
+        self.files = []
+        #(measurement, day) -> PointColumns
+        self._partitions = {}
+        self._buffered = 0
+        self._days = {}
+
+    def _partition(self, measurement, ts):
+        #(UTC days, so ts // 86400 picks out the day)
+        day = self._days.get(ts // 86400)
+        if day is None:
+            day = self._days[ts // 86400] = time.strftime("%Y-%m-%d", time.gmtime(ts))
+        key = (measurement, day)
+        points = self._partitions.get(key)
+        if points is None:
+            points = self._partitions[key] = PointColumns(measurement)
+        return points
+
+    def _write(self, data):
+        for line in data.decode().splitlines():
+            if len(line) < 1 or line.startswith("#"):
+                continue
+            measurement, tags, fields, ts = parseLine(line, exactInts=True)
+            self._partition(measurement, ts).append(ts, tags, fields)
+            self._buffered += 1
+        if self._buffered >= self.rowsPerFile:
+            self._flush()
+
+    def writeColumns(self, points):
+        """write(), for points already in columns (see TrafficEncoder.encodeColumns)"""
+        if len(points) < 1:
+            return
+        self.lines += len(points)
+        #(split by day; a chunk is usually all one, or two)
+        byDay = {}
+        for i, ts in enumerate(points.cols['time']):
+            byDay.setdefault(self._partition(points.measurement, ts), []).append(i)
+        for partition, indices in byDay.items():
+            partition.extend(points, indices if len(indices) < len(points) else None)
+        self._buffered += len(points)
+        if self._buffered >= self.rowsPerFile:
+            self._flush()
+
+    def _flush(self):
+        for (measurement, day), points in self._partitions.items():
+            partdir = os.path.join(self.directory, measurement, f"date={day}")
+            os.makedirs(partdir, exist_ok=True)
+            path = os.path.join(partdir, f"part-{time.time_ns()}.{self.fileFormat}")
+            table = self._table(points)
+            if self.fileFormat == "parquet":
+                pyarrow.parquet.write_table(table, path + ".part")
+            else :
+                pyarrow.feather.write_feather(table, path + ".part")
+            os.replace(path + ".part", path)
+            self.files.append(path)
+        self._partitions = {}
+        self._buffered = 0
+
+    @staticmethod
+    def _arrowType(values):
+        """Column type from every value in it (None: missing from that row)"""
+        kinds = {type(v) for v in values if v is not None}
+        if len(kinds) > 0 and kinds <= {bool}:
+            return pyarrow.bool_()
+        if len(kinds) > 0 and kinds <= {int}:
+            return pyarrow.int64()
+        if len(kinds) > 0 and kinds <= {int, float}:
+            return pyarrow.float64()
+        return pyarrow.string()
+
+    @staticmethod
+    def _table(points):
+        """A table of the points with a schema covering all of them (not just
+           the first): whole-number fields (tx, rx, ...) as int64, a column
+           missing from some points null in those"""
+        fields = [pyarrow.field('time', pyarrow.timestamp('s'))]
+        arrays = [pyarrow.array(points.cols['time'], type=pyarrow.timestamp('s'))]
+        for name, values in points.cols.items():
+            if name == 'time':
+                continue
+            kind = ColumnarSink._arrowType(values)
+            if kind == pyarrow.string():
+                values = [str(v) if v is not None and not isinstance(v, str) else v for v in values]
+            fields.append(pyarrow.field(name, kind))
+            arrays.append(pyarrow.array(values, type=kind))
+        return pyarrow.Table.from_arrays(arrays, schema=pyarrow.schema(fields))
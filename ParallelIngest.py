@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+##############################################################################
+# ParallelIngest.py
+# -----------------
+#
+# Process-pool plumbing for ingesting many TrafficAnalyzer.db snapshots at
+# once (e.g. a staging directory full of hourly scp'd copies from several
+# routers).
+#
+# The parent process works out WHAT to read: each snapshot is cut into
+# windows of rowids, and each window becomes a task. Workers open the
+# snapshot themselves, read their window and encode it to line-protocol,
+# handing back (key, line) pairs. The key is (timestamp, mac, app, cat) so
+# the parent can drop rows that more than one snapshot holds before they go
+# to the (single, shared) writer.
+#
+# The MAC->name map (and the SeriesSchema) is sent to each worker once, when
+# it starts, rather than with every task, as are the RouterDB settings:
+# each worker keeps its own pool of read-only connections, so a snapshot
+# is opened once per worker rather than once per window. Rows are de-duplicated one line
+# at a time, so the schema mustn't fold rows together.
+#
+# The same pool does a backfill of one big database (--backfill): the parent
+# makes one grouped pass over the table to find how many rows each hour
+# holds (and their rowid range), then cuts the time range into windows of
+# whole hours. Each worker reads its window over its own read-only,
+# memory-mapped connection - a rowid range scan, as the router's table has
+# no timestamp index - and encodes it. Windows never share a second, so
+# they can be handed to the writer (and checkpointed) in timestamp order as
+# they come back, and folding works as it does on a normal run.
+###############################################################################
+import glob
+import os
+import sqlite3
+from collections import deque
+from fnmatch import fnmatch
+from LineProtocol import TrafficEncoder
+from TrafficColumns import TrafficColumns
+from RouterDB import routerDB
+
+#Per-worker state, set up by initWorker()
+_workerNames = {}
+_workerMeasurement = None
+_workerSchema = None
+_workerEncoders = {}
+
+def initWorker(macNameList, measurement, schema=None, dbSettings=None):
+    """Process pool initializer: stash the shared, read-only bits"""
+    global _workerNames, _workerMeasurement, _workerSchema
+    _workerNames = macNameList
+    _workerMeasurement = measurement
+    _workerSchema = schema
+    if dbSettings is not None:
+        routerDB.configure(**dbSettings)
+
+def _getEncoder(router):
+    """One encoder (and so one prefix cache) per router, kept across tasks"""
+    if router not in _workerEncoders:
+        _workerEncoders[router] = TrafficEncoder(_workerMeasurement, _workerNames,
+                                                 {'router': router} if router else None, _workerSchema)
+    return _workerEncoders[router]
+
+def encodeSnapshotWindow(task):
+    """Worker: read one rowid window of a snapshot at or after minTimestamp and
+       encode it. Returns the (ts,mac,app,cat) of each row, and its points:
+       a list of lines, or a PointColumns if columnar (one point per row
+       either way - snapshots are never folded)."""
+    dbfile, router, minTimestamp, rowidLo, rowidHi, columnar = task
+    cur = routerDB.connect(dbfile).execute("SELECT timestamp,mac,app_name,cat_name,tx,rx FROM traffic "
+                                           "WHERE rowid > ? AND rowid <= ? AND timestamp >= ?",
+                                           (rowidLo, rowidHi, minTimestamp))
+    metrics = [{'ts': r[0], 'mac': r[1], 'app': r[2], 'cat': r[3], 'tx': r[4], 'rx': r[5]}
+               for r in cur]
+    keys = [(m['ts'], m['mac'], m['app'], m['cat']) for m in metrics]
+    if columnar:
+        return keys, _getEncoder(router).encodeColumns(metrics)
+    return keys, _getEncoder(router).encode(metrics).decode().splitlines(keepends=True)
+
+def backfillWindows(dbfile, afterTs, afterRowid, windowRows):
+    """Plan a backfill of the rows after (afterTs, afterRowid) - as
+       TrafficAnalyzerExtractor.iterMetricsAfter counts them - as windows of
+       whole hours holding about windowRows rows each. Returns a list of
+       (tsLo, tsHi, rowidLo, rowidHi, rows), tsHi/rowidHi inclusive."""
+    hours = routerDB.connect(dbfile).execute(
+        "SELECT timestamp - timestamp % 3600 AS hour, MIN(timestamp), MAX(timestamp), "
+        "MIN(rowid), MAX(rowid), COUNT(*) FROM traffic "
+        "WHERE timestamp > ? OR (timestamp = ? AND rowid > ?) GROUP BY hour ORDER BY hour",
+        (afterTs, afterTs, afterRowid)).fetchall()
+    windows = []
+    for hour, tsLo, tsHi, rowidLo, rowidHi, rows in hours:
+        if len(windows) > 0 and windows[-1][4] + rows <= windowRows:
+            w = windows[-1]
+            windows[-1] = (w[0], tsHi, min(w[2], rowidLo), max(w[3], rowidHi), w[4] + rows)
+        else :
+            windows.append((tsLo, tsHi, rowidLo, rowidHi, rows))
+    return windows
+
+def encodeBackfillWindow(task):
+    """Worker: read one backfill window, in (timestamp, rowid) order, and
+       encode it. Returns (lines - or a PointColumns if columnar -, rows, last
+       ts, last rowid, TrafficColumns of the rows if asked for, else None)."""
+    dbfile, router, afterTs, afterRowid, window, wantColumns, columnar = task
+    tsLo, tsHi, rowidLo, rowidHi, _ = window
+    rows = routerDB.connect(dbfile).execute(
+        "SELECT timestamp,mac,app_name,cat_name,tx,rx,rowid FROM traffic "
+        "WHERE rowid >= ? AND rowid <= ? AND timestamp >= ? AND timestamp <= ? "
+        "AND (timestamp > ? OR (timestamp = ? AND rowid > ?)) ORDER BY timestamp, rowid",
+        (rowidLo, rowidHi, tsLo, tsHi, afterTs, afterTs, afterRowid)).fetchall()
+    if len(rows) < 1:
+        return b"", 0, None, None, None
+    metrics = [{'ts': r[0], 'mac': r[1], 'app': r[2], 'cat': r[3], 'tx': r[4], 'rx': r[5]} for r in rows]
+    encoder = _getEncoder(router)
+    #(the window holds whole seconds, so anything folded is complete at its end)
+    if columnar:
+        lines = encoder.encodeColumns(metrics)
+        lines.extend(encoder.finishColumns())
+    else :
+        lines = encoder.encode(metrics) + encoder.finish()
+    columns = TrafficColumns.fromRows(rows) if wantColumns else None
+    return lines, len(rows), rows[-1][0], rows[-1][6], columns
+
+def snapshotWindows(dbfile, windowRows):
+    """Split a snapshot's rowid range into (lo, hi] windows of windowRows.
+       Returns (lo, hi, earliest, latest timestamp) for each non-empty one."""
+    conn = routerDB.connect(dbfile)
+    minrowid, maxrowid = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM traffic").fetchone()
+    if maxrowid is None:
+        return []
+    #(one pass over the table for every window's time range)
+    windows = []
+    for w, tsMin, tsMax in conn.execute("SELECT (rowid - ?) / ? AS w, MIN(timestamp), MAX(timestamp) "
+                                        "FROM traffic GROUP BY w ORDER BY w", (minrowid, windowRows)):
+        lo = minrowid - 1 + w * windowRows
+        windows.append((lo, min(lo + windowRows, maxrowid), tsMin, tsMax))
+    return windows
+
+def listSnapshots(spec, pattern="*.db"):
+    """Expand a directory (using pattern) or a glob into a sorted list of files"""
+    if os.path.isdir(spec):
+        spec = os.path.join(spec, pattern)
+    return sorted(f for f in glob.glob(spec) if os.path.isfile(f))
+
+#Files already warned about (watch mode lists the directory every pass)
+_notTraffic = set()
+
+def listTrafficSnapshots(spec, pattern="*.db"):
+    """listSnapshots, less any file that isn't a Traffic Analyzer database -
+       a staging directory usually holds nt_center.db and our own state too"""
+    snapshots = []
+    for f in listSnapshots(spec, pattern):
+        try:
+            found = routerDB.connect(f).execute("SELECT 1 FROM sqlite_master "
+                                                "WHERE type='table' AND name='traffic'").fetchone()
+        except sqlite3.DatabaseError:
+            found = None
+        if found is not None:
+            snapshots.append(f)
+            continue
+        routerDB.release(f)
+        if f not in _notTraffic:
+            _notTraffic.add(f)
+            print(f"WARN {f} has no traffic table, skipping it")
+    return snapshots
+
+def routerForSnapshot(dbfile, routerMap, defaultRouter=None):
+    """Pick the router tag for a snapshot from a {filename-glob: router} map"""
+    for pattern in routerMap:
+        if fnmatch(os.path.basename(dbfile), pattern):
+            return routerMap[pattern]
+    return defaultRouter
+
+def boundedMap(executor, fn, tasks, ahead):
+    """Like executor.map(), results in task order, but never more than
+       `ahead` tasks outstanding so results can't pile up in memory"""
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, task))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
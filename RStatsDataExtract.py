@@ -11,59 +11,87 @@
 ###############################################################################
 import gzip
 import struct
+import zlib
 from collections import namedtuple
 from datetime import datetime, timezone
 from time import ctime
 
+Bandwidth = namedtuple('Bandwidth', 'date down up')
+
 ###############################################################################
 ###############################################################################
 class TomatoData(object):
-    """Parser for gzip compressed Tomato RStats data"""
+    """Parser for (usually gzip compressed) Tomato RStats data. Accepts a file
+       name, the file contents as bytes, or a list of either - in which case
+       the counters are merged, later files winning where dates overlap."""
     ID_V0 = 0x30305352
     ID_V1 = 0x31305352
+    #The original used "l" but that's platform-size-dependent; "q" is a long
+    #long of 8 bytes, always. "I4x2Q" is the 24 byte I2Q record spelt out.
+    HEADER = struct.Struct("I0q")
+    POINTER = struct.Struct("i0q")
+    RECORD = struct.Struct("I4x2Q")
 
     def __init__(self, filename):
         self.daily = []
         self.monthly = []
-        self.rstats_file = self._decompress(filename)
-        self._load_history()
+        sources = filename if isinstance(filename, (list, tuple)) else [filename]
+        daily = {}
+        monthly = {}
+        for source in sources:
+            d, m = self._load_history(self._decompress(source))
+            #(unused slots have a zero date)
+            daily.update((b.date, b) for b in d if b.date != 0)
+            monthly.update((b.date, b) for b in m if b.date != 0)
+        self.daily = [daily[k] for k in sorted(daily)]
+        self.monthly = [monthly[k] for k in sorted(monthly)]
+        #Dates are worked out once here, not on every call
+        self._dailyFmt = self._format_counters(self.daily)
+        self._monthlyFmt = self._format_counters(self.monthly)
 
     def _decompress(self,fname):
+        """Whole file into memory in one go; gzip or not, we can tell from
+           the magic number"""
         try:
-            return gzip.open(fname,'rb')
-        except IOError as e:
-            print(f"ERROR File {fname} could not be decompressed: {e}")
-            exit(1)
-
-    def _load_history(self):
+            if isinstance(fname, (bytes, bytearray, memoryview)):
+                data = bytes(fname)
+            else :
+                with open(fname, 'rb') as rf:
+                    data = rf.read()
+            if data[:2] == b"\x1f\x8b":
+                data = gzip.decompress(data)
+            return data
+        except (IOError, EOFError, gzip.BadGzipFile, zlib.error) as e:
+            #(e.g. caught half-copied; a caller that keeps running can try again later)
+            raise ValueError(f"File {fname if isinstance(fname, str) else '(data)'} could not be decompressed: {e}")
+
+    def _load_history(self, data):
+        """Decode a whole rstats file from a buffer in one pass"""
         max_daily=62
         max_monthly=25
 
-        Bandwidth = namedtuple('Bandwidth', 'date down up')
-        daily = []
-        monthly = []
-
-        #original used "l" but that's platform-size-dependent.
-        # "q" is a long long of 8 bytes, always
-        version, = struct.unpack("I0q", self.rstats_file.read(8))
+        buf = memoryview(data)
+        if len(buf) < self.HEADER.size:
+            raise ValueError(f"Truncated Rstats file ({len(buf)} bytes)")
+        version, = self.HEADER.unpack_from(buf, 0)
 
         if version == TomatoData.ID_V0:
             max_monthly = 12
         elif version != TomatoData.ID_V1:
-            print(f"Unknown Rstats file version, aborting ({hex(version)})")
-            exit(1)
-
-        for i in range(max_daily):
-            self.daily.append(Bandwidth._make(struct.unpack("I2Q", self.rstats_file.read(24))))
+            raise ValueError(f"Unknown Rstats file version ({hex(version)})")
 
-        #Again, original format was "i0l" but that's 4 bytes on some platforms:
-        dailyp, = struct.unpack("i0q", self.rstats_file.read(8))
+        dailyStart = self.HEADER.size
+        monthlyStart = dailyStart + max_daily * self.RECORD.size + self.POINTER.size
+        needed = monthlyStart + max_monthly * self.RECORD.size + self.POINTER.size
+        if len(buf) < needed:
+            raise ValueError(f"Truncated Rstats file ({len(buf)} of {needed} bytes)")
 
-        for i in range(max_monthly):
-            self.monthly.append(Bandwidth._make(struct.unpack("I2Q", self.rstats_file.read(24))))
-
-        #Another format change "i0l" -> "i0q"
-        monthlyp, = struct.unpack("i0q", self.rstats_file.read(8))
+        daily = [Bandwidth._make(r) for r in
+                 self.RECORD.iter_unpack(buf[dailyStart:dailyStart + max_daily * self.RECORD.size])]
+        monthly = [Bandwidth._make(r) for r in
+                   self.RECORD.iter_unpack(buf[monthlyStart:monthlyStart + max_monthly * self.RECORD.size])]
+        #(the dailyp/monthlyp "current slot" pointers after each block aren't needed)
+        return daily, monthly
 
     @staticmethod
     def get_date(xtime):
@@ -85,41 +113,37 @@ class TomatoData(object):
                 outCount.append(cMetric)
         return outCount
 
-    def _prettyPrint_counters(self,counters):
+    @staticmethod
+    def _prettyPrint_counters(formatted):
         """Helper class to pretty-print set of counters"""
-        for val in sorted(self._format_counters(counters), key=lambda k: k['date'], reverse=False):
+        for val in sorted(formatted, key=lambda k: k['date'], reverse=False):
             print(f"{ctime(val['date'])}\t\t{val['down']}\t{val['up']}")
 
-    def _getDateRange(self, counters):
+    @staticmethod
+    def _getDateRange(formatted):
         """Helper function, return earliest & latest defined date from counter"""
-        earliest=99999999999999
-        latest=0
-        for c in counters:
-            if c.date != 0:
-                cdate=self.get_date(c.date)
-                if cdate > latest:
-                    latest = cdate
-                if cdate < earliest:
-                    earliest = cdate
-        return earliest, latest
+        if len(formatted) < 1:
+            return 99999999999999, 0
+        dates = [c['date'] for c in formatted]
+        return min(dates), max(dates)
 
     def getDaily(self) :
-        return self._format_counters(self.daily)
+        return [dict(c) for c in self._dailyFmt]
 
     def getMonthly(self) :
-        return self._format_counters(self.monthly)
+        return [dict(c) for c in self._monthlyFmt]
 
     def getDailyRange(self):
-        return self._getDateRange(self.daily)
+        return self._getDateRange(self._dailyFmt)
 
     def getMonthlyRange(self):
-        return self._getDateRange(self.monthly)
+        return self._getDateRange(self._monthlyFmt)
 
     def prettyPrintDaily(self):
-        self._prettyPrint_counters(self.daily)
+        self._prettyPrint_counters(self._dailyFmt)
 
     def prettyPrintMonthly(self):
-        self._prettyPrint_counters(self.monthly)
+        self._prettyPrint_counters(self._monthlyFmt)
 
 
 ###############################################################################
@@ -128,10 +152,14 @@ class TomatoData(object):
 if __name__ == "__main__":
     print("This is a TEST PROGRAM")
     print("(you probably don't want to be here)")
-    from sys import argv
+    from sys import argv, exit
     from os.path import isfile
-    if len(argv) == 2 and isfile(argv[1]):
-        bwUsage = TomatoData(argv[1])
+    if len(argv) >= 2 and all(isfile(f) for f in argv[1:]):
+        try:
+            bwUsage = TomatoData(argv[1:] if len(argv) > 2 else argv[1])
+        except ValueError as e:
+            print(f"ERROR {e}")
+            exit(1)
         print("Daily Data:")
         print(f"Daily Date Ranges:   {bwUsage.getDailyRange()}")
         print(f"\tDate\t\t\t\t\tdown\tup")
@@ -140,4 +168,5 @@ if __name__ == "__main__":
         print(f"Monthly Date Ranges: {bwUsage.getMonthlyRange()}")
         bwUsage.prettyPrintMonthly()
     else :
-        print("When called directly, supply the path to a COMPRESSED ASUS RStats (tomato) file on the command line")
+        print("When called directly, supply the path to an ASUS RStats (tomato) file on the command line")
+        print("(or several, to see them merged)")
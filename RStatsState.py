@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+##############################################################################
+# RStatsState.py
+# --------------
+#
+# The RStats file holds 62 days and 25 months of counters, but from one run
+# to the next usually only today's and this month's figures change. This
+# keeps a hash of the (down, up) values last written for every date, per
+# measurement, so a run only needs to write the rows that are new or whose
+# counters have moved on.
+#
+# With no state (a first run, or after deleting the file) every row counts
+# as new, so the whole of the file's history is written; dates that were
+# missed for any reason are likewise picked up the next time they're seen.
+#
+# Like IngestCheckpoint the file is JSON, replaced atomically on update. It
+# should only be updated once the rows concerned have been written.
+###############################################################################
+import hashlib
+import json
+import os
+from os.path import isfile
+
+class RStatsState(object):
+    """Per-date hash of the RStats counters last written, per measurement"""
+
+    def __init__(self, statefile):
+        """Load any existing state from the file given"""
+        self.statefile = statefile
+        #measurement -> date (as a string, it's JSON) -> hash
+        self.hashes = {}
+        if isfile(self.statefile):
+            with open(self.statefile) as sf:
+                try:
+                    self.hashes = json.load(sf)
+                except json.decoder.JSONDecodeError as e:
+                    #Not fatal, it just means everything gets written again.
+                    print(f"WARN Ignoring unreadable RStats state file {self.statefile}, {e}")
+
+    @staticmethod
+    def rowHash(metric):
+        return hashlib.blake2b(f"{metric['down']},{metric['up']}".encode(), digest_size=8).hexdigest()
+
+    def changed(self, measurement, metrics):
+        """The metrics (from TomatoData.getDaily/getMonthly) not yet written as they are now"""
+        known = self.hashes.get(measurement, {})
+        return [m for m in metrics if known.get(str(m['date'])) != self.rowHash(m)]
+
+    def update(self, measurement, metrics):
+        """Record metrics as written and persist straight away"""
+        known = self.hashes.setdefault(measurement, {})
+        for m in metrics:
+            known[str(m['date'])] = self.rowHash(m)
+        self._save()
+
+    def _save(self):
+        """Write-then-rename so the state file is never half-written"""
+        tmpfile = self.statefile + ".tmp"
+        with open(tmpfile, "w") as sf:
+            json.dump(self.hashes, sf, indent=1, sort_keys=True)
+            sf.flush()
+            os.fsync(sf.fileno())
+        os.replace(tmpfile, self.statefile)
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from time import ctime
+    from sys import argv
+    if len(argv) == 2 and isfile(argv[1]):
+        state = RStatsState(argv[1]).hashes
+        for measurement in state:
+            dates = sorted(int(d) for d in state[measurement])
+            if len(dates) < 1:
+                continue
+            print(f"{measurement}\t{len(dates)} dates, {ctime(dates[0])} - {ctime(dates[-1])}")
+    else :
+        print("When called directly, supply the path to an RStats state file on the command line")
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+##############################################################################
+# RouterDB.py
+# -----------
+#
+# The router's databases (TrafficAnalyzer.db, nt_center.db) are only ever
+# read here, and are usually copies that nothing else will touch - yet a
+# plain sqlite3.connect(path) opens them read-write, with the locking and
+# journal checks that go with it, through a small page cache. RouterDB is
+# the one place they're opened:
+#    - as mode=ro&immutable=1 URIs: SQLite takes no locks and doesn't look
+#      for a journal, and the file is memory-mapped (mmapMB) so a scan is
+#      served straight from the OS page cache rather than copied into
+#      SQLite's own (cacheMB, for anything past the mapped part)
+#    - connections are pooled by file, so every parser in a run (and every
+#      window a worker process reads) shares one per file rather than
+#      opening its own. A pooled connection is re-opened if the file has
+#      changed since (immutable means SQLite won't notice by itself).
+#    - a file that still looks live - modified in the last liveSeconds, or
+#      with a -journal/-wal beside it, e.g. an scp still in progress - is
+#      never opened immutable (SQLite would take no locks and could read
+#      torn pages without noticing). By default it's read with SQLite's
+#      normal locking; with copyTo set it's copied first with the SQLite
+#      backup API (which reads a consistent snapshot under that locking)
+#      into memory or onto tmpfs, and the copy read instead. A file we've
+#      just written ourselves (markComplete) isn't live, however new.
+#
+# Each process has its own pool (routerDB); a worker process started by
+# fork drops the connections it inherited rather than using them.
+###############################################################################
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.request import pathname2url
+
+class RouterDB(object):
+    """Pool of shared, read-only, memory-mapped connections to router databases"""
+
+    def __init__(self, mmapMB=1024, cacheMB=64, copyTo=None, liveSeconds=60):
+        """copyTo: None (read live files in place, with locking), "memory",
+           or a directory (e.g. /dev/shm) to copy live files to"""
+        self._lock = threading.Lock()
+        #realpath -> (connection, file identity when opened, copy's path or None)
+        self._pool = {}
+        #realpaths of files known to be whole, however recently written
+        self._complete = set()
+        self._pid = os.getpid()
+        self.opened = 0
+        self.reused = 0
+        self.copied = 0
+        self.configure(mmapMB, cacheMB, copyTo, liveSeconds)
+
+    def configure(self, mmapMB=None, cacheMB=None, copyTo=None, liveSeconds=None):
+        """Change the settings (None leaves one as it is, except copyTo);
+           connections already open keep theirs"""
+        if mmapMB is not None:
+            self.mmapMB = mmapMB
+        if cacheMB is not None:
+            self.cacheMB = cacheMB
+        self.copyTo = copyTo
+        if liveSeconds is not None:
+            self.liveSeconds = liveSeconds
+
+    def settings(self):
+        """configure() arguments for the same settings (e.g. for worker processes)"""
+        return {'mmapMB': self.mmapMB, 'cacheMB': self.cacheMB, 'copyTo': self.copyTo,
+                'liveSeconds': self.liveSeconds}
+
+    @staticmethod
+    def _identity(path):
+        st = os.stat(path)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def markComplete(self, dbfile):
+        """dbfile was written by us and is finished with (e.g. a database
+           spooled out of an archive), so it's never treated as live"""
+        with self._lock:
+            self._complete.add(os.path.realpath(dbfile))
+
+    def _isLive(self, path):
+        if path in self._complete:
+            return False
+        if os.path.exists(path + "-journal") or os.path.exists(path + "-wal"):
+            return True
+        return os.stat(path).st_mtime > time.time() - self.liveSeconds
+
+    def _tune(self, conn):
+        conn.execute(f"PRAGMA mmap_size={int(self.mmapMB * 1048576)}")
+        conn.execute(f"PRAGMA cache_size={-int(self.cacheMB * 1024)}")
+        return conn
+
+    def _open(self, path):
+        """A new (connection, copy path) for a file"""
+        uri = "file:" + pathname2url(path)
+        live = self._isLive(path)
+        if live and self.copyTo is None:
+            #Still being written: no copy wanted, so read it where it is,
+            #but with locking and change detection
+            conn = sqlite3.connect(uri + "?mode=ro", uri=True, check_same_thread=False)
+            return self._tune(conn), None
+        if live:
+            #Read-only but not immutable, so the backup sees a consistent
+            #snapshot even if the file is being written to
+            src = sqlite3.connect(uri + "?mode=ro", uri=True)
+            try:
+                if self.copyTo == "memory":
+                    copy = None
+                    dst = sqlite3.connect(":memory:", check_same_thread=False)
+                else :
+                    fd, copy = tempfile.mkstemp(dir=self.copyTo, prefix="routerdb-", suffix="-" + os.path.basename(path))
+                    os.close(fd)
+                    dst = sqlite3.connect(copy)
+                src.backup(dst)
+            finally:
+                src.close()
+            self.copied += 1
+            if copy is None:
+                return self._tune(dst), None
+            dst.close()
+            uri = "file:" + pathname2url(copy)
+        else :
+            copy = None
+        conn = sqlite3.connect(uri + "?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        return self._tune(conn), copy
+
+    def connect(self, dbfile):
+        """The shared connection for a database file. Don't close it - it
+           belongs to the pool (see release())."""
+        path = os.path.realpath(dbfile)
+        #(a missing file is a FileNotFoundError here, rather than an empty
+        #database created in its place as a plain connect would)
+        identity = self._identity(path)
+        with self._lock:
+            if os.getpid() != self._pid:
+                #Inherited over a fork: the parent's, not ours to use or close
+                self._pool = {}
+                self._pid = os.getpid()
+            entry = self._pool.get(path)
+            if entry is not None and entry[1] == identity:
+                self.reused += 1
+                return entry[0]
+            if entry is not None:
+                self._discard(entry)
+            conn, copy = self._open(path)
+            self._pool[path] = (conn, identity, copy)
+            self.opened += 1
+            return conn
+
+    @staticmethod
+    def _discard(entry):
+        conn, _, copy = entry
+        conn.close()
+        if copy is not None and os.path.isfile(copy):
+            os.remove(copy)
+
+    def release(self, dbfile):
+        """Close a file's connection (e.g. before the file is deleted)"""
+        with self._lock:
+            self._complete.discard(os.path.realpath(dbfile))
+            entry = self._pool.pop(os.path.realpath(dbfile), None)
+            if entry is not None and os.getpid() == self._pid:
+                self._discard(entry)
+
+    def closeAll(self):
+        with self._lock:
+            if os.getpid() == self._pid:
+                for entry in self._pool.values():
+                    self._discard(entry)
+            self._pool = {}
+
+    def summary(self):
+        return f"{self.opened} opened, {self.reused} reused, {self.copied} copied first"
+
+#The pool for this process
+routerDB = RouterDB()
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from os.path import isfile
+    from sys import argv
+    if len(argv) == 2 and isfile(argv[1]):
+        for label, pooled in (("plain", False), ("pooled", True)):
+            sT = time.perf_counter()
+            for _ in range(5):
+                if not pooled:
+                    conn = sqlite3.connect(argv[1])
+                else :
+                    conn = routerDB.connect(argv[1])
+                tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+                for table in tables:
+                    conn.execute(f"SELECT COUNT(*), SUM(LENGTH(CAST(rowid AS TEXT))) FROM {table}").fetchone()
+                if not pooled:
+                    conn.close()
+            print(f"{label:8} 5 full scans of {', '.join(tables)} in {time.perf_counter()-sT:.2f}s")
+        print(f"Pool: {routerDB.summary()}")
+    else :
+        print("When called directly, supply the path to a router SQLite database on the command line")
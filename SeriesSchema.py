@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+##############################################################################
+# SeriesSchema.py
+# ---------------
+#
+# Every distinct tag set in Influx is a series, and every series costs index
+# space and memory. By default the traffic measurement is tagged with mac,
+# app, cat AND name, so:
+#    - renaming a device starts a whole new set of series for it
+#    - the series count is the number of (mac, app, cat) combinations, and
+#      the long tail of apps each used once for a few bytes is most of them
+#
+# A SeriesSchema changes how records map onto series:
+#    nameMode   'tag' (as before), 'field' (name is stored with each point,
+#               so it's still there to read but isn't part of the series)
+#               or 'drop'
+#    dictionary app and cat tags become short codes (a12, c3); the code
+#               table is kept in the schema file (and can be turned into
+#               Grafana value mappings)
+#    foldBelow  apps whose share of all the traffic seen is below this
+#               fraction are folded into one "other" app per device and
+#               category, their tx/rx summed
+#
+# The schema file remembers the codes handed out and which apps have been
+# kept out of "other", so both stay the same from run to run (an app that
+# once made the cut always does; one that grows into it later keeps its
+# earlier history under "other").
+#
+# project() estimates the series (and index key bytes) a configuration would
+# produce from an extractor's metadata, before anything is written.
+###############################################################################
+import json
+import os
+from os.path import isfile
+
+class SeriesSchema(object):
+    """Mapping of traffic records onto Influx tag sets: name handling,
+       app/cat dictionary coding and long-tail folding"""
+    nameModes = ('tag', 'field', 'drop')
+    otherApp = "other"
+
+    def __init__(self, nameMode='tag', dictionary=False, foldBelow=0.0, schemafile=None):
+        if nameMode not in SeriesSchema.nameModes:
+            raise ValueError(f"Unknown name mode '{nameMode}' (want tag, field or drop)")
+        self.nameMode = nameMode
+        self.dictionary = dictionary
+        self.foldBelow = foldBelow
+        self.schemafile = schemafile
+        #name -> code
+        self.appCodes = {}
+        self.catCodes = {}
+        #Apps kept out of "other" (None: nothing folded)
+        self.kept = None
+        if schemafile is not None and isfile(schemafile):
+            with open(schemafile) as sf:
+                try:
+                    saved = json.load(sf)
+                    self.appCodes = saved.get('apps', {})
+                    self.catCodes = saved.get('cats', {})
+                    self.kept = set(saved['kept']) if saved.get('kept') is not None else None
+                except json.decoder.JSONDecodeError as e:
+                    #Codes must never be re-used for something else, so this is fatal
+                    raise TypeError(f"Unreadable series schema file {schemafile}, {e}")
+
+    @property
+    def folding(self):
+        return self.foldBelow > 0
+
+    @staticmethod
+    def usage(combos):
+        """app -> total bytes, from TrafficAnalyzerExtractor.combos"""
+        used = {}
+        for (mac, app, cat), v in combos.items():
+            used[app] = used.get(app, 0) + v[3] + v[4]
+        return used
+
+    def plan(self, combos, save=True):
+        """Bring the codes and kept apps up to date with an extractor's
+           metadata (combos), saving the schema file if anything changed
+           (and save is set)"""
+        changed = False
+        if self.folding:
+            used = self.usage(combos)
+            total = sum(used.values())
+            kept = self.kept if self.kept is not None else set()
+            for app in used:
+                if app not in kept and total > 0 and used[app] >= total * self.foldBelow:
+                    kept.add(app)
+                    changed = True
+            self.kept = kept
+        if self.dictionary:
+            #Sorted so that two runs over the same data hand out the same codes
+            for codes, prefix, values in ((self.appCodes, "a", {k[1] for k in combos}),
+                                          (self.catCodes, "c", {k[2] for k in combos})):
+                for v in sorted(values - codes.keys()):
+                    codes[v] = f"{prefix}{len(codes)}"
+                    changed = True
+        if changed and save:
+            self._save()
+
+    def _save(self):
+        if self.schemafile is None:
+            return
+        tmpfile = self.schemafile + ".tmp"
+        with open(tmpfile, "w") as sf:
+            json.dump({'apps': self.appCodes, 'cats': self.catCodes,
+                       'kept': sorted(self.kept) if self.kept is not None else None}, sf, indent=1)
+            sf.flush()
+            os.fsync(sf.fileno())
+        os.replace(tmpfile, self.schemafile)
+
+    def folds(self, app):
+        return self.folding and self.kept is not None and app not in self.kept
+
+    def tags(self, mac, app, cat, name):
+        """The tags a record gets (before any extra tags like router)"""
+        if self.folds(app):
+            app = SeriesSchema.otherApp
+        elif self.dictionary:
+            app = self.appCodes.get(app, app)
+        if self.dictionary:
+            cat = self.catCodes.get(cat, cat)
+        tags = {'app': app, 'cat': cat, 'mac': mac}
+        if self.nameMode == 'tag':
+            tags['name'] = name
+        return tags
+
+    def project(self, combos, macNameList, extraTags=None):
+        """(series, index key bytes) this schema would give for the combos"""
+        extra = dict(extraTags) if extraTags is not None else {}
+        series = set()
+        for mac, app, cat in combos:
+            tags = dict(extra)
+            tags.update(self.tags(mac, app, cat, macNameList.get(mac, mac)))
+            series.add(",".join(f"{k}={tags[k]}" for k in sorted(tags)))
+        return len(series), sum(len(s) for s in series)
+
+    def valueMappings(self):
+        """code -> name for app and cat, e.g. for Grafana value mappings"""
+        return {'app': {c: n for n, c in self.appCodes.items()}, 'cat': {c: n for n, c in self.catCodes.items()}}
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from sys import argv
+    if len(argv) == 2 and isfile(argv[1]):
+        schema = SeriesSchema(schemafile=argv[1])
+        print(f"{len(schema.appCodes)} app codes, {len(schema.catCodes)} category codes, "
+              f"{len(schema.kept) if schema.kept is not None else 'all'} apps kept out of '{SeriesSchema.otherApp}'")
+        print(json.dumps(schema.valueMappings(), indent=1))
+    else :
+        print("When called directly, supply the path to a series schema file on the command line")
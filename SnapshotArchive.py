@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+##############################################################################
+# SnapshotArchive.py
+# ------------------
+#
+# Router backups tend to arrive as tar(.gz) bundles of the files this repo
+# reads: TrafficAnalyzer.db, nt_center.db, custom_clientlist and the RStats
+# file. Rather than extracting each bundle to disk first, the archive is
+# read as a stream (tarfile "r|*", so it's never seeked and can be any of
+# gzip/bz2/xz) and the members we want are picked out as they go past:
+#    - the SQLite databases are spooled to temporary files, on tmpfs
+#      (/dev/shm) where there is one, since SQLite needs a real file; they
+#      are deleted as soon as the archive has been dealt with
+#    - custom_clientlist is kept as a string and the RStats file as bytes,
+#      both of which the parsers accept directly
+# Everything else in the archive is skipped without being unpacked.
+#
+# (A memfd would avoid even the tmpfs file, but SQLite resolves the
+# /proc/self/fd/N symlink to a path that doesn't exist and opens that.)
+#
+# ArchiveLedger keeps the sha256 of every archive ingested so a bulk replay
+# can be re-run, or pointed at a directory that keeps growing, and only
+# the new archives are read.
+###############################################################################
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from fnmatch import fnmatch
+from os.path import isfile
+from RouterDB import routerDB
+
+def defaultSpoolDir():
+    """tmpfs if we've got it, otherwise wherever temporary files normally go"""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+class SnapshotArchive(object):
+    """The router files from one backup archive, streamed out of the tar"""
+
+    def __init__(self, archivefile, spoolDir=None, rstatsPattern="*rstats*"):
+        """Read through the archive once, spooling/keeping the members we use"""
+        self.archivefile = archivefile
+        self.spoolDir = spoolDir if spoolDir is not None else defaultSpoolDir()
+        self.rstatsPattern = rstatsPattern
+        #Paths of the spooled SQLite databases, None if not in the archive
+        self.trafficDB = None
+        self.ntCenterDB = None
+        #Contents of custom_clientlist (str) and the RStats file (bytes)
+        self.clientList = None
+        self.rstats = None
+        self.rstatsName = None
+        self._extract()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _spool(self, fileobj, name, previous):
+        """Copy a member out to a temporary file, replacing any earlier copy"""
+        if previous is not None:
+            os.remove(previous)
+        with tempfile.NamedTemporaryFile(dir=self.spoolDir, prefix="archive-", suffix=f"-{name}",
+                                         delete=False) as tmp:
+            shutil.copyfileobj(fileobj, tmp, 1048576)
+        #(brand new, but complete and ours: not to be mistaken for a live file)
+        routerDB.markComplete(tmp.name)
+        return tmp.name
+
+    def _extract(self):
+        try:
+            with tarfile.open(self.archivefile, "r|*") as tf:
+                for member in tf:
+                    if not member.isfile():
+                        continue
+                    name = os.path.basename(member.name)
+                    if name == "TrafficAnalyzer.db":
+                        self.trafficDB = self._spool(tf.extractfile(member), name, self.trafficDB)
+                    elif name == "nt_center.db":
+                        self.ntCenterDB = self._spool(tf.extractfile(member), name, self.ntCenterDB)
+                    elif name == "custom_clientlist":
+                        self.clientList = tf.extractfile(member).read().decode(errors="replace")
+                    elif fnmatch(name, self.rstatsPattern):
+                        self.rstats = tf.extractfile(member).read()
+                        self.rstatsName = name
+        except (tarfile.TarError, OSError, EOFError) as e:
+            self.close()
+            raise TypeError(f"{self.archivefile} is not a readable archive ({e})")
+
+    def close(self):
+        """Remove the spooled databases"""
+        for path in (self.trafficDB, self.ntCenterDB):
+            if path is not None and isfile(path):
+                routerDB.release(path)
+                os.remove(path)
+        self.trafficDB = None
+        self.ntCenterDB = None
+
+    @staticmethod
+    def sha256(archivefile):
+        digest = hashlib.sha256()
+        with open(archivefile, "rb") as af:
+            for block in iter(lambda: af.read(1048576), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+class ArchiveLedger(object):
+    """Persistent record of the archives (by content hash) already ingested"""
+
+    def __init__(self, ledgerfile):
+        self.ledgerfile = ledgerfile
+        #key (sha256, possibly namespaced) -> {'archive': name, 'ingested': time}
+        self.entries = {}
+        if isfile(self.ledgerfile):
+            with open(self.ledgerfile) as lf:
+                try:
+                    self.entries = json.load(lf)
+                except json.decoder.JSONDecodeError as e:
+                    print(f"WARN Ignoring unreadable archive ledger {self.ledgerfile}, {e}")
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record(self, key, archivefile):
+        self.entries[key] = {'archive': os.path.basename(archivefile), 'ingested': int(time.time())}
+        self._save()
+
+    def _save(self):
+        """Write-then-rename so the ledger is never half-written"""
+        tmpfile = self.ledgerfile + ".tmp"
+        with open(tmpfile, "w") as lf:
+            json.dump(self.entries, lf, indent=1)
+            lf.flush()
+            os.fsync(lf.fileno())
+        os.replace(tmpfile, self.ledgerfile)
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from sys import argv
+    if len(argv) == 2 and isfile(argv[1]):
+        print(f"sha256 {SnapshotArchive.sha256(argv[1])}")
+        with SnapshotArchive(argv[1]) as arc:
+            for label, path in (("TrafficAnalyzer.db", arc.trafficDB), ("nt_center.db", arc.ntCenterDB)):
+                print(f"{label:20} {'spooled to ' + path + ' (' + str(os.path.getsize(path)) + ' bytes)' if path else 'not found'}")
+            print(f"{'custom_clientlist':20} {str(len(arc.clientList)) + ' characters' if arc.clientList is not None else 'not found'}")
+            print(f"{'RStats':20} {arc.rstatsName + ', ' + str(len(arc.rstats)) + ' bytes' if arc.rstats is not None else 'not found'}")
+    else :
+        print("When called directly, supply the path to a router backup archive (tar/tar.gz) on the command line")
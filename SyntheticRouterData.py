@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+##############################################################################
+# SyntheticRouterData.py
+# ----------------------
+#
+# Generates a believable set of router files for testing and benchmarking,
+# without needing a router (or publishing what our own devices get up to):
+#
+#    TrafficAnalyzer.db    - the traffic table, hourly records per device/app
+#    nt_center.db          - notification events, some carrying macaddr/cname/ip
+#    custom_clientlist     - the angle-bracket delimited MAC->name file
+#    tomato_rstats_synthetic.gz - RStats (Tomato) daily/monthly counters
+#
+# The shape follows the real thing: each application belongs to a single
+# category, each device uses a handful of applications, and every hour the
+# router writes one record per device/application that saw traffic. Scale is
+# set by the number of traffic rows wanted; tens of millions is fine, the
+# inserts are streamed in transactions with journalling switched off.
+#
+# Everything comes from a seeded random generator so runs are repeatable.
+###############################################################################
+import gzip
+import json
+import os
+import random
+import sqlite3
+import struct
+from datetime import date, timedelta
+
+class SyntheticRouterData(object):
+    """Generator for synthetic ASUS router data files"""
+    #Same layout as the router's own table
+    traffic_schema = ("CREATE TABLE traffic(mac TEXT NOT NULL, app_name VARCHAR(50) NOT NULL, "
+                      "cat_name VARCHAR(50) NOT NULL, timestamp UNSIGNED BIG INT NOT NULL, "
+                      "tx UNSIGNED BIG INT NOT NULL, rx UNSIGNED BIG INT NOT NULL)")
+    nt_center_schema = ("CREATE TABLE nt_center(id INTEGER PRIMARY KEY, tstamp INTEGER, "
+                        "event INTEGER, status INTEGER, msg TEXT)")
+
+    def __init__(self, outdir, numRows=100000, numDevices=40, numApps=200, numCats=25,
+                 appsPerDevice=15, startTime=1600000000, seed=42):
+        """Set up the device/app population. Nothing is written until generate()."""
+        self.outdir = outdir
+        self.numRows = numRows
+        self.startTime = startTime - (startTime % 3600)
+        self.rng = random.Random(seed)
+        self.macs = [f"{self.rng.randrange(256):02X}:{self.rng.randrange(256):02X}:"
+                     f"{i//65536%256:02X}:{i//256%256:02X}:{i%256:02X}:{self.rng.randrange(256):02X}"
+                     for i in range(numDevices)]
+        self.names = {m: f"Device {i}" for i,m in enumerate(self.macs)}
+        cats = [f"Category {i}" for i in range(numCats)]
+        #A few of the awkward names real routers report:
+        apps = ["Apple, Inc=Push", "Web Browsing", "SSL/TLS", "Netflix"] + \
+               [f"Application {i}" for i in range(max(0, numApps-4))]
+        self.appCat = {a: self.rng.choice(cats) for a in apps}
+        self.deviceApps = {m: self.rng.sample(apps, min(appsPerDevice, len(apps))) for m in self.macs}
+        self.trafficFile = os.path.join(outdir, "TrafficAnalyzer.db")
+        self.ntCenterFile = os.path.join(outdir, "nt_center.db")
+        self.clientListFile = os.path.join(outdir, "custom_clientlist")
+        self.rstatsFile = os.path.join(outdir, "tomato_rstats_synthetic.gz")
+
+    def generate(self):
+        """Write all four files, returning their paths"""
+        os.makedirs(self.outdir, exist_ok=True)
+        self.writeTraffic()
+        self.writeNtCenter()
+        self.writeClientList()
+        self.writeRStats()
+        return {'trafDataDB': self.trafficFile, 'ntDBFile': self.ntCenterFile,
+                'clientJSONfile': self.clientListFile, 'rstatsfile': self.rstatsFile}
+
+    def _trafficRows(self):
+        """Hour by hour, a record for each device/app that was busy"""
+        rng = self.rng
+        hour = self.startTime
+        made = 0
+        while made < self.numRows:
+            for mac in self.macs:
+                if rng.random() < 0.3:
+                    continue #Device idle (or off) this hour
+                for app in self.deviceApps[mac]:
+                    if rng.random() < 0.5:
+                        continue
+                    yield (mac, app, self.appCat[app], hour,
+                           int(rng.expovariate(1/200000)), int(rng.expovariate(1/2000000)))
+                    made += 1
+                    if made >= self.numRows:
+                        return
+            hour += 3600
+
+    def writeTraffic(self):
+        """Create TrafficAnalyzer.db with numRows traffic records"""
+        if os.path.exists(self.trafficFile):
+            os.remove(self.trafficFile)
+        conn = sqlite3.connect(self.trafficFile)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(self.traffic_schema)
+        rows = self._trafficRows()
+        while True:
+            batch = [r for _,r in zip(range(100000), rows)]
+            if len(batch) < 1:
+                break
+            conn.executemany("INSERT INTO traffic VALUES (?,?,?,?,?,?)", batch)
+            conn.commit()
+        conn.close()
+
+    def writeNtCenter(self):
+        """Create nt_center.db: name/IP events for most devices among other noise"""
+        if os.path.exists(self.ntCenterFile):
+            os.remove(self.ntCenterFile)
+        conn = sqlite3.connect(self.ntCenterFile)
+        conn.execute(self.nt_center_schema)
+        tstamp = self.startTime
+        events = []
+        for i,mac in enumerate(self.macs):
+            for _ in range(self.rng.randint(1, 5)):
+                tstamp += self.rng.randint(60, 86400)
+                if i % 5 == 0:
+                    msg = {"event": "wan_up"} #No MAC in this one
+                else :
+                    msg = {"macaddr": mac, "cname": self.names[mac],
+                           "ip": f"192.168.1.{10 + i % 240}"}
+                events.append((tstamp, 1, 0, json.dumps(msg)))
+        events.append((tstamp, 2, 0, "{not valid json"))
+        conn.executemany("INSERT INTO nt_center(tstamp,event,status,msg) VALUES (?,?,?,?)", events)
+        conn.commit()
+        conn.close()
+
+    def writeClientList(self):
+        """User-assigned names for a subset of devices"""
+        with open(self.clientListFile, "w") as cl:
+            cl.write("".join(f"<{self.names[m]} (custom)>{m}>0>0>>" for m in self.macs[::3]))
+
+    @staticmethod
+    def _xtime(d):
+        """Tomato packs dates as (year-1900)<<16 | (month-1)<<8 | day"""
+        return ((d.year - 1900) << 16) | ((d.month - 1) << 8) | d.day
+
+    def writeRStats(self):
+        """A version 1 rstats file: 62 daily and 25 monthly counters"""
+        today = date.fromtimestamp(self.startTime) + timedelta(days=max(1, self.numRows // 5000))
+        data = struct.pack("I0q", 0x31305352)
+        for i in range(62):
+            d = today - timedelta(days=i)
+            data += struct.pack("I2Q", self._xtime(d), self.rng.randint(10**8, 10**11), self.rng.randint(10**7, 10**10))
+        data += struct.pack("i0q", 0)
+        month = today.replace(day=1)
+        for i in range(25):
+            data += struct.pack("I2Q", self._xtime(month), self.rng.randint(10**10, 10**12), self.rng.randint(10**9, 10**11))
+            month = (month - timedelta(days=1)).replace(day=1)
+        data += struct.pack("i0q", 0)
+        with gzip.open(self.rstatsFile, "wb") as rf:
+            rf.write(data)
+
+if __name__ == "__main__":
+    from sys import argv
+    if len(argv) in (2, 3):
+        numRows = int(argv[2]) if len(argv) == 3 else 100000
+        files = SyntheticRouterData(argv[1], numRows).generate()
+        for f in files:
+            print(f"{f:15} {files[f]}")
+    else :
+        print("Usage: SyntheticRouterData.py <output directory> [number of traffic rows]")
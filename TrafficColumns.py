@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+##############################################################################
+# TrafficColumns.py
+# -----------------
+#
+# A traffic record as a dict - six string keys, the MAC/app/category
+# strings, three boxed ints - costs a few hundred bytes. For a chunk on its
+# way to the encoder that doesn't matter; for a report or rollup over
+# millions of rows it's most of the memory. This is the same data as
+# columns:
+#    - ts, tx, rx (and rowid) in array('q') columns, 8 bytes a value
+#    - mac, app and cat as array('I') codes into StringTables, so each
+#      distinct string is held once, however many rows use it
+#    - row views (with __slots__) that answer row['ts'], row['app'] etc
+#      for code written against the dicts
+#
+# sumBy() totals tx/rx grouped by any of ts (optionally cut into fixed
+# width time buckets), mac/device, app and cat without building a record
+# per row. With NumPy installed the columns are viewed as NumPy arrays (no
+# copy) and the grouping is vectorized; without it, it's a single pass of
+# plain Python over the columns. NumPy's bincount sums in float64, which is
+# only exact up to 2^53 (8 PiB) per group, so a value column whose total
+# could pass that is summed the plain Python way, in exact ints. Both ways
+# give identical results (the test program below checks they do).
+###############################################################################
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class StringTable(object):
+    """Dictionary coding: each distinct string is stored once and given a code"""
+    __slots__ = ('values', 'codes')
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        c = self.codes.get(value)
+        if c is None:
+            c = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return c
+
+    def encode(self, values):
+        """Codes for a sequence of strings, as an array"""
+        for v in set(values) - self.codes.keys():
+            self.code(v)
+        return array('I', map(self.codes.__getitem__, values))
+
+class ColumnRow(object):
+    """One row of a Columns, read like the dict it replaces"""
+    __slots__ = ('_cols', '_i')
+
+    def __init__(self, cols, i):
+        self._cols = cols
+        self._i = i
+
+    def __getitem__(self, key):
+        return self._cols.value(key, self._i)
+
+    def get(self, key, default=None):
+        return self._cols.value(key, self._i) if key in self._cols.fields else default
+
+    def keys(self):
+        return self._cols.fields
+
+    def __iter__(self):
+        return iter(self._cols.fields)
+
+    def asDict(self):
+        return {k: self._cols.value(k, self._i) for k in self._cols.fields}
+
+    def __repr__(self):
+        return repr(self.asDict())
+
+class Columns(object):
+    """Base for column sets: integer columns in arrays, string columns as
+       codes into StringTables (which can be shared between column sets so
+       the codes mean the same thing in all of them)"""
+    numeric = ()
+    coded = ()
+    #Other names a column can be asked for by
+    aliases = {}
+
+    def __init__(self, tables=None):
+        self.fields = self.numeric + self.coded
+        self.tables = tables if tables is not None else {}
+        for name in self.coded:
+            self.tables.setdefault(name, StringTable())
+        self.cols = {name: array('q') for name in self.numeric}
+        self.cols.update({name: array('I') for name in self.coded})
+
+    def __len__(self):
+        return len(self.cols[self.fields[0]])
+
+    def __getitem__(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("row index out of range")
+        return ColumnRow(self, i)
+
+    def __iter__(self):
+        return (ColumnRow(self, i) for i in range(len(self)))
+
+    def value(self, key, i):
+        key = self.aliases.get(key, key)
+        if key in self.tables:
+            return self.tables[key].values[self.cols[key][i]]
+        return self.cols[key][i]
+
+    def extend(self, rows):
+        """Append rows given as tuples in numeric-then-coded field order"""
+        if len(rows) < 1:
+            return self
+        columns = list(zip(*rows))
+        for name, values in zip(self.fields, columns):
+            if name in self.tables:
+                self.cols[name].extend(self.tables[name].encode(values))
+            else :
+                self.cols[name].extend(values)
+        return self
+
+    def column(self, key):
+        """A whole column: the values for numeric ones, the codes for string
+           ones - a NumPy array (a view, not a copy) if NumPy is installed"""
+        col = self.cols[self.aliases.get(key, key)]
+        if numpy is not None:
+            return numpy.frombuffer(col, dtype=numpy.int64 if col.typecode == 'q' else numpy.uint32)
+        return col
+
+    def since(self, start):
+        """The rows from index start on, as a new column set (sharing the
+           string tables)"""
+        cols = type(self)(self.tables)
+        for name, col in self.cols.items():
+            cols.cols[name] = col[start:]
+        return cols
+
+    def toRecords(self):
+        """The rows as plain dicts"""
+        return [r.asDict() for r in self]
+
+    def nbytes(self):
+        """Bytes held by the columns themselves (not the string tables)"""
+        return sum(c.itemsize * len(c) for c in self.cols.values())
+
+    def _timeColumn(self, col, width, offset, bucketOf):
+        """The time column cut into buckets"""
+        if bucketOf is not None:
+            #Records share a handful of timestamps, so each distinct one is
+            #looked up once
+            if numpy is not None:
+                uniq, inverse = numpy.unique(numpy.frombuffer(col, dtype=numpy.int64), return_inverse=True)
+                return numpy.array([bucketOf(int(t)) for t in uniq], dtype=numpy.int64)[inverse.reshape(-1)]
+            buckets = {t: bucketOf(t) for t in set(col)}
+            return array('q', map(buckets.__getitem__, col))
+        if numpy is not None:
+            t = numpy.frombuffer(col, dtype=numpy.int64)
+            return t - (t - offset) % width
+        return array('q', (t - (t - offset) % width for t in col))
+
+    def sumBy(self, keys, values, width=None, offset=0, bucketOf=None):
+        """{group: (sum of value 1, sum of value 2)} for a pair of value
+           columns, grouped by the keys (a single key gives plain keys,
+           several give tuples). The time column can be cut into buckets:
+           width seconds wide, starting offset seconds past the epoch (e.g.
+           width=3600 for hourly), or bucketOf(ts) for uneven ones like
+           local days."""
+        keys = (keys,) if isinstance(keys, str) else tuple(keys)
+        groups = []
+        for key in keys:
+            key = self.aliases.get(key, key)
+            col = self.cols[key]
+            if key == self.timeField and (width is not None or bucketOf is not None):
+                col = self._timeColumn(col, width, offset, bucketOf)
+            groups.append((col, self.tables[key].values if key in self.tables else None))
+        first, second = [self.cols[self.aliases.get(v, v)] for v in values]
+        if len(self) < 1:
+            return {}
+        #(no group's sum can be bigger than its column's total)
+        if numpy is not None and all(int(numpy.abs(numpy.frombuffer(c, dtype=numpy.int64)).sum()) < 2**53
+                                     for c in (first, second)):
+            keyArray = numpy.stack([numpy.asarray(g[0], dtype=numpy.int64) for g in groups], axis=1)
+            uniq, inverse = numpy.unique(keyArray, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            #(float64 sums, exact as the totals are below 2^53)
+            sums = [numpy.rint(numpy.bincount(inverse, weights=numpy.frombuffer(c, dtype=numpy.int64),
+                                              minlength=len(uniq))).astype(numpy.int64) for c in (first, second)]
+            acc = {tuple(row): (int(sums[0][g]), int(sums[1][g])) for g, row in enumerate(uniq.tolist())}
+        else :
+            #Ints hash (and are made) far quicker than tuples, so if the keys
+            #after the first are codes they're packed into one int
+            strides = [len(tbl) if tbl is not None else None for _, tbl in groups[1:]]
+            packed = None not in strides
+            if packed:
+                keyCol = groups[0][0]
+                for (col, _), stride in zip(groups[1:], strides):
+                    keyCol = [k * stride + c for k, c in zip(keyCol, col)]
+            else :
+                keyCol = zip(*[g[0] for g in groups])
+            acc = {}
+            get = acc.get
+            for k, a, b in zip(keyCol, first, second):
+                s = get(k)
+                if s is None:
+                    acc[k] = [a, b]
+                else :
+                    s[0] += a
+                    s[1] += b
+            if packed:
+                return self._unpack(acc, groups, strides, len(keys) > 1)
+        out = {}
+        for k, v in acc.items():
+            label = tuple(tbl[c] if tbl is not None else c for c, (_, tbl) in zip(k, groups))
+            out[label if len(keys) > 1 else label[0]] = tuple(v)
+        return out
+
+    @staticmethod
+    def _unpack(acc, groups, strides, asTuples):
+        """sumBy() output from sums keyed by packed ints"""
+        out = {}
+        t0 = groups[0][1]
+        if len(groups) == 1:
+            for k, v in acc.items():
+                out[t0[k] if t0 is not None else k] = (v[0], v[1])
+        elif len(groups) == 2:
+            #(the usual case - time and one item - done without the loop)
+            s1 = strides[0]
+            t1 = groups[1][1]
+            for k, v in acc.items():
+                a, c = divmod(k, s1)
+                out[(t0[a] if t0 is not None else a, t1[c])] = (v[0], v[1])
+        else :
+            for k, v in acc.items():
+                parts = []
+                for stride, (_, tbl) in zip(reversed(strides), reversed(groups[1:])):
+                    k, c = divmod(k, stride)
+                    parts.append(tbl[c])
+                parts.append(t0[k] if t0 is not None else k)
+                out[tuple(reversed(parts))] = (v[0], v[1])
+        return out
+
+class TrafficColumns(Columns):
+    """Traffic Analyzer records as columns; rows read as {'ts','mac','app','cat','tx','rx','rowid'}"""
+    numeric = ('ts', 'tx', 'rx', 'rowid')
+    coded = ('mac', 'app', 'cat')
+    aliases = {'device': 'mac'}
+    timeField = 'ts'
+
+    @classmethod
+    def fromRows(cls, rows, tables=None):
+        """From (ts, mac, app, cat, tx, rx[, rowid]) tuples, e.g. straight off a cursor"""
+        cols = cls(tables)
+        if len(rows) < 1:
+            return cols
+        columns = list(zip(*rows))
+        c = cols.cols
+        c['ts'].extend(columns[0])
+        c['tx'].extend(columns[4])
+        c['rx'].extend(columns[5])
+        c['rowid'].extend(columns[6] if len(columns) > 6 else [-1] * len(rows))
+        for name, i in (('mac', 1), ('app', 2), ('cat', 3)):
+            c[name].extend(cols.tables[name].encode(columns[i]))
+        return cols
+
+    @classmethod
+    def fromRecords(cls, records, tables=None):
+        """From the dicts TrafficAnalyzerExtractor has always produced"""
+        return cls(tables).extend([(m['ts'], m['tx'], m['rx'], m.get('rowid', -1), m['mac'], m['app'], m['cat'])
+                                   for m in records])
+
+    def sumBy(self, keys, width=None, offset=0, bucketOf=None):
+        """{group: (tx, rx)}, e.g. sumBy('mac'), sumBy(('ts', 'app'), width=3600)"""
+        return Columns.sumBy(self, keys, ('tx', 'rx'), width, offset, bucketOf)
+
+    def totals(self):
+        """(tx, rx) over every row"""
+        return sum(self.cols['tx']), sum(self.cols['rx'])
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    import time
+    import tracemalloc
+    from os.path import isfile
+    from sys import argv
+    if len(argv) == 2 and isfile(argv[1]):
+        from read_traffic_database import TrafficAnalyzerExtractor
+        tdata = TrafficAnalyzerExtractor(argv[1])
+        print(f"NumPy {'available' if numpy is not None else 'not installed'}")
+        if numpy is not None:
+            #The vectorized sums must match the plain Python ones exactly
+            cols = next(tdata.iterColumnsAfter(-1, tdata.numrows + 1), TrafficColumns())
+            cases = [('app',), ('mac', 'cat'), ('ts', 'app'), ('ts', 'mac', 'app', 'cat')]
+            vectorized = [cols.sumBy(k) for k in cases] + [cols.sumBy(('ts', 'cat'), width=3600, offset=1800),
+                                                           cols.sumBy(('ts', 'mac'), bucketOf=lambda t: t - t % 86400)]
+            numpy, saved = None, numpy
+            plain = [cols.sumBy(k) for k in cases] + [cols.sumBy(('ts', 'cat'), width=3600, offset=1800),
+                                                      cols.sumBy(('ts', 'mac'), bucketOf=lambda t: t - t % 86400)]
+            numpy = saved
+            same = all(v == p for v, p in zip(vectorized, plain))
+            print(f"sumBy with NumPy against plain Python: {'identical' if same else 'DIFFERENT'} "
+                  f"({sum(len(v) for v in vectorized)} groups)")
+            if not same:
+                exit(1)
+        for label, fetch in (("dicts", lambda: tdata.getAllMetricsAfter(-1)),
+                             ("columns", lambda: next(tdata.iterColumnsAfter(-1, tdata.numrows + 1), TrafficColumns()))):
+            tracemalloc.start()
+            sT = time.perf_counter()
+            rows = fetch()
+            loadT = time.perf_counter() - sT
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            sT = time.perf_counter()
+            if label == "dicts":
+                byApp = {}
+                for m in rows:
+                    t = byApp.get(m['app'], (0, 0))
+                    byApp[m['app']] = (t[0] + m['tx'], t[1] + m['rx'])
+            else :
+                byApp = rows.sumBy('app')
+            sumT = time.perf_counter() - sT
+            print(f"{label:8} {len(rows)} rows, {size/1048576:.1f} MB, loaded in {loadT:.2f}s, "
+                  f"totals per app in {sumT*1000:.1f} ms ({len(byApp)} apps)")
+    else :
+        print("When called directly, supply the path to a TrafficAnalyzer.db on the command line")
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+##############################################################################
+# TrafficMirror.py
+# ----------------
+#
+# The router's own TrafficAnalyzer.db has no indexes (so every query is a
+# full scan) and is pruned by the router, so history drops off the end of
+# it. The mirror is a local, append-only SQLite copy of the traffic:
+#    - each snapshot is ATTACHed (read-only) and only rows from the newest
+#      second already copied from that file onwards are looked at; rows
+#      we've already got are ignored by a unique key on
+#      (timestamp, mac, app, cat)
+#    - app and category names are dictionary-coded into their own tables,
+#      which roughly halves the size of the traffic table
+#    - there are indexes on (timestamp) and (mac, timestamp), so reading
+#      "everything since T" or "one device's history" is a range scan
+#    - the per (mac, app, cat) summary the extractor needs is kept up to
+#      date as rows are copied in, rather than found by scanning everything
+#
+# TrafficMirror reads like TrafficAnalyzerExtractor (same attributes, same
+# iterMetricsAfter), so once a snapshot has been copied in the ingest can
+# run from the mirror instead. Its rowids are the mirror's own, which only
+# ever go up - though if an older snapshot is copied in late, its rows get
+# newer rowids than newer data, so oldestAdded says how far back the rows
+# not yet sent on go. It's kept in the mirror itself, set in the same
+# transaction as the rows are copied, and only cleared (clearPending) once
+# the write covering them has gone through - so a run that fails part way
+# leaves it for the next one.
+###############################################################################
+import os
+import sqlite3
+from urllib.request import pathname2url
+from TrafficColumns import TrafficColumns
+
+class TrafficMirror(object):
+    """Append-only, indexed local copy of the Traffic Analyzer data"""
+
+    def __init__(self, mirrorfile):
+        """Open (creating if need be) the mirror database"""
+        self.mirrorfile = mirrorfile
+        #(clearPending is called back from the writer's threads)
+        self.conn = sqlite3.connect(mirrorfile, uri=True, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS apps(id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS cats(id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS traffic(id INTEGER PRIMARY KEY, timestamp INTEGER, mac TEXT,
+                                               app INTEGER, cat INTEGER, tx INTEGER, rx INTEGER,
+                                               UNIQUE(timestamp, mac, app, cat));
+            CREATE INDEX IF NOT EXISTS traffic_ts ON traffic(timestamp);
+            CREATE INDEX IF NOT EXISTS traffic_mac_ts ON traffic(mac, timestamp);
+            CREATE TABLE IF NOT EXISTS combos(mac TEXT, app INTEGER, cat INTEGER, min_ts INTEGER,
+                                              max_ts INTEGER, count INTEGER, tx INTEGER, rx INTEGER,
+                                              PRIMARY KEY(mac, app, cat));
+            CREATE TABLE IF NOT EXISTS sources(source TEXT PRIMARY KEY, timestamp INTEGER);
+            CREATE TABLE IF NOT EXISTS pending(id INTEGER PRIMARY KEY CHECK(id = 0), timestamp INTEGER);
+        """)
+        if "tx" not in {r[1] for r in self.conn.execute("PRAGMA table_info(combos)")}:
+            #Mirrors from before the summary had traffic totals in
+            with self.conn:
+                self.conn.execute("DELETE FROM combos")
+                self.conn.execute("ALTER TABLE combos ADD COLUMN tx INTEGER")
+                self.conn.execute("ALTER TABLE combos ADD COLUMN rx INTEGER")
+                self._updateCombos(0)
+        self.conn.commit()
+        self.dbfile = mirrorfile
+        #Oldest timestamp among the rows copied in but not yet sent on, if any
+        self.oldestAdded = self._pending()
+        self._loadMetadata()
+
+    def __del__(self):
+        self.conn.close()
+
+    def absorb(self, trafficdbfile, source=None):
+        """Copy any new rows in from a TrafficAnalyzer.db snapshot; returns
+           the number of rows added. How far each source has been copied is
+           remembered under its path, or under source if given - e.g. for a
+           series of temporary copies of the same router's database."""
+        if source is None:
+            source = os.path.realpath(trafficdbfile)
+        r = self.conn.execute("SELECT timestamp FROM sources WHERE source=?", (source,)).fetchone()
+        since = r[0] if r is not None else 0
+        lastid, = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM traffic").fetchone()
+        #(quoted, as a ?, # or % in the path would otherwise end or mangle the URI)
+        self.conn.execute("ATTACH DATABASE ? AS snap", (f"file:{pathname2url(os.path.realpath(trafficdbfile))}?mode=ro",))
+        try:
+            with self.conn:
+                #(the newest second copied last time is looked at again, in
+                #case more rows for it were written after we last looked)
+                for table, column in (("apps", "app_name"), ("cats", "cat_name")):
+                    self.conn.execute(f"INSERT OR IGNORE INTO {table}(name) "
+                                      f"SELECT DISTINCT {column} FROM snap.traffic WHERE timestamp >= ?", (since,))
+                added = self.conn.execute(
+                    "INSERT OR IGNORE INTO traffic(timestamp, mac, app, cat, tx, rx) "
+                    "SELECT t.timestamp, t.mac, a.id, c.id, t.tx, t.rx FROM snap.traffic t "
+                    "JOIN apps a ON a.name = t.app_name JOIN cats c ON c.name = t.cat_name "
+                    "WHERE t.timestamp >= ? ORDER BY t.timestamp, t.rowid", (since,)).rowcount
+                newest, = self.conn.execute("SELECT MAX(timestamp) FROM snap.traffic").fetchone()
+                self.conn.execute("INSERT OR REPLACE INTO sources(source, timestamp) VALUES (?,?)",
+                                  (source, max(since, newest or 0)))
+                self._updateCombos(lastid)
+                #Rows can arrive out of time order (an older snapshot copied
+                #in late), which the ingest needs to know about
+                oldest, = self.conn.execute("SELECT MIN(timestamp) FROM traffic WHERE id > ?", (lastid,)).fetchone()
+                if oldest is not None:
+                    self.conn.execute("INSERT INTO pending(id, timestamp) VALUES (0, ?) "
+                                      "ON CONFLICT(id) DO UPDATE SET timestamp=MIN(timestamp, excluded.timestamp)",
+                                      (oldest,))
+        except sqlite3.OperationalError as e:
+            raise TypeError(f"{trafficdbfile} does not contain Traffic Analyzer records ({e})")
+        finally:
+            self.conn.execute("DETACH DATABASE snap")
+        self.oldestAdded = self._pending()
+        self._loadMetadata()
+        return added
+
+    def _pending(self):
+        r = self.conn.execute("SELECT timestamp FROM pending WHERE id = 0").fetchone()
+        return r[0] if r is not None else None
+
+    def clearPending(self, timestamp):
+        """The rows from timestamp on have been sent: forget oldestAdded,
+           unless older rows have been copied in since"""
+        with self.conn:
+            self.conn.execute("DELETE FROM pending WHERE id = 0 AND timestamp >= ?", (timestamp,))
+        self.oldestAdded = self._pending()
+
+    def _updateCombos(self, lastid):
+        """Fold rows past lastid into the per (mac, app, cat) summary"""
+        self.conn.execute(
+            "INSERT INTO combos(mac, app, cat, min_ts, max_ts, count, tx, rx) "
+            "SELECT mac, app, cat, MIN(timestamp), MAX(timestamp), COUNT(*), SUM(tx), SUM(rx) FROM traffic "
+            "WHERE id > ? GROUP BY mac, app, cat "
+            "ON CONFLICT(mac, app, cat) DO UPDATE SET min_ts=MIN(min_ts, excluded.min_ts), "
+            "max_ts=MAX(max_ts, excluded.max_ts), count=count+excluded.count, "
+            "tx=tx+excluded.tx, rx=rx+excluded.rx", (lastid,))
+
+    def _loadMetadata(self):
+        """The same summary TrafficAnalyzerExtractor provides, from the combos table"""
+        self.apps = dict(self.conn.execute("SELECT id, name FROM apps"))
+        self.cats = dict(self.conn.execute("SELECT id, name FROM cats"))
+        #(mac,app,cat) -> [earliest, latest, rowcount, tx total, rx total]
+        self.combos = {(mac, self.apps[app], self.cats[cat]): [tmin, tmax, count, tx, rx]
+                       for mac, app, cat, tmin, tmax, count, tx, rx
+                       in self.conn.execute("SELECT mac, app, cat, min_ts, max_ts, count, tx, rx FROM combos")}
+        self.uniquemacs = sorted({k[0] for k in self.combos})
+        self.uniqueapps = sorted({k[1] for k in self.combos})
+        self.uniquecats = sorted({k[2] for k in self.combos})
+        if len(self.combos) > 0 :
+            self.mindate = min(v[0] for v in self.combos.values())
+            self.maxdate = max(v[1] for v in self.combos.values())
+        else :
+            self.mindate = None
+            self.maxdate = None
+        self.numrows = sum(v[2] for v in self.combos.values())
+
+    def _fmtRows(self, rows):
+        apps = self.apps
+        cats = self.cats
+        return [{'ts': ts, 'mac': mac, 'app': apps[app], 'cat': cats[cat], 'tx': tx, 'rx': rx, 'rowid': rowid}
+                for rowid, ts, mac, app, cat, tx, rx in rows]
+
+    def iterMetricsAfter(self, minTimestamp, chunkSize=10000, afterRowid=None, mac=None):
+        """As TrafficAnalyzerExtractor.iterMetricsAfter, but an index range
+           scan. Optionally for just one device."""
+        cur = self._queryAfter(minTimestamp, afterRowid, mac)
+        while True:
+            rows = cur.fetchmany(chunkSize)
+            if len(rows) < 1 :
+                break
+            yield self._fmtRows(rows)
+
+    def iterColumnsAfter(self, minTimestamp, chunkSize=10000, afterRowid=None, mac=None):
+        """iterMetricsAfter as TrafficColumns chunks (sharing string tables)"""
+        cur = self._queryAfter(minTimestamp, afterRowid, mac)
+        apps = self.apps
+        cats = self.cats
+        tables = None
+        while True:
+            rows = cur.fetchmany(chunkSize)
+            if len(rows) < 1 :
+                break
+            chunk = TrafficColumns.fromRows([(ts, m, apps[a], cats[c], tx, rx, rowid)
+                                             for rowid, ts, m, a, c, tx, rx in rows], tables)
+            tables = chunk.tables
+            yield chunk
+
+    def _queryAfter(self, minTimestamp, afterRowid, mac):
+        afterRowid = afterRowid if afterRowid is not None else 2**63-1
+        #Written as a range on timestamp so the index can be used for it
+        where = "timestamp >= ? AND NOT (timestamp = ? AND id <= ?)"
+        params = [int(minTimestamp), int(minTimestamp), int(afterRowid)]
+        if mac is not None:
+            where = f"mac = ? AND {where}"
+            params.insert(0, mac)
+        return self.conn.execute(f"SELECT id, timestamp, mac, app, cat, tx, rx FROM traffic WHERE {where} "
+                                 "ORDER BY timestamp, id", params)
+
+    def getAllMetrics(self):
+        return [m for chunk in self.iterMetricsAfter(-1) for m in chunk]
+
+    def getAllMetricsAfter(self, minTimestamp):
+        return [m for chunk in self.iterMetricsAfter(minTimestamp) for m in chunk]
+
+    def getMetricsBetween(self, startTs, endTs, mac=None):
+        """Every record with startTs <= timestamp < endTs (for one device, optionally)"""
+        where = "timestamp >= ? AND timestamp < ?"
+        params = [int(startTs), int(endTs)]
+        if mac is not None:
+            where = f"mac = ? AND {where}"
+            params.insert(0, mac)
+        return self._fmtRows(self.conn.execute(f"SELECT id, timestamp, mac, app, cat, tx, rx FROM traffic "
+                                               f"WHERE {where} ORDER BY timestamp, id", params))
+
+    def fmtMetaData(self):
+        return { 'earliestData' : self.mindate,
+                 'latestData'   : self.maxdate,
+                 'uniqueMACs'   : self.uniquemacs,
+                 'uniqueApps'   : self.uniqueapps,
+                 'uniqueCats'   : self.uniquecats,
+                 'totalRows'    : self.numrows}
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    import time
+    from os.path import isfile
+    from sys import argv
+    if len(argv) >= 2:
+        mirror = TrafficMirror(argv[1])
+        for snap in argv[2:]:
+            if isfile(snap):
+                sT = time.perf_counter()
+                print(f"{snap}: {mirror.absorb(snap)} new rows in {time.perf_counter()-sT:.2f}s")
+        print(f"Mirror holds {mirror.numrows} rows from {len(mirror.uniquemacs)} devices, "
+              f"{len(mirror.uniqueapps)} apps, {len(mirror.uniquecats)} categories")
+        if mirror.mindate is not None:
+            print(f"{time.ctime(mirror.mindate)} - {time.ctime(mirror.maxdate)}")
+    else :
+        print("When called directly, supply the path to a mirror database, then any TrafficAnalyzer.db files to copy into it")
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+##############################################################################
+# TrafficReport.py
+# ----------------
+#
+# The router's "Traffic Statistics" page without Influx or Grafana: the top
+# N devices, apps or categories by tx, rx or both over any time range, and
+# per-item series over time.
+#
+# Answers come from hourly and daily totals per device/app/category, kept
+# in a small SQLite state file by TrafficRollup and brought up to date
+# incrementally (only rows past the last one counted are read). A range is
+# split into whole local days, read from the daily totals, plus the odd
+# hours at either end from the hourly ones, so even a year is only a few
+# hundred rows per item; heapq then picks the top N without sorting the
+# lot.
+#
+# Results can be returned as JSON in the shapes a Grafana JSON datasource
+# expects (a table for top N, time series for series).
+#
+# Usage:
+#    TrafficReport.py STATE update TRAFFICDB [TRAFFICDB...]
+#    TrafficReport.py STATE top [--dim app] [--by rx] [-n 10] [--from DATE] [--to DATE] [--json]
+#    TrafficReport.py STATE series --key KEY [--dim device] [--period daily] ... [--json]
+# (TRAFFICDB may be a TrafficMirror database as well as a TrafficAnalyzer.db)
+###############################################################################
+import heapq
+import json
+import os
+import time
+from TrafficRollup import TrafficRollup
+
+class TrafficReport(object):
+    """Top-N and time series queries over materialized hourly/daily traffic totals"""
+    periods = ('hourly', 'daily')
+    dims = ('device', 'app', 'cat')
+    metrics = ('tx', 'rx', 'total')
+
+    def __init__(self, statefile, macNameList=None):
+        """statefile holds the totals; macNameList turns device MACs into names"""
+        self.macNameList = macNameList if macNameList is not None else {}
+        self.rollup = TrafficRollup(statefile, "report", self.macNameList, TrafficReport.periods, TrafficReport.dims)
+        self.conn = self.rollup.conn
+        #The rollup's key leads with the item; ranges over all items want time first
+        self.conn.execute("CREATE INDEX IF NOT EXISTS buckets_time ON buckets(period, dim, bucket)")
+        self.conn.commit()
+
+    def update(self, tdata, source, chunkSize=50000, commitEvery=10, byTimestamp=False):
+        """Count any rows of tdata (a TrafficAnalyzerExtractor or TrafficMirror)
+           past the last one counted from source. Returns the rows added.
+           byTimestamp is for sources whose rowids change from copy to copy:
+           the last second counted is read again, and only rows in it that
+           weren't counted last time are taken (see TrafficRollup.trackEdge)."""
+        mark = self.rollup.getHighWater(source)
+        startTs, startRowid = mark if mark is not None else (0, -1)
+        if byTimestamp:
+            if self.rollup.trackEdge(source):
+                startRowid = -1
+            elif mark is not None:
+                #(no edge stored yet: only later seconds)
+                startRowid = None
+        rows = 0
+        chunks = 0
+        last = None
+        #(summed as columns, never turned into a dict per row)
+        for chunk in tdata.iterColumnsAfter(startTs, chunkSize, startRowid):
+            self.rollup.absorb(chunk)
+            rows += len(chunk)
+            chunks += 1
+            last = (chunk[-1]['ts'], chunk[-1]['rowid'])
+            #A big backfill would otherwise hold every hour in memory
+            if chunks % commitEvery == 0:
+                self.rollup.commit(self.rollup.takeTotals(), source, *last, self.rollup.takeEdge())
+        if last is not None:
+            self.rollup.commit(self.rollup.takeTotals(), source, *last, self.rollup.takeEdge())
+        return rows
+
+    @staticmethod
+    def _nextMidnight(ts):
+        t = time.localtime(ts)
+        return int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1)))
+
+    def _ranges(self, start, end):
+        """Split [start,end) into (period, lo, hi) pieces: whole days from the
+           daily totals, the hours either side from the hourly ones"""
+        start = start - start % 3600
+        firstDay = self.rollup._buckets(start)['daily']
+        if firstDay != start:
+            firstDay = self._nextMidnight(start)
+        lastDay = self.rollup._buckets(end)['daily']
+        if firstDay >= lastDay:
+            return [('hourly', start, end)]
+        ranges = [('daily', firstDay, lastDay)]
+        if start < firstDay:
+            ranges.append(('hourly', start, firstDay))
+        if lastDay < end:
+            ranges.append(('hourly', lastDay, end))
+        return ranges
+
+    def totals(self, dim, start, end):
+        """{key: (tx, rx)} summed over start <= time < end"""
+        totals = {}
+        with self.rollup._lock:
+            for period, lo, hi in self._ranges(start, end):
+                for key, tx, rx in self.conn.execute("SELECT key, SUM(tx), SUM(rx) FROM buckets WHERE period=? "
+                                                     "AND dim=? AND bucket>=? AND bucket<? GROUP BY key",
+                                                     (period, dim, lo, hi)):
+                    t = totals.get(key)
+                    totals[key] = (tx, rx) if t is None else (t[0] + tx, t[1] + rx)
+        return totals
+
+    def _label(self, dim, key):
+        return self.macNameList.get(key, key) if dim == 'device' else key
+
+    @staticmethod
+    def _value(by, tx, rx):
+        return tx if by == 'tx' else rx if by == 'rx' else tx + rx
+
+    def top(self, dim, start, end, n=10, by='total'):
+        """The n biggest items by tx, rx or total, biggest first, as dicts"""
+        best = heapq.nlargest(n, self.totals(dim, start, end).items(),
+                              key=lambda kv: self._value(by, kv[1][0], kv[1][1]))
+        return [{'key': key, 'name': self._label(dim, key), 'tx': tx, 'rx': rx, 'total': tx + rx}
+                for key, (tx, rx) in best]
+
+    def series(self, dim, key, start, end, period='daily', by='total'):
+        """[(bucket start, value)] for one item, hourly or daily"""
+        with self.rollup._lock:
+            rows = self.conn.execute("SELECT bucket, tx, rx FROM buckets WHERE period=? AND dim=? AND key=? "
+                                     "AND bucket>=? AND bucket<? ORDER BY bucket", (period, dim, key, start, end)).fetchall()
+        return [(bucket, self._value(by, tx, rx)) for bucket, tx, rx in rows]
+
+    @staticmethod
+    def grafanaTable(top, dim):
+        """top() in the table shape a Grafana JSON datasource wants"""
+        return [{'type': 'table',
+                 'columns': [{'text': dim, 'type': 'string'}, {'text': 'key', 'type': 'string'},
+                             {'text': 'tx', 'type': 'number'}, {'text': 'rx', 'type': 'number'},
+                             {'text': 'total', 'type': 'number'}],
+                 'rows': [[r['name'], r['key'], r['tx'], r['rx'], r['total']] for r in top]}]
+
+    @staticmethod
+    def grafanaSeries(target, series):
+        """series() as a Grafana JSON datasource time series (milliseconds)"""
+        return [{'target': target, 'datapoints': [[value, bucket * 1000] for bucket, value in series]}]
+
+def _parseTime(text):
+    """YYYY-MM-DD[ HH:MM] (local time) or seconds since the epoch"""
+    if text.isdigit():
+        return int(text)
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(time.strptime(text, fmt)))
+        except ValueError:
+            pass
+    raise ValueError(f"Can't make sense of time '{text}'")
+
+if __name__ == "__main__":
+    import argparse
+    import sqlite3
+    parser = argparse.ArgumentParser(description="Router-style traffic statistics from materialized totals")
+    parser.add_argument("state", help="report state file (created if need be)")
+    parser.add_argument("--names", help="device registry to take device names from")
+    sub = parser.add_subparsers(dest="command", required=True)
+    up = sub.add_parser("update", help="count any new rows from traffic databases")
+    up.add_argument("trafficdb", nargs="+")
+    for name in ("top", "series"):
+        p = sub.add_parser(name)
+        p.add_argument("--dim", choices=TrafficReport.dims, default="device")
+        p.add_argument("--by", choices=TrafficReport.metrics, default="total")
+        p.add_argument("--from", dest="start", default=None, help="start (default: 30 days before --to)")
+        p.add_argument("--to", dest="end", default=None, help="end (default: now)")
+        p.add_argument("--json", action="store_true", help="Grafana JSON datasource output")
+        if name == "top":
+            p.add_argument("-n", type=int, default=10)
+        else :
+            p.add_argument("--key", required=True, help="MAC, app or category")
+            p.add_argument("--period", choices=TrafficReport.periods, default="daily")
+    args = parser.parse_args()
+
+    names = {}
+    if args.names is not None:
+        from DeviceRegistry import DeviceRegistry
+        names = DeviceRegistry(args.names).getNameMap()
+    report = TrafficReport(args.state, names)
+
+    if args.command == "update":
+        for dbfile in args.trafficdb:
+            sT = time.perf_counter()
+            #A mirror or the router's own database?
+            conn = sqlite3.connect(f"file:{dbfile}?mode=ro", uri=True)
+            isMirror = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='combos'").fetchone()[0] > 0
+            conn.close()
+            if isMirror:
+                from TrafficMirror import TrafficMirror
+                tdata = TrafficMirror(dbfile)
+                source = f"mirror:{os.path.realpath(dbfile)}"
+            else :
+                from read_traffic_database import TrafficAnalyzerExtractor
+                tdata = TrafficAnalyzerExtractor(dbfile)
+                source = os.path.realpath(dbfile)
+            print(f"{dbfile}: {report.update(tdata, source)} new rows counted in {time.perf_counter()-sT:.2f}s")
+    else :
+        end = _parseTime(args.end) if args.end is not None else int(time.time())
+        start = _parseTime(args.start) if args.start is not None else end - 30*86400
+        sT = time.perf_counter()
+        if args.command == "top":
+            result = report.top(args.dim, start, end, args.n, args.by)
+            if args.json:
+                print(json.dumps(TrafficReport.grafanaTable(result, args.dim)))
+            else :
+                print(f"Top {args.n} {args.dim} by {args.by}, {time.ctime(start)} - {time.ctime(end)}")
+                for r in result:
+                    print(f"{r['name'][:32]:32} {r['tx']:>16} {r['rx']:>16} {r['total']:>16}")
+        else :
+            result = report.series(args.dim, args.key, start, end, args.period, args.by)
+            if args.json:
+                print(json.dumps(TrafficReport.grafanaSeries(report._label(args.dim, args.key), result)))
+            else :
+                for bucket, value in result:
+                    print(f"{time.ctime(bucket)}\t{value}")
+        if not args.json:
+            print(f"({(time.perf_counter()-sT)*1000:.1f} ms)")
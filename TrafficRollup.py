@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+##############################################################################
+# TrafficRollup.py
+# ----------------
+#
+# Dashboards covering months of traffic don't need hourly points per
+# device/app/category; they need totals. Rather than have Grafana (and
+# Influx) sum millions of raw points on every refresh, this rolls the
+# traffic up as it streams past into daily and monthly sums:
+#    per device    (tags: mac, name)
+#    per app       (tags: app)
+#    per category  (tags: cat)
+# each period/dimension pair going to its own measurement, named
+# <prefix>_<period>_<dimension>, e.g. traffic_daily_device.
+#
+# A day (or month) fills up over many runs, so the running totals are kept
+# in a small local SQLite state file. Each run adds the new hours to the
+# totals for the buckets they touch, and rewrites just those bucket points
+# (Influx replaces a point with the same series and timestamp).
+#
+# The state file also records how far through each source it has got. It's
+# only committed once the rollup points have been written, so if a write
+# fails the same rows are rolled up again next time, never twice. The rows
+# handed to absorb() can go back further than that (the ingest's own start
+# point is per sink, and can be rewound), so absorb() is given the mark and
+# skips anything at or before it.
+#
+# A source whose rowids change from copy to copy (e.g. successive archives)
+# can't be marked by rowid, and a later copy can hold more rows for the
+# marked second than the last one did. For those, trackEdge() keeps the
+# (mac, app, cat) of every row counted in the last second too, and rows of
+# that second are only counted if they aren't among them.
+#
+# Buckets start at local midnight / the first of the month, local time, to
+# match the router's own Traffic Statistics page. An 'hourly' period is
+# there too (TrafficReport uses it), though it's rarely worth sending.
+###############################################################################
+import sqlite3
+import threading
+import time
+from LineProtocol import escapeMeasurement, escapeTag
+from TrafficColumns import TrafficColumns
+
+class TrafficRollup(object):
+    """Incrementally maintained daily/monthly traffic sums per device, app and category"""
+    periods = ('daily', 'monthly')
+    dims = ('device', 'app', 'cat')
+
+    def __init__(self, statefile, prefix, macNameList, periods=None, dims=None, extraTags=None):
+        """statefile is the SQLite state database, prefix the measurement name prefix"""
+        self.prefix = prefix
+        self.macNameList = macNameList
+        self.extraTags = extraTags if extraTags is not None else {}
+        self.periods = tuple(periods) if periods is not None else TrafficRollup.periods
+        self.dims = tuple(dims) if dims is not None else TrafficRollup.dims
+        #Commits happen on the writer's thread once the points are acknowledged
+        self.conn = sqlite3.connect(statefile, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets(period TEXT, dim TEXT, key TEXT, "
+                          "bucket INTEGER, tx INTEGER, rx INTEGER, "
+                          "PRIMARY KEY(period, dim, key, bucket))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS highwater(source TEXT PRIMARY KEY, "
+                          "timestamp INTEGER, lastrowid INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS edge(source TEXT, timestamp INTEGER, mac TEXT, app TEXT, "
+                          "cat TEXT, PRIMARY KEY(source, mac, app, cat))")
+        self.conn.commit()
+        #(period, dim, key, bucket) -> [tx, rx] for rows absorbed this run
+        self.delta = {}
+        self._bucketCache = {}
+        #(timestamp, {(mac,app,cat)}) counted in the last second, if tracked
+        self.edge = None
+
+    def __del__(self):
+        self.conn.close()
+
+    def getHighWater(self, source):
+        """(timestamp,rowid) of the last row rolled up from source, or None"""
+        with self._lock:
+            r = self.conn.execute("SELECT timestamp, lastrowid FROM highwater WHERE source=?", (source,)).fetchone()
+        return None if r is None else (r[0], r[1])
+
+    def trackEdge(self, source):
+        """Keep track of the rows counted in the last second (see above),
+           starting from what was stored for source. Returns False if
+           nothing was (e.g. state from before edges were kept)."""
+        with self._lock:
+            rows = self.conn.execute("SELECT timestamp, mac, app, cat FROM edge WHERE source=?", (source,)).fetchall()
+        self.edge = (rows[0][0], {r[1:] for r in rows}) if len(rows) > 0 else (None, set())
+        return len(rows) > 0
+
+    def takeEdge(self):
+        """A copy of the tracked edge, to commit(), or None"""
+        return None if self.edge is None else (self.edge[0], set(self.edge[1]))
+
+    def _buckets(self, ts):
+        """Start of the hour, local day and month containing ts (cached, rows share hours)"""
+        b = self._bucketCache.get(ts)
+        if b is None:
+            t = time.localtime(ts)
+            day = int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1)))
+            month = int(time.mktime((t.tm_year, t.tm_mon, 1, 0, 0, 0, 0, 0, -1)))
+            b = {'hourly': ts - ts % 3600, 'daily': day, 'monthly': month}
+            self._bucketCache[ts] = b
+        return b
+
+    @staticmethod
+    def _firstAfter(metrics, after):
+        """Index of the first record past the (timestamp,rowid) mark after
+           (records are in (timestamp,rowid) order)"""
+        n = len(metrics)
+        if after is None or n < 1:
+            return 0
+        last = metrics[-1]
+        if (last['ts'], last['rowid']) <= after:
+            return n
+        first = metrics[0]
+        if (first['ts'], first['rowid']) > after:
+            return 0
+        if isinstance(metrics, TrafficColumns):
+            pairs = zip(metrics.cols['ts'], metrics.cols['rowid'])
+        else :
+            pairs = ((m['ts'], m['rowid']) for m in metrics)
+        return next((i for i, p in enumerate(pairs) if p > after), n)
+
+    def absorb(self, metrics, after=None):
+        """Add a chunk of traffic records (dicts or a TrafficColumns, in
+           (timestamp,rowid) order) into this run's totals, skipping any at or
+           before the (timestamp,rowid) mark after - see getHighWater()"""
+        start = self._firstAfter(metrics, after)
+        if start >= len(metrics):
+            return
+        if self.edge is not None:
+            start = self._absorbEdge(metrics, start)
+            if start >= len(metrics):
+                return
+        if isinstance(metrics, TrafficColumns):
+            self._absorbColumns(metrics.since(start) if start > 0 else metrics)
+        else :
+            self._absorbRecords(metrics[start:] if start > 0 else metrics)
+        if self.edge is not None:
+            #(the rows after the old edge's second are all newer than it)
+            lastTs = metrics[-1]['ts']
+            keys = set()
+            for i in range(len(metrics) - 1, start - 1, -1):
+                m = metrics[i]
+                if m['ts'] != lastTs:
+                    break
+                keys.add((m['mac'], m['app'], m['cat']))
+            self.edge = (lastTs, keys)
+
+    def _absorbEdge(self, metrics, start):
+        """Count the rows from start on in the edge's second that haven't
+           been already; returns the index of the first row after it"""
+        edgeTs, keys = self.edge
+        fresh = []
+        i = start
+        while i < len(metrics) and metrics[i]['ts'] == edgeTs:
+            m = metrics[i]
+            key = (m['mac'], m['app'], m['cat'])
+            if key not in keys:
+                keys.add(key)
+                fresh.append(m)
+            i += 1
+        self._absorbRecords(fresh)
+        return i
+
+    def _absorbRecords(self, metrics):
+        delta = self.delta
+        for m in metrics:
+            buckets = self._buckets(m['ts'])
+            keys = {'device': m['mac'], 'app': m['app'], 'cat': m['cat']}
+            for period in self.periods:
+                for dim in self.dims:
+                    k = (period, dim, keys[dim], buckets[period])
+                    d = delta.get(k)
+                    if d is None:
+                        delta[k] = [m['tx'], m['rx']]
+                    else :
+                        d[0] += m['tx']
+                        d[1] += m['rx']
+
+    def _absorbColumns(self, cols):
+        """Summed per (timestamp, item) on the columns - records share a
+           handful of timestamps - so only those totals are bucketed here"""
+        delta = self.delta
+        for dim in self.dims:
+            for (ts, key), (tx, rx) in cols.sumBy(('ts', dim)).items():
+                buckets = self._buckets(ts)
+                for period in self.periods:
+                    k = (period, dim, key, buckets[period])
+                    d = delta.get(k)
+                    if d is None:
+                        delta[k] = [tx, rx]
+                    else :
+                        d[0] += tx
+                        d[1] += rx
+
+    def _totals(self):
+        """New running totals for every bucket touched this run"""
+        totals = {}
+        with self._lock:
+            for k, (tx, rx) in self.delta.items():
+                r = self.conn.execute("SELECT tx, rx FROM buckets WHERE period=? AND dim=? AND key=? AND bucket=?", k).fetchone()
+                totals[k] = (tx + r[0], rx + r[1]) if r is not None else (tx, rx)
+        return totals
+
+    def _tags(self, dim, key):
+        tags = dict(self.extraTags)
+        if dim == 'device':
+            tags.update({'mac': key, 'name': self.macNameList.get(key, key)})
+        else :
+            tags[dim] = key
+        return "".join(f",{escapeTag(k)}={escapeTag(tags[k])}" for k in sorted(tags))
+
+    def takeTotals(self):
+        """New running totals for the buckets touched since the last call, to
+           commit(); the rows absorbed so far are done with either way"""
+        totals = self._totals()
+        self.delta = {}
+        return totals
+
+    def encode(self):
+        """Line-protocol for the touched buckets, plus the totals to commit once written"""
+        #Whatever happens to the write, these rows are done with; if it
+        #fails they'll be re-read from the (uncommitted) high-water mark.
+        totals = self.takeTotals()
+        lines = []
+        for (period, dim, key, bucket), (tx, rx) in totals.items():
+            lines.append(f"{escapeMeasurement(f'{self.prefix}_{period}_{dim}')}{self._tags(dim, key)} "
+                         f"tx={tx},rx={rx} {bucket}\n")
+        return "".join(lines).encode(), totals
+
+    def commit(self, totals, source, timestamp, rowid, edge=None):
+        """Store the new totals and high-water mark (and edge, from
+           takeEdge(), if tracked). Call only after the points from encode()
+           have been written successfully."""
+        with self._lock:
+            self.conn.executemany("INSERT INTO buckets(period, dim, key, bucket, tx, rx) VALUES (?,?,?,?,?,?) "
+                                  "ON CONFLICT(period, dim, key, bucket) DO UPDATE SET tx=excluded.tx, rx=excluded.rx",
+                                  [k + v for k,v in totals.items()])
+            self.conn.execute("INSERT OR REPLACE INTO highwater(source, timestamp, lastrowid) VALUES (?,?,?)",
+                              (source, int(timestamp), int(rowid)))
+            if edge is not None and edge[0] is not None:
+                self.conn.execute("DELETE FROM edge WHERE source=?", (source,))
+                self.conn.executemany("INSERT INTO edge(source, timestamp, mac, app, cat) VALUES (?,?,?,?,?)",
+                                      [(source, edge[0]) + k for k in edge[1]])
+            self.conn.commit()
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from os.path import isfile
+    from sys import argv
+    if len(argv) == 2 and isfile(argv[1]):
+        conn = sqlite3.connect(argv[1])
+        for period, dim, buckets, tx, rx in conn.execute(
+                "SELECT period, dim, COUNT(*), SUM(tx), SUM(rx) FROM buckets GROUP BY period, dim"):
+            print(f"{period:8} {dim:8} {buckets:8} buckets, tx={tx} rx={rx}")
+        for source, ts, rowid in conn.execute("SELECT source, timestamp, lastrowid FROM highwater"):
+            print(f"{source} rolled up to {time.ctime(ts)} (rowid {rowid})")
+        conn.close()
+    else :
+        print("When called directly, supply the path to a rollup state file on the command line")
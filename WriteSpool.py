@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+##############################################################################
+# WriteSpool.py
+# -------------
+#
+# A write-ahead spool for the batches InfluxBatchWriter sends. If Influx
+# goes away part way through a big backlog, everything not yet acknowledged
+# would otherwise be lost and the next run would have to extract it all
+# again. Instead each batch is written to a segment file (and fsync'd)
+# before it's sent, and the segment is deleted once Influx has acknowledged
+# it. Whatever is left in the spool directory at the next start is sent
+# again, oldest first, before anything new.
+#
+# Because a spooled batch will get to Influx sooner or later, the writer can
+# treat it as stored: checkpoints move on once the data is in the spool, so
+# a run after an outage replays the spool rather than re-extracting. Writing
+# the same point to Influx twice just overwrites it, so a batch that was
+# sent but whose segment didn't get deleted does no harm.
+#
+# Segments are named seg-<number>.lp, numbered in the order written:
+#    - the spool is capped at maxBytes; a batch that won't fit isn't spooled
+#      (the writer then waits for Influx to acknowledge it, as without one)
+#    - compact() merges runs of small segments (e.g. from a series of
+#      hourly top-ups while Influx was down) into batch-sized ones
+#    - a batch Influx refuses outright (a 4xx: the data itself is bad) is
+#      renamed rejected-<number>.lp, out of the way of the replay but kept
+#      for a look
+###############################################################################
+import os
+import re
+import threading
+
+class WriteSpool(object):
+    """Directory of fsync'd line-protocol segments awaiting acknowledgement"""
+    segmentName = re.compile(r"^seg-(\d+)\.lp$")
+    rejectedName = re.compile(r"^rejected-(\d+)\.lp$")
+
+    def __init__(self, spoolDir, maxBytes=256*1048576):
+        """Open (creating if need be) the spool directory"""
+        self.spoolDir = spoolDir
+        self.maxBytes = maxBytes
+        #(segments are appended by the producer, acknowledged by send threads)
+        self._lock = threading.Lock()
+        os.makedirs(spoolDir, exist_ok=True)
+        #segment number -> size, for the segments on disk
+        self._sizes = {}
+        #(rejected segments keep their numbers, so those aren't handed out
+        #again either - a later reject() would overwrite them)
+        used = [-1]
+        for name in os.listdir(spoolDir):
+            m = WriteSpool.segmentName.match(name)
+            r = WriteSpool.rejectedName.match(name)
+            if m is not None:
+                self._sizes[int(m.group(1))] = os.path.getsize(os.path.join(spoolDir, name))
+                used.append(int(m.group(1)))
+            elif r is not None:
+                used.append(int(r.group(1)))
+            elif name.endswith(".tmp"):
+                #Never got renamed into place, so never counted as spooled
+                os.remove(os.path.join(spoolDir, name))
+        self._next = max(used) + 1
+
+    def _path(self, segId):
+        return os.path.join(self.spoolDir, f"seg-{segId:012d}.lp")
+
+    def _syncDir(self):
+        """Make renames/deletes in the spool directory durable too"""
+        fd = os.open(self.spoolDir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _writeSegment(self, segId, body):
+        tmpfile = self._path(segId) + ".tmp"
+        with open(tmpfile, "wb") as sf:
+            sf.write(body)
+            sf.flush()
+            os.fsync(sf.fileno())
+        os.replace(tmpfile, self._path(segId))
+        self._syncDir()
+        with self._lock:
+            self._sizes[segId] = len(body)
+
+    @property
+    def size(self):
+        """Bytes currently spooled"""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def segments(self):
+        """The unacknowledged segment numbers, oldest first"""
+        with self._lock:
+            return sorted(self._sizes)
+
+    def append(self, body):
+        """Durably store a batch; returns its segment number, or None if it
+           would take the spool over its size cap"""
+        with self._lock:
+            if sum(self._sizes.values()) + len(body) > self.maxBytes:
+                return None
+            segId = self._next
+            self._next += 1
+            #(reserve the space while it's being written)
+            self._sizes[segId] = len(body)
+        self._writeSegment(segId, body)
+        return segId
+
+    def read(self, segId):
+        with open(self._path(segId), "rb") as sf:
+            return sf.read()
+
+    def ack(self, segId):
+        """The batch has been acknowledged; forget it"""
+        with self._lock:
+            known = self._sizes.pop(segId, None) is not None
+        if known:
+            os.remove(self._path(segId))
+
+    def reject(self, segId):
+        """Influx won't take the batch; set it aside rather than replay it"""
+        with self._lock:
+            known = self._sizes.pop(segId, None) is not None
+        if known:
+            os.replace(self._path(segId), os.path.join(self.spoolDir, f"rejected-{segId:012d}.lp"))
+
+    def compact(self, batchBytes):
+        """Merge consecutive segments smaller than batchBytes into ones of up
+           to batchBytes. Returns the number of segments removed."""
+        removed = 0
+        group = []
+        groupBytes = 0
+        for segId in self.segments() + [None]:
+            size = self._sizes.get(segId, batchBytes) if segId is not None else batchBytes
+            if segId is not None and size < batchBytes and groupBytes + size <= batchBytes:
+                group.append(segId)
+                groupBytes += size
+                continue
+            if len(group) > 1:
+                #The merged data replaces the first segment of the group, so
+                #it keeps its place in the order; if we stop before the rest
+                #are deleted they're only sent twice
+                body = b"".join(self.read(s) for s in group)
+                self._writeSegment(group[0], body)
+                for s in group[1:]:
+                    self.ack(s)
+                removed += len(group) - 1
+            group = [segId] if segId is not None and size < batchBytes else []
+            groupBytes = size if len(group) > 0 else 0
+        if removed > 0:
+            self._syncDir()
+        return removed
+
+if __name__ == "__main__":
+    print("This is a TEST PROGRAM")
+    print("(you probably don't want to be here)")
+    from sys import argv
+    if len(argv) == 2 and os.path.isdir(argv[1]):
+        spool = WriteSpool(argv[1])
+        segs = spool.segments()
+        print(f"{len(segs)} unacknowledged segments, {spool.size} bytes")
+        for segId in segs:
+            lines = spool.read(segId).count(b"\n")
+            print(f"  {segId:8d} {spool._sizes[segId]:10d} bytes, {lines} lines")
+    else :
+        print("When called directly, supply the path to a write spool directory on the command line")
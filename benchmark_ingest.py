@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+##############################################################################
+# benchmark_ingest.py
+# -------------------
+#
+# End-to-end throughput benchmark for the ingest, run against synthetic data
+# (SyntheticRouterData) and a local Influx stand-in (FakeInfluxServer), so it
+# needs neither a router nor an Influx server.
+#
+# Each stage runs in its own freshly forked process, so the peak RSS
+# reported is that stage's own and not a high-water mark left by an earlier
+# one. Every state file the ingest keeps (checkpoint, registry, caches,
+# spool...) is pointed at an empty directory of the stage's own under DIR,
+# so nothing is picked up from an earlier run or left in the current
+# directory. Stages:
+#    metadata  - TrafficAnalyzerExtractor metadata load (no sidecar cache)
+#    names     - parsing and reconciling the name sources
+#    extract   - streaming every traffic row out of the database
+#    encode    - line-protocol encoding of every row (encoding time only)
+#    write     - the full traffic update through the writer to the stand-in
+#    rstats    - loading the RStats file and formatting its counters
+#
+# Usage:
+#    benchmark_ingest.py [--rows N] [--dir DIR] [--json results.json]
+# Fixtures are generated in DIR (a temporary directory by default) unless a
+# TrafficAnalyzer.db is already there. Save the --json output from a known
+# good version and compare against it to catch regressions.
+###############################################################################
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from io import StringIO
+
+from FakeInfluxServer import FakeInfluxServer
+from SyntheticRouterData import SyntheticRouterData
+import read_traffic_database as rtd
+
+def _stageMetadata(workdir):
+    tdata = rtd.TrafficAnalyzerExtractor(rtd.opt['trafDataDB'], False)
+    return tdata.numrows
+
+def _stageNames(workdir):
+    return len(rtd.loadMacNameList())
+
+def _stageExtract(workdir):
+    tdata = rtd.TrafficAnalyzerExtractor(rtd.opt['trafDataDB'], False)
+    rows = 0
+    for chunk in tdata.iterMetricsAfter(0, rtd.opt['chunkSize'], -1):
+        rows += len(chunk)
+    return rows
+
+def _stageEncode(workdir):
+    """Returns (rows, seconds) - only the encoding itself is timed"""
+    tdata = rtd.TrafficAnalyzerExtractor(rtd.opt['trafDataDB'], False)
+    encoder = rtd.TrafficEncoder(rtd.opt['inMeasurement'], rtd.loadMacNameList())
+    rows = 0
+    elapsed = 0.0
+    for chunk in tdata.iterMetricsAfter(0, rtd.opt['chunkSize'], -1):
+        sT = time.perf_counter()
+        encoder.encode(chunk)
+        elapsed += time.perf_counter() - sT
+        rows += len(chunk)
+    return rows, elapsed
+
+def _stageWrite(workdir):
+    dbconn = rtd.setupInfluxConnection()
+    writer = rtd.setupInfluxWriter()
+    rtd.updateInfluxTrafficHistory(rtd.opt['trafDataDB'], dbconn, writer)
+    writer.close()
+    return writer.summary()['lines']
+
+def _stageRStats(workdir):
+    rStats = rtd.TomatoData(rtd.opt['rstatsfile'])
+    return len(rStats.getDaily()) + len(rStats.getMonthly())
+
+stages = [('metadata', _stageMetadata),
+          ('names',    _stageNames),
+          ('extract',  _stageExtract),
+          ('encode',   _stageEncode),
+          ('write',    _stageWrite),
+          ('rstats',   _stageRStats)]
+
+def _stateOptions(statedir):
+    """Every option naming state the ingest keeps between runs, pointed at
+       statedir (or turned off)"""
+    return {'checkpointFile'  : os.path.join(statedir, "ingest_checkpoint.json"),
+            'deviceRegistry'  : os.path.join(statedir, "device_registry.db"),
+            'ntCenterCache'   : os.path.join(statedir, "nt_center_cache.json"),
+            'writerSpoolDir'  : os.path.join(statedir, "write_spool"),
+            'rstatsStateFile' : os.path.join(statedir, "rstats_state.json"),
+            'seriesSchemaFile': os.path.join(statedir, "series_schema.json"),
+            'rollupStateFile' : os.path.join(statedir, "traffic_rollup.db"),
+            'archiveLedger'   : os.path.join(statedir, "archive_ledger.json"),
+            'profileFile'     : os.path.join(statedir, "ingest.pstats"),
+            'trafficMirror'   : None,
+            'reportStateFile' : None,
+            #(the metadata sidecar would sit beside the fixtures, and carry over)
+            'trafMetaCache'   : False}
+
+def _runStage(fn, workdir, options):
+    """Child process: run one stage quietly, from no saved state, and measure it"""
+    statedir = tempfile.mkdtemp(dir=workdir, prefix="state-")
+    rtd.opt.update(options)
+    rtd.opt.update(_stateOptions(statedir))
+    try:
+        with redirect_stdout(StringIO()):
+            sT = time.perf_counter()
+            result = fn(workdir)
+            elapsed = time.perf_counter() - sT
+    finally:
+        shutil.rmtree(statedir, ignore_errors=True)
+    if isinstance(result, tuple):
+        result, elapsed = result
+    #ru_maxrss is in KiB on Linux
+    return elapsed, result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runBenchmark(workdir, numRows):
+    """Generate fixtures if needed, then run each stage; returns the results"""
+    files = SyntheticRouterData(workdir, numRows)
+    if os.path.exists(files.trafficFile):
+        print(f"Using existing fixtures in {workdir}")
+        options = {'trafDataDB': files.trafficFile, 'ntDBFile': files.ntCenterFile,
+                   'clientJSONfile': files.clientListFile, 'rstatsfile': files.rstatsFile}
+    else :
+        print(f"Generating {numRows} traffic rows of fixtures in {workdir}")
+        sT = time.perf_counter()
+        options = files.generate()
+        print(f"(took {time.perf_counter()-sT:.1f}s)")
+    server = FakeInfluxServer().start()
+    options.update({'inHost': server.host, 'inPort': server.port})
+    results = {}
+    try:
+        forking = multiprocessing.get_context("fork")
+        print(f"{'stage':10} {'seconds':>10} {'rows':>12} {'rows/sec':>12} {'peak RSS MB':>12}")
+        for name, fn in stages:
+            with ProcessPoolExecutor(max_workers=1, mp_context=forking) as pool:
+                elapsed, rows, maxrss = pool.submit(_runStage, fn, workdir, options).result()
+            results[name] = {'seconds': elapsed, 'rows': rows,
+                             'rowsPerSec': rows / elapsed if elapsed > 0 else 0,
+                             'peakRSSMB': maxrss / 1024}
+            print(f"{name:10} {elapsed:10.3f} {rows:12d} {results[name]['rowsPerSec']:12.0f} {maxrss/1024:12.1f}")
+    finally:
+        server.stop()
+    print(f"Stand-in received {server.points} points in {server.requests} writes ({server.bytesReceived} bytes)")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the traffic ingest against synthetic data")
+    parser.add_argument("--rows", type=int, default=1000000, help="traffic rows to generate")
+    parser.add_argument("--dir", help="where to keep the fixtures (default: a temporary directory)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    if args.dir is not None:
+        results = runBenchmark(args.dir, args.rows)
+    else :
+        with tempfile.TemporaryDirectory() as workdir:
+            results = runBenchmark(workdir, args.rows)
+    if args.json is not None:
+        with open(args.json, "w") as jf:
+            json.dump({'rows': args.rows, 'stages': results}, jf, indent=1)
@@ -13,16 +13,38 @@
 #
 # Or something like that, anyway.
 ##############################################################################
-import sqlite3
 import time
-from os.path import isfile
+from os.path import isfile, isdir
 import os
-from sys import argv
+import glob
+import argparse
 import json
+import sys
 from influxdb import InfluxDBClient
 from CustClientListParser import CustClientListParser
 from NtCenterMacParser import NtCenterMacParser
 from RStatsDataExtract import TomatoData
+from RStatsState import RStatsState
+from IngestCheckpoint import IngestCheckpoint
+from InfluxBatchWriter import InfluxBatchWriter, InfluxWriteError
+from WriteSpool import WriteSpool
+from LineProtocol import TrafficEncoder, escapeTag
+from SeriesSchema import SeriesSchema
+from TrafficColumns import TrafficColumns
+from TrafficRollup import TrafficRollup
+from DeviceRegistry import DeviceRegistry
+from OutputSinks import StdoutSink, LineProtocolFileSink, ColumnarSink, LockedSink
+from SnapshotArchive import SnapshotArchive, ArchiveLedger
+from IngestStats import IngestStats
+from TrafficMirror import TrafficMirror
+from TrafficReport import TrafficReport
+from RouterDB import routerDB
+import cProfile
+import pstats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ParallelIngest import (initWorker, encodeSnapshotWindow, snapshotWindows,
+                            listSnapshots, listTrafficSnapshots, routerForSnapshot, boundedMap,
+                            backfillWindows, encodeBackfillWindow)
 
 #################################################################################
 # USER-MODIFIABLE PARAMETERS:
@@ -36,14 +58,88 @@ opt = {
     'inPassword'    : 'admin_password',
     'inDatabase'    : 'routerdata',
     'inMeasurement' : 'traffic',
+    'chunkSize'     : 10000,
+    'trafMetaCache' : True,
+    'checkpointFile': 'ingest_checkpoint.json',
+    'writerThreads' : 4,
+    'writerQueue'   : 8,
+    'writerBatchKB' : 1024,
+    'writerGzip'    : True,
+    'writerRetries' : 5,
+    #Batches are kept here until Influx has them, and re-sent at the next
+    #start if it didn't (None: no spool); it stops growing at writerSpoolMB
+    'writerSpoolDir': 'write_spool',
+    'writerSpoolMB' : 256,
+    'watchInterval' : 10,
+    'watchSettle'   : 5,
+    'sink'          : 'influx',
+    'sinkPath'      : 'export',
+    'sinkRotateMB'  : 64,
+    'sinkRotateMinutes': 60,
+    'routerTag'     : None,
+    'routerMap'     : {},
+    'snapshotPattern': '*.db',
+    'snapshotWorkers': 0,
+    'snapshotWindow': 100000,
+    #--backfill: rows per window (whole hours) and worker processes (0:
+    #one per CPU)
+    'backfillWindow': 250000,
+    'backfillWorkers': 0,
+    'rollups'       : False,
+    'rollupPrefix'  : 'traffic',
+    'rollupPeriods' : ['daily', 'monthly'],
+    'rollupDims'    : ['device', 'app', 'cat'],
+    'rollupStateFile': 'traffic_rollup.db',
+    #Router databases are opened read-only through RouterDB.py: how much of
+    #each file is memory-mapped and the SQLite page cache beyond it. Files
+    #modified in the last routerDBLiveSeconds are read with locking, or if
+    #routerDBCopy is set copied first (backup API) to "memory" or a
+    #directory such as /dev/shm
+    'routerDBMmapMB': 1024,
+    'routerDBCacheMB': 64,
+    'routerDBCopy'  : None,
+    'routerDBLiveSeconds': 60,
     'ntDBFile'      : 'sampledata/nt_center.db',
+    'ntCenterCache' : 'nt_center_cache.json',
+    'deviceRegistry': 'device_registry.db',
+    'stableNames'   : False,
     'clientJSONfile': 'sampledata/custom_clientlist',
     'trafDataDB'    : 'sampledata/TrafficAnalyzer.db',
     'rstatsDailyM'  : 'rstatsDaily',
     'rstatsMonthM'  : 'rstatsMonthly',
-    'rstatsfile'    : 'sampledata/tomato_rstats_blahblah.gz'
+    'rstatsfile'    : 'sampledata/tomato_rstats_blahblah.gz',
+    #Local indexed, append-only copy of the traffic data (TrafficMirror.py)
+    #that outlives the router's pruning; None to read the snapshots directly
+    'trafficMirror' : None,
+    #Hourly/daily totals kept up to date for TrafficReport.py; None: don't
+    'reportStateFile': None,
+    #'upsert' writes only the RStats rows that are new or changed since the
+    #last run (all of them, first time); 'top3' always rewrites the 3 newest
+    'rstatsMode'    : 'upsert',
+    'rstatsStateFile': 'rstats_state.json',
+    #Backup archives (--archives): which files in a directory are archives,
+    #where to spool their databases (None = /dev/shm if possible) and the
+    #record of those already ingested
+    'archivePattern': '*.tar*',
+    'archiveSpoolDir': None,
+    'archiveLedger' : 'archive_ledger.json',
+    #Per-stage timings of each run go to this measurement (None: don't);
+    #--profile also prints them and saves cProfile output to profileFile
+    'statsMeasurement': 'ingest_stats',
+    'profileFile'   : 'ingest.pstats',
+    #How traffic records map onto Influx series (see SeriesSchema.py): the
+    #device name as a 'tag', a 'field' or 'drop'ped; app/cat tags as short
+    #codes; apps with less than this fraction of all the traffic folded
+    #into "other". The schema file keeps the codes and the apps kept.
+    'seriesNameMode': 'tag',
+    'seriesDictionary': False,
+    'seriesFoldBelow': 0.0,
+    'seriesSchemaFile': 'series_schema.json'
 }
 
+#Stage timings/counts for this run (see IngestStats.py)
+stats = IngestStats()
+
 #################################################################################
 class TrafficAnalyzerExtractor(object):
     """Extractor for data from the Traffic Analyzer db passed as a file name"""
@@ -51,7 +147,10 @@ class TrafficAnalyzerExtractor(object):
     #used for queries later...
     traffic_fields = "timestamp,mac,app_name,cat_name,tx,rx"
 
-    def __init__(self,trafficdbfile):
+    #Bump this if the layout of the metadata sidecar cache changes
+    metacache_version = 2
+
+    def __init__(self,trafficdbfile,useMetaCache=False):
         """Load and actually do the parsing of the SQLLite database"""
         self.uniquemacs = []
         self.uniqueapps = []
@@ -59,36 +158,97 @@ class TrafficAnalyzerExtractor(object):
         self.mindate = -1
         self.maxdate = 1
         self.numrows = 0
+        #(mac,app,cat) -> [earliest, latest, rowcount, tx total, rx total]
+        self.combos = {}
         self.dbfile = trafficdbfile
+        self.metacachefile = trafficdbfile + ".meta.json" if useMetaCache else None
         #We want this to cause program oopsies if it fails:
-        self.conn = sqlite3.connect(self.dbfile)
+        #(read-only and shared with anything else reading the file this run)
+        self.conn = routerDB.connect(self.dbfile)
         #Load the unique identifiers from the table
         self._loadMetadata()
 
-    def __del__(self):
-        """Need a destructor to ensure database is closed properly"""
-        self.conn.close()
-
     def _loadMetadata(self):
         """Populate the uniquemacs, apps, cats lists with data from the DB"""
         #We don't wrap these in try/except because we want them to die if
         #they fail.
-        macCur = self.conn.execute("SELECT DISTINCT(mac) FROM traffic")
-        for m in macCur:
-            self.uniquemacs.append(m[0])
-        appCur = self.conn.execute("SELECT DISTINCT(app_name) FROM traffic")
-        for a in appCur:
-            self.uniqueapps.append(a[0])
-        catCur = self.conn.execute("SELECT DISTINCT(cat_name) FROM traffic")
-        for c in catCur:
-            self.uniquecats.append(c[0])
-        tsCur = self.conn.execute("SELECT MIN(timestamp), MAX(timestamp) FROM traffic")
-        for t in tsCur:
-            self.mindate = t[0]
-            self.maxdate = t[1]
-        rcCur = self.conn.execute("SELECT COUNT(*) FROM traffic")
-        for r in rcCur:
-            self.numrows = r[0]
+        #MIN/MAX(rowid) come straight off the table b-tree so are cheap, and
+        #tell us whether a cached scan is still a valid prefix of the table.
+        minrowid, maxrowid = self.conn.execute("SELECT MIN(rowid), MAX(rowid) FROM traffic").fetchone()
+        minrowid = minrowid or 0
+        maxrowid = maxrowid or 0
+        st = os.stat(self.dbfile)
+        cache = self._readMetaCache()
+        if (cache is not None and cache['minrowid'] == minrowid and
+            cache['maxrowid'] <= maxrowid) :
+            for c in cache['combos']:
+                self.combos[(c[0],c[1],c[2])] = c[3:]
+            if (cache['size'] == st.st_size and cache['mtime'] == st.st_mtime and
+                cache['maxrowid'] == maxrowid) :
+                self._summariseCombos()
+                return
+            self._scanCombos(cache['maxrowid'])
+        else :
+            self._scanCombos(0)
+        self._summariseCombos()
+        self._writeMetaCache({
+            'version'  : self.metacache_version,
+            'size'     : st.st_size,
+            'mtime'    : st.st_mtime,
+            'minrowid' : minrowid,
+            'maxrowid' : maxrowid,
+            'combos'   : [list(k) + v for k,v in self.combos.items()]
+        })
+
+    def _scanCombos(self, afterRowid):
+        """One aggregate pass over rows past afterRowid, merged into self.combos"""
+        cur = self.conn.execute("SELECT mac, app_name, cat_name, MIN(timestamp), MAX(timestamp), COUNT(*), "
+                                "SUM(tx), SUM(rx) "
+                                f"FROM traffic WHERE rowid > {int(afterRowid)} GROUP BY mac, app_name, cat_name")
+        for mac,app,cat,tmin,tmax,count,tx,rx in cur:
+            known = self.combos.get((mac,app,cat))
+            if known is None:
+                self.combos[(mac,app,cat)] = [tmin, tmax, count, tx, rx]
+            else :
+                known[0] = min(known[0], tmin)
+                known[1] = max(known[1], tmax)
+                known[2] += count
+                known[3] += tx
+                known[4] += rx
+
+    def _summariseCombos(self):
+        """Derive the unique lists, date range and row count from self.combos"""
+        self.uniquemacs = sorted({k[0] for k in self.combos})
+        self.uniqueapps = sorted({k[1] for k in self.combos})
+        self.uniquecats = sorted({k[2] for k in self.combos})
+        if len(self.combos) > 0 :
+            self.mindate = min(v[0] for v in self.combos.values())
+            self.maxdate = max(v[1] for v in self.combos.values())
+        else :
+            self.mindate = None
+            self.maxdate = None
+        self.numrows = sum(v[2] for v in self.combos.values())
+
+    def _readMetaCache(self):
+        """Returns the sidecar metadata cache if there is a usable one, else None"""
+        if self.metacachefile is None or not isfile(self.metacachefile):
+            return None
+        cache = loadParseJSONFile(self.metacachefile)
+        if cache is None or cache.get('version') != self.metacache_version:
+            return None
+        return cache
+
+    def _writeMetaCache(self, cache):
+        """Atomically replace the sidecar metadata cache. Failure isn't fatal."""
+        if self.metacachefile is None:
+            return
+        try:
+            tmpfile = self.metacachefile + ".tmp"
+            with open(tmpfile, "w") as cf:
+                json.dump(cache, cf)
+            os.replace(tmpfile, self.metacachefile)
+        except OSError as e:
+            print(f"WARN Could not write metadata cache {self.metacachefile}, {e}")
 
     def getAllMetrics(self):
         """This is the simplest retrieval - just all data"""
@@ -98,6 +258,42 @@ class TrafficAnalyzerExtractor(object):
         """Simple filter - get all records AFTER a given timestamp"""
         return self._fmtQRes(self.conn.execute(f"SELECT {self.traffic_fields} FROM TRAFFIC WHERE timestamp > {int(minTimestamp)}"))
 
+    def iterMetricsAfter(self,minTimestamp,chunkSize=10000,afterRowid=None):
+        """Streaming version of getAllMetricsAfter - yields lists of at most
+           chunkSize records so the whole result set is never held in memory.
+           If afterRowid is given, records AT minTimestamp with a larger rowid
+           are included too, so nothing sharing the last second is lost.
+           Records are yielded in (timestamp,rowid) order and carry a 'rowid'."""
+        cur = self._queryAfter(minTimestamp, afterRowid)
+        while True:
+            rows = cur.fetchmany(chunkSize)
+            if len(rows) < 1 :
+                break
+            chunk = self._fmtQRes(rows)
+            for m,r in zip(chunk, rows):
+                m['rowid'] = r[6]
+            yield chunk
+
+    def iterColumnsAfter(self,minTimestamp,chunkSize=10000,afterRowid=None):
+        """iterMetricsAfter, but each chunk is a TrafficColumns (all sharing
+           one set of string tables) rather than a list of dicts"""
+        cur = self._queryAfter(minTimestamp, afterRowid)
+        tables = None
+        while True:
+            rows = cur.fetchmany(chunkSize)
+            if len(rows) < 1 :
+                break
+            chunk = TrafficColumns.fromRows(rows, tables)
+            tables = chunk.tables
+            yield chunk
+
+    def _queryAfter(self, minTimestamp, afterRowid):
+        if afterRowid is None:
+            where = f"timestamp > {int(minTimestamp)}"
+        else :
+            where = f"timestamp > {int(minTimestamp)} OR (timestamp = {int(minTimestamp)} AND rowid > {int(afterRowid)})"
+        return self.conn.execute(f"SELECT {self.traffic_fields},rowid FROM traffic WHERE {where} ORDER BY timestamp, rowid")
+
     def _fmtQRes(self, query_cursor) :
         """Bit of a reusable internal"""
         res = []
@@ -160,10 +356,79 @@ def setupInfluxConnection():
     client.grant_privilege("read",opt['inDatabase'],"q")
     return client
 
+#################################################################################
+def connectInflux():
+    """setupInfluxConnection(), unless Influx can't be reached and there's a
+       write spool to hold the data until it can (then None)"""
+    try:
+        return setupInfluxConnection()
+    except OSError as e:
+        if opt['writerSpoolDir'] is None:
+            raise
+        #Everything goes to the spool, to be sent once Influx is back
+        print(f"WARN Influx unreachable ({e}), spooling to {opt['writerSpoolDir']}")
+        return None
+
+#################################################################################
+def setupInfluxWriter(spool=None):
+    """Setup the (pipelined) writer used for all the data inserts, sending
+       anything left in the write spool by an earlier run first - unless
+       it's to share the spool of a writer that's already running"""
+    replay = spool is None
+    if spool is None and opt['writerSpoolDir'] is not None:
+        spool = WriteSpool(opt['writerSpoolDir'], opt['writerSpoolMB'] * 1048576)
+    writer = InfluxBatchWriter(host        = opt['inHost'],
+                               port        = opt['inPort'],
+                               database    = opt['inDatabase'],
+                               username    = opt['inUser'],
+                               password    = opt['inPassword'],
+                               precision   = 's',
+                               maxInFlight = opt['writerThreads'],
+                               queueDepth  = opt['writerQueue'],
+                               batchBytes  = opt['writerBatchKB'] * 1024,
+                               useGzip     = opt['writerGzip'],
+                               retries     = opt['writerRetries'],
+                               spool       = spool)
+    if replay:
+        writer.replaySpool()
+    return writer
+
+#################################################################################
+def setupOutputSink(stdout=None):
+    """Where the data goes: the 'sink' option picks influx (the default),
+       lpfile, stdout, parquet or arrow"""
+    sink = opt['sink']
+    if sink == 'influx':
+        return setupInfluxWriter()
+    if sink == 'lpfile':
+        return LineProtocolFileSink(opt['sinkPath'], opt['inDatabase'],
+                                    rotateBytes   = opt['sinkRotateMB'] * 1048576,
+                                    rotateSeconds = opt['sinkRotateMinutes'] * 60)
+    if sink == 'stdout':
+        return StdoutSink(stdout)
+    if sink in ('parquet', 'arrow'):
+        return ColumnarSink(opt['sinkPath'], sink)
+    raise ValueError(f"Unknown output sink '{sink}' (want influx, lpfile, stdout, parquet or arrow)")
+
+#################################################################################
+def checkpointKey(measurement):
+    """Checkpoints are per destination: exporting to files mustn't make a
+       later run think Influx already has the data"""
+    return measurement if opt['sink'] == 'influx' else f"{opt['sink']}:{measurement}"
+
+def rollupStateFile():
+    """The rollup state is per destination as well: its totals and high-water
+       marks say what that sink has been sent (Influx keeps the plain name)"""
+    if opt['sink'] == 'influx':
+        return opt['rollupStateFile']
+    base, ext = os.path.splitext(opt['rollupStateFile'])
+    return f"{base}.{opt['sink']}{ext}"
+
 #################################################################################
 def fluxEscapeString(inString) :
-    #Influx doesn't want quotes used. Instead, use backslashes:
-    return inString.replace(" ", "\ ")
+    #Influx doesn't want quotes used. Instead, use backslashes (and not
+    #just for spaces; commas and equals signs break tag values too):
+    return escapeTag(inString)
 
 #################################################################################
 def fmtTrafficDataPoint(metric, macNameList):
@@ -204,117 +469,910 @@ def reconcileMacNameLists(masterList,auxList) :
     return masterList
 
 #################################################################################
-def getLatestRecordForMeasurement(measurement, dbconn):
-    """Helper function since we seem to do this a lot...."""
-    tq=dbconn.query(f"select * from {measurement} ORDER BY time desc limit 1", epoch="s")
-    if len(list(tq.get_points())) > 0 :
-        latestInfluxData = int(list(tq.get_points())[0]['time'])
+def getLatestRecordForMeasurement(measurement, dbconn, tags=None):
+    """Helper function since we seem to do this a lot....
+       (tags optionally restricts it to one series, e.g. {'router':'x'})"""
+    where = ""
+    if tags:
+        where = " WHERE " + " AND ".join(f"\"{k}\"='{v}'" for k,v in tags.items())
+    tq=dbconn.query(f"select * from {measurement}{where} ORDER BY time desc limit 1", epoch="s")
+    points = list(tq.get_points())
+    if len(points) > 0 :
+        latestInfluxData = int(points[0]['time'])
     else :
         latestInfluxData = 0
     return latestInfluxData
 
 #################################################################################
-def updateInfluxTrafficHistory(trafficDataFile, dbconn) :
-    """Wrapper for the whole process of updating the TrafficHistory measurement"""
-    tdata=TrafficAnalyzerExtractor(trafficDataFile)
-    macNameList = reconcileMacNameLists(
-                    CustClientListParser(opt['clientJSONfile']).getMappings(),
-                    NtCenterMacParser(opt['ntDBFile']).getMappings())
+def getTrafficStartPoint(measurement, source, checkpoint, dbconn, reconcile=False, tags=None):
+    """Work out the (timestamp,rowid) to resume the traffic stream from.
+       Normally this is just the local checkpoint; Influx is only asked when
+       there isn't one yet, or when reconcile is requested."""
+    mark = checkpoint.get(checkpointKey(measurement), source)
+    if mark is not None and not reconcile:
+        print(f"Checkpoint:         {fmtTimeStamp(mark[0])} (rowid {mark[1]})")
+        return mark
+    if dbconn is None:
+        #Not writing to Influx, so there's nothing to ask
+        if mark is None:
+            print(f"Checkpoint:         none, starting from the beginning")
+            return 0, -1
+        print(f"Checkpoint:         {fmtTimeStamp(mark[0])} (rowid {mark[1]}), no Influx to reconcile against")
+        return mark
+    latestInfluxData = getLatestRecordForMeasurement(measurement, dbconn, tags)
+    print(f"Influx latest:      {fmtTimeStamp(latestInfluxData)}")
+    #rowid -1 means "everything AT this second too" - rewriting points Influx
+    #already holds is harmless, it simply overwrites them.
+    if mark is None:
+        return latestInfluxData, -1
+    #Other sources may feed the same measurement, so Influx being AHEAD of
+    #us is fine. Being BEHIND means it lost data, so rewind to match.
+    if latestInfluxData < mark[0]:
+        print(f"Reconcile:          checkpoint {fmtTimeStamp(mark[0])} is ahead of Influx, rewinding")
+        return latestInfluxData, -1
+    print(f"Reconcile:          checkpoint {fmtTimeStamp(mark[0])} (rowid {mark[1]}) is consistent")
+    return mark
+
+#################################################################################
+def loadMacNameList(clientList=None, ntDBFile=None, readOnly=False):
+    """MAC->friendly name map from all the name sources we know about. With a
+       device registry configured the sources update it and the names come
+       back from there. clientList (file or contents) and ntDBFile override
+       the configured files (an overridden nt_center isn't cached); False
+       leaves that source out altogether. readOnly looks the registry up
+       without recording anything in it."""
+    custNames = {}
+    if clientList is not False:
+        with stats.stage("names:custom_clientlist") as st:
+            custNames = CustClientListParser(clientList if clientList is not None else opt['clientJSONfile']).getMappings()
+            st['count'] = len(custNames)
+    ntNames = {}
+    ntIPs = {}
+    if ntDBFile is not False:
+        with stats.stage("names:nt_center") as st:
+            if ntDBFile is None:
+                ntCenter = NtCenterMacParser(opt['ntDBFile'], opt['ntCenterCache'])
+            else :
+                ntCenter = NtCenterMacParser(ntDBFile)
+            ntNames = ntCenter.getMappings()
+            ntIPs = ntCenter.getIPMappings()
+            st['count'] = len(ntNames)
+    if opt['deviceRegistry'] is None:
+        return reconcileMacNameLists(custNames, ntNames)
+    if readOnly:
+        #What the registry would give once updated: its names, with the
+        #sources' current ones over them (stable names are its alone)
+        names = DeviceRegistry(opt['deviceRegistry']).getNameMap(opt['stableNames']) if isfile(opt['deviceRegistry']) else {}
+        if not opt['stableNames']:
+            names.update(reconcileMacNameLists(custNames, ntNames))
+        return names
+    with stats.stage("names:registry") as st:
+        registry = DeviceRegistry(opt['deviceRegistry'])
+        #custom_clientlist takes priority, as in reconcileMacNameLists
+        renamed = registry.updateNames([('custom_clientlist', custNames), ('nt_center', ntNames)])
+        registry.updateIPs(ntIPs)
+        st['count'] = renamed
+    if renamed > 0:
+        print(f"Device Registry:    {renamed} new or changed device names")
+    return registry.getNameMap(opt['stableNames'])
+
+#################################################################################
+def recordDevicesSeen(tdata):
+    """Widen the registry's first/last seen times from the traffic metadata"""
+    if opt['deviceRegistry'] is not None:
+        DeviceRegistry(opt['deviceRegistry']).updateSeen(tdata.combos)
+
+#################################################################################
+def loadSeriesSchema(folding=True):
+    """The configured SeriesSchema; folding=False leaves out the folding"""
+    return SeriesSchema(opt['seriesNameMode'], opt['seriesDictionary'],
+                        opt['seriesFoldBelow'] if folding else 0.0, opt['seriesSchemaFile'])
+
+#################################################################################
+def seriesReport(trafficDataFile, macNameList=None):
+    """Print the series the traffic measurement gets from trafficDataFile
+       with the configured schema against the default one. Nothing is sent,
+       and the device registry is only read, not updated."""
+    tdata = TrafficAnalyzerExtractor(trafficDataFile, opt['trafMetaCache'])
+    if macNameList is None:
+        macNameList = loadMacNameList(readOnly=True)
+    extra = routerTags(opt['routerTag'])
+    baseSeries, baseBytes = SeriesSchema().project(tdata.combos, macNameList, extra)
+    schema = loadSeriesSchema()
+    schema.plan(tdata.combos, save=False)
+    series, keyBytes = schema.project(tdata.combos, macNameList, extra)
+    print(f"Traffic Data file:  {trafficDataFile}, {tdata.numrows} records, {len(tdata.combos)} (mac, app, cat) combinations")
+    print(f"Default schema:     {baseSeries} series, {baseBytes} bytes of series keys")
+    print(f"Configured schema:  name as {schema.nameMode}, app/cat {'coded' if schema.dictionary else 'as-is'}, "
+          f"folding below {schema.foldBelow:.4%}")
+    print(f"                    {series} series ({series/max(baseSeries,1):.1%}), {keyBytes} bytes of series keys")
+    if schema.folding:
+        folded = [a for a in tdata.uniqueapps if schema.folds(a)]
+        print(f"                    {len(folded)} of {len(tdata.uniqueapps)} apps folded into '{SeriesSchema.otherApp}'")
+
+#################################################################################
+def routerTags(router):
+    """Extra tags identifying the router, if we've been given one"""
+    return {'router': router} if router else None
+
+#################################################################################
+def updateInfluxTrafficHistory(trafficDataFile, dbconn, writer, checkpoint=None, reconcile=False, macNameList=None, source=None,
+                               tdata=None) :
+    """Wrapper for the whole process of updating the TrafficHistory measurement.
+       checkpoint and macNameList are loaded afresh unless passed in. source
+       names the checkpoint for a transient copy of the database (e.g. out of
+       an archive). With a trafficMirror, trafficDataFile (or a list of them)
+       is copied into the mirror and the data read from there; otherwise
+       tdata may be its already loaded TrafficAnalyzerExtractor.
+       Returns False if the data couldn't be written."""
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint(opt['checkpointFile'])
+    transient = source is not None
+    if opt['trafficMirror'] is not None:
+        with stats.stage("mirror") as st:
+            tdata = TrafficMirror(opt['trafficMirror'])
+            for f in (trafficDataFile if isinstance(trafficDataFile, list) else [trafficDataFile]):
+                #(a transient copy is recorded under its stable source name,
+                #not its temporary path)
+                st['count'] += tdata.absorb(f, source if transient else None)
+        print(f"Traffic Mirror:     {st['count']} new rows copied to {opt['trafficMirror']}")
+        #The mirror's rowids are its own, and only go up
+        source = f"mirror:{os.path.realpath(opt['trafficMirror'])}"
+        transient = False
+    else :
+        if not transient:
+            source = os.path.realpath(trafficDataFile)
+        #(no point keeping a metadata sidecar for a file that's about to go)
+        if tdata is None:
+            with stats.stage("metadata") as st:
+                tdata=TrafficAnalyzerExtractor(trafficDataFile, opt['trafMetaCache'] and not transient)
+                st['count'] = tdata.numrows
+    if macNameList is None:
+        macNameList = loadMacNameList()
+    recordDevicesSeen(tdata)
     missingNames=0
     for m in tdata.uniquemacs:
         if m not in macNameList:
             missingNames += 1
 
     #Dump the metadata from the stats we've got
-    print(f"Traffic Data file:  {trafficDataFile}")
+    print(f"Traffic Data file:  {trafficDataFile if not isinstance(trafficDataFile, list) else f'{len(trafficDataFile)} snapshots'}")
     print(f"Friendly Names:     {len(tdata.uniquemacs)-missingNames} of {len(tdata.uniquemacs)} devices")
     print(f"Date Range:         {fmtTimeStamp(tdata.mindate)} - {fmtTimeStamp(tdata.maxdate)}")
     print(f"Traffic Analyzer:   {len(tdata.uniqueapps)} applications, {len(tdata.uniquecats)} categories")
     print(f"Total Records:      {tdata.numrows} traffic records")
 
-    #Get the "latest" timestamp from the db:
-    latestInfluxData = getLatestRecordForMeasurement(opt['inMeasurement'], dbconn)
+    schema = loadSeriesSchema()
+    schema.plan(tdata.combos)
 
-    print(f"Influx latest:      {fmtTimeStamp(latestInfluxData)}")
-    #Check how much Metric data we have after this:
-    metricDataNewerThanInflux = tdata.getAllMetricsAfter(int(latestInfluxData))
-    print(f"Records to add:     {len(metricDataNewerThanInflux)}")
+    #Where did we get up to last time?
+    startTs, startRowid = getTrafficStartPoint(opt['inMeasurement'], source, checkpoint, dbconn,
+                                               reconcile, routerTags(opt['routerTag']))
+    if transient:
+        #rowids mean nothing between different copies, so it's by timestamp alone
+        startRowid = -1
+    pendingTs = tdata.oldestAdded if isinstance(tdata, TrafficMirror) else None
+    if pendingTs is not None and pendingTs < startTs:
+        print(f"Traffic Mirror:     older rows copied in, resuming from {fmtTimeStamp(pendingTs)}")
+        startTs, startRowid = pendingTs, -1
+    if schema.folding:
+        #A folded point sums every row in its second, so a second is never
+        #started part way through. (Only the points are re-written: the
+        #rollup skips the re-read rows by its own mark, which keeps the true
+        #rowid.)
+        startRowid = -1
+
+    #Daily/monthly rollups are maintained as the rows stream past. If the
+    #last rollup didn't get committed, go back to where it got to: rewriting
+    #the raw points in between is harmless, missing rows from a sum isn't.
+    #Going the other way (a lost checkpoint, a rewind to match Influx, a
+    #different sink) the rollup skips rows up to its mark itself.
+    rollup = None
+    rollupMark = None
+    if opt['rollups']:
+        rollup = TrafficRollup(rollupStateFile(), opt['rollupPrefix'], macNameList,
+                               opt['rollupPeriods'], opt['rollupDims'], routerTags(opt['routerTag']))
+        rollupMark = rollup.getHighWater(source)
+        if transient:
+            #The next copy's rowids have nothing to do with the last one's:
+            #the marked second is read again whole, and the rows already
+            #counted in it are told apart by their (mac, app, cat)
+            if rollup.trackEdge(source):
+                rollupMark = (rollupMark[0], -1)
+            elif rollupMark is not None:
+                #(no edge stored yet: the whole of the marked second counts as done)
+                rollupMark = (rollupMark[0], 2**63-1)
+        if rollupMark is not None and rollupMark < (startTs, startRowid):
+            print(f"Rollups:            behind the checkpoint, resuming from {fmtTimeStamp(rollupMark[0])}")
+            startTs, startRowid = rollupMark
+
+    #Stream the new records through in bounded chunks: each chunk is
+    #formatted and queued on the writer before the next is read from the
+    #cursor, so memory use doesn't depend on how big the backlog is. The
+    #writer's own queue is bounded too, so a slow link holds us back here.
+    encoder = TrafficEncoder(opt['inMeasurement'], macNameList, routerTags(opt['routerTag']), schema)
+    #(a columnar sink is handed the points as columns, not text to parse)
+    columnar = getattr(writer, 'columnar', False)
+    totalRows = 0
+    chunkNum = 0
+    sT = time.perf_counter()
+    for chunk in stats.iterate("extract", tdata.iterMetricsAfter(startTs, opt['chunkSize'], startRowid)):
+        chunkNum += 1
+        with stats.stage("encode", len(chunk)):
+            points = encoder.encodeColumns(chunk) if columnar else encoder.encode(chunk)
+        with stats.stage("write", len(chunk)):
+            writer.writeColumns(points) if columnar else writer.write(points)
+        if rollup is not None:
+            with stats.stage("rollup", len(chunk)):
+                rollup.absorb(chunk, rollupMark)
+        #Only move the checkpoint on once the write has been acknowledged
+        writer.mark(lambda ts=chunk[-1]['ts'], rowid=chunk[-1]['rowid'] :
+                        checkpoint.update(checkpointKey(opt['inMeasurement']), source, ts, rowid))
+        lastTs, lastRowid = chunk[-1]['ts'], chunk[-1]['rowid']
+        totalRows += len(chunk)
+        elapsed = time.perf_counter() - sT
+        print(f"Chunk {chunkNum}:  queued {len(chunk)} rows (total {totalRows}, up to {fmtTimeStamp(chunk[-1]['ts'])}, {totalRows/elapsed:.0f} rows/second)")
+    #(the last second's folded points; if these don't make it, the restart
+    #from that second's timestamp writes them again)
+    points = encoder.finishColumns() if columnar else encoder.finish()
+    if len(points) > 0:
+        with stats.stage("write"):
+            writer.writeColumns(points) if columnar else writer.write(points)
+    if pendingTs is not None:
+        #Everything copied into the mirror has now been read from before it
+        writer.mark(lambda : tdata.clearPending(pendingTs))
+
+    #The report totals go from their own high-water mark, Influx or not
+    if opt['reportStateFile'] is not None:
+        with stats.stage("report") as st:
+            st['count'] = TrafficReport(opt['reportStateFile'], macNameList).update(tdata, source, byTimestamp=transient)
+        print(f"Report totals:      {st['count']} new rows counted")
 
     #Do we actually need to do anything?
-    if len(metricDataNewerThanInflux) < 1 :
+    if totalRows < 1 :
         print(f"No new Traffic data to add to Influx")
-        return
+        return True
 
-    #They really don't want you writing in JSON format these days, which is a shame
-    datapoints = []
-    for metric in metricDataNewerThanInflux :
-        datapoints.append(fmtTrafficDataPoint(metric, macNameList))
+    if rollup is not None:
+        rollupLines, rollupTotals = rollup.encode()
+        with stats.stage("write"):
+            writer.write(rollupLines)
+        #(never moving the mark backwards, if every row read was behind it)
+        if rollupMark is not None and rollupMark > (lastTs, lastRowid):
+            lastTs, lastRowid = rollupMark
+        edge = rollup.takeEdge()
+        writer.mark(lambda : rollup.commit(rollupTotals, source, lastTs, lastRowid, edge))
+        print(f"Rollups:            updating {len(rollupTotals)} daily/monthly totals")
 
-    #Here's where the insert goes
     try:
-        sT = time.perf_counter()
-        dbconn.write_points(datapoints, time_precision='s', batch_size=1000, protocol='line')
-        eT = time.perf_counter()
-        elapsed = eT - sT
-        rate = float(len(datapoints)) / elapsed
-        print(f"Wrote {len(datapoints)} rows to measurement {opt['inMeasurement']} in {elapsed} seconds ({rate} rows/second)")
-    except InfluxDBClientError as e:
+        with stats.stage("write"):
+            writer.flush()
+    except InfluxWriteError as e:
         print(f"ERROR writing datapoints to {opt['inMeasurement']}, error = {e}")
+        return False
 
-    return
+    elapsed = time.perf_counter() - sT
+    rate = float(totalRows) / elapsed
+    print(f"Wrote {totalRows} rows to measurement {opt['inMeasurement']} in {elapsed} seconds ({rate} rows/second)")
+
+    return True
 
 
 #################################################################################
-def updateRStatsMeasurement(tomatofile, dbconn) :
+def updateInfluxTrafficSnapshots(snapshotSpec, dbconn, writer, checkpoint=None, reconcile=False, macNameList=None) :
+    """Update the TrafficHistory measurement from a whole directory (or glob) of
+       TrafficAnalyzer.db snapshots, extracting and encoding them in parallel.
+       Returns False if the data couldn't be written."""
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint(opt['checkpointFile'])
+    snapshots = listTrafficSnapshots(snapshotSpec, opt['snapshotPattern'])
+    if len(snapshots) < 1 :
+        print(f"No Traffic Analyzer snapshots found matching {snapshotSpec}")
+        return True
+    #Names are parsed once here and handed to every worker
+    if macNameList is None:
+        macNameList = loadMacNameList()
+    if opt['trafficMirror'] is not None:
+        #The mirror does the de-duplicating; copy every snapshot into it,
+        #then ingest whatever's new there in one go
+        return updateInfluxTrafficHistory(snapshots, dbconn, writer, checkpoint, reconcile, macNameList)
+    schema = loadSeriesSchema(folding=False)
+    if opt['seriesFoldBelow'] > 0:
+        print(f"WARN Snapshots are de-duplicated row by row, so long-tail apps aren't folded (seriesFoldBelow ignored)")
+    if opt['rollups']:
+        #(rows come back out of time order from overlapping snapshots, and the
+        #last second is re-read each run, so running totals can't be kept)
+        print(f"WARN Rollups aren't kept from a snapshot directory without a trafficMirror (rollups ignored)")
+    if opt['reportStateFile'] is not None:
+        print(f"WARN Report totals aren't kept from a snapshot directory without a trafficMirror (reportStateFile ignored)")
+    if schema.dictionary:
+        #Codes are handed out here so every worker uses the same ones
+        with stats.stage("metadata"):
+            for snap in snapshots:
+                schema.plan(TrafficAnalyzerExtractor(snap, opt['trafMetaCache']).combos)
+    byRouter = {}
+    for snap in snapshots:
+        byRouter.setdefault(routerForSnapshot(snap, opt['routerMap'], opt['routerTag']), []).append(snap)
+    print(f"Snapshots:          {len(snapshots)} files from {len(byRouter)} router(s)")
+
+    workers = opt['snapshotWorkers'] if opt['snapshotWorkers'] > 0 else os.cpu_count()
+    columnar = getattr(writer, 'columnar', False)
+    totalRows = 0
+    sT = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                             initargs=(macNameList, opt['inMeasurement'], schema, routerDB.settings())) as pool:
+        for router in byRouter:
+            #Snapshots of the same router share a checkpoint; rowids mean
+            #nothing between different copies so it's by timestamp alone.
+            source = f"snapshots:{router or 'default'}"
+            print(f"Router:             {router or '(untagged)'}, {len(byRouter[router])} snapshots")
+            startTs, _ = getTrafficStartPoint(opt['inMeasurement'], source, checkpoint, dbconn,
+                                              reconcile, routerTags(router))
+            #Windows go out earliest first, whichever snapshot they're from, so
+            #once a window starting at T comes back no later one can hold a
+            #row from before T (windows wholly before the start are skipped)
+            windows = sorted((tsMin, snap, lo, hi) for snap in byRouter[router]
+                             for lo,hi,tsMin,tsMax in snapshotWindows(snap, opt['snapshotWindow']) if tsMax >= startTs)
+            tasks = [(snap, router, startTs, lo, hi, columnar) for tsMin,snap,lo,hi in windows]
+            #Snapshots overlap heavily, so only the first copy of each row is
+            #kept; keys are forgotten once they're older than every window left
+            seen = set()
+            floor = startTs
+            latest = startTs
+            rows = 0
+            dupes = 0
+            #(extraction and encoding both happen in the workers)
+            for taskNum, result in enumerate(stats.iterate("snapshot_windows",
+                                                           boundedMap(pool, encodeSnapshotWindow, tasks, 2*workers))):
+                if windows[taskNum][0] > floor:
+                    floor = windows[taskNum][0]
+                    seen = {k for k in seen if k[0] >= floor}
+                keys, points = result
+                fresh = []
+                for i, key in enumerate(keys):
+                    if key in seen:
+                        dupes += 1
+                        continue
+                    seen.add(key)
+                    fresh.append(i)
+                    if key[0] > latest:
+                        latest = key[0]
+                with stats.stage("write", len(fresh)):
+                    if columnar:
+                        writer.writeColumns(points.take(fresh))
+                    else :
+                        writer.write("".join(points[i] for i in fresh).encode())
+                rows += len(fresh)
+                elapsed = time.perf_counter() - sT
+                print(f"Window {taskNum+1}/{len(tasks)}:  queued {len(fresh)} rows, dropped {len(keys)-len(fresh)} duplicates "
+                      f"({(totalRows+rows)/elapsed:.0f} rows/second)")
+            #The windows overlap in time, so the checkpoint can only
+            #move once the whole of this router's data has been written.
+            writer.mark(lambda ts=latest, source=source :
+                            checkpoint.update(checkpointKey(opt['inMeasurement']), source, ts, -1))
+            print(f"Router {router or '(untagged)'}: {rows} new rows, {dupes} duplicates dropped")
+            totalRows += rows
+
+    if totalRows < 1 :
+        print(f"No new Traffic data to add to Influx")
+        return True
+
+    try:
+        with stats.stage("write"):
+            writer.flush()
+    except InfluxWriteError as e:
+        print(f"ERROR writing datapoints to {opt['inMeasurement']}, error = {e}")
+        return False
+
+    elapsed = time.perf_counter() - sT
+    rate = float(totalRows) / elapsed
+    print(f"Wrote {totalRows} rows to measurement {opt['inMeasurement']} in {elapsed} seconds ({rate} rows/second)")
+
+    return True
+
+#################################################################################
+def updateInfluxTrafficBackfill(trafficDataFile, dbconn, writer, checkpoint=None, reconcile=False, macNameList=None) :
+    """updateInfluxTrafficHistory for a big initial load: the rows to go are
+       cut into time windows, which a process pool reads (each worker over
+       its own read-only connection) and encodes in parallel. Windows are
+       written, and the checkpoint moved, in timestamp order, so an
+       interrupted backfill resumes from the first window not acknowledged.
+       Returns False if the data couldn't be written."""
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint(opt['checkpointFile'])
+    source = os.path.realpath(trafficDataFile)
+    with stats.stage("metadata") as st:
+        tdata=TrafficAnalyzerExtractor(trafficDataFile, opt['trafMetaCache'])
+        st['count'] = tdata.numrows
+    if macNameList is None:
+        macNameList = loadMacNameList()
+    recordDevicesSeen(tdata)
+
+    print(f"Traffic Data file:  {trafficDataFile}")
+    print(f"Date Range:         {fmtTimeStamp(tdata.mindate)} - {fmtTimeStamp(tdata.maxdate)}")
+    print(f"Total Records:      {tdata.numrows} traffic records")
+
+    schema = loadSeriesSchema()
+    schema.plan(tdata.combos)
+
+    startTs, startRowid = getTrafficStartPoint(opt['inMeasurement'], source, checkpoint, dbconn,
+                                               reconcile, routerTags(opt['routerTag']))
+    if schema.folding:
+        #(as on a normal run: the last second is re-read whole, and the
+        #rollup skips what it has already counted)
+        startRowid = -1
+    rollup = None
+    rollupMark = None
+    if opt['rollups']:
+        rollup = TrafficRollup(rollupStateFile(), opt['rollupPrefix'], macNameList,
+                               opt['rollupPeriods'], opt['rollupDims'], routerTags(opt['routerTag']))
+        rollupMark = rollup.getHighWater(source)
+        if rollupMark is not None and rollupMark < (startTs, startRowid):
+            print(f"Rollups:            behind the checkpoint, resuming from {fmtTimeStamp(rollupMark[0])}")
+            startTs, startRowid = rollupMark
+
+    with stats.stage("backfill_plan") as st:
+        windows = backfillWindows(trafficDataFile, startTs, startRowid, opt['backfillWindow'])
+        st['count'] = len(windows)
+    toGo = sum(w[4] for w in windows)
+    workers = opt['backfillWorkers'] if opt['backfillWorkers'] > 0 else os.cpu_count()
+    print(f"Backfill:           {toGo} rows in {len(windows)} windows, {workers} workers")
+
+    totalRows = 0
+    lastTs, lastRowid = startTs, startRowid
+    sT = time.perf_counter()
+    columnar = getattr(writer, 'columnar', False)
+    tasks = [(trafficDataFile, opt['routerTag'], startTs, startRowid, w, rollup is not None, columnar)
+             for w in windows]
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                             initargs=(macNameList, opt['inMeasurement'], schema, routerDB.settings())) as pool:
+        #(reading and encoding both happen in the workers; results come back
+        #in window order however the workers finish)
+        for taskNum, (lines, rows, ts, rowid, columns) in enumerate(
+                stats.iterate("backfill_windows", boundedMap(pool, encodeBackfillWindow, tasks, 2*workers))):
+            if rows < 1:
+                continue
+            with stats.stage("write", rows):
+                writer.writeColumns(lines) if columnar else writer.write(lines)
+            if columns is not None:
+                with stats.stage("rollup", rows):
+                    rollup.absorb(columns, rollupMark)
+            writer.mark(lambda ts=ts, rowid=rowid :
+                            checkpoint.update(checkpointKey(opt['inMeasurement']), source, ts, rowid))
+            lastTs, lastRowid = ts, rowid
+            totalRows += rows
+            elapsed = time.perf_counter() - sT
+            rate = totalRows / elapsed
+            print(f"Window {taskNum+1}/{len(windows)}:  queued {rows} rows (total {totalRows} of {toGo}, "
+                  f"up to {fmtTimeStamp(ts)}, {rate:.0f} rows/second, {(toGo-totalRows)/rate:.0f}s to go)")
+
+    if opt['reportStateFile'] is not None:
+        with stats.stage("report") as st:
+            st['count'] = TrafficReport(opt['reportStateFile'], macNameList).update(tdata, source)
+        print(f"Report totals:      {st['count']} new rows counted")
+
+    if totalRows < 1 :
+        print(f"No new Traffic data to add to Influx")
+        return True
+
+    if rollup is not None:
+        rollupLines, rollupTotals = rollup.encode()
+        with stats.stage("write"):
+            writer.write(rollupLines)
+        #(never moving the mark backwards, if every row read was behind it)
+        if rollupMark is not None and rollupMark > (lastTs, lastRowid):
+            lastTs, lastRowid = rollupMark
+        writer.mark(lambda : rollup.commit(rollupTotals, source, lastTs, lastRowid))
+        print(f"Rollups:            updating {len(rollupTotals)} daily/monthly totals")
+
+    try:
+        with stats.stage("write"):
+            writer.flush()
+    except InfluxWriteError as e:
+        print(f"ERROR writing datapoints to {opt['inMeasurement']}, error = {e}")
+        return False
+
+    elapsed = time.perf_counter() - sT
+    rate = float(totalRows) / elapsed
+    print(f"Wrote {totalRows} rows to measurement {opt['inMeasurement']} in {elapsed} seconds ({rate} rows/second)")
 
-    print(f"RStats(Tomato) File {tomatofile}")
-    rStats = TomatoData(tomatofile)
+    return True
+
+#################################################################################
+def updateRStatsMeasurement(tomatofile, writer, label=None) :
+    """Update the RStats measurements from a file (or its contents, in which
+       case label says where it came from). Returns False if the data
+       couldn't be written."""
+    print(f"RStats(Tomato) File {label if label is not None else tomatofile}")
+    try:
+        with stats.stage("rstats") as st:
+            rStats = TomatoData(tomatofile)
+            st['count'] = len(rStats.daily) + len(rStats.monthly)
+    except ValueError as e:
+        #(most likely caught part way through being copied in)
+        print(f"ERROR reading RStats data: {e}")
+        return False
     dMin,dMax = rStats.getDailyRange()
     mMin,mMax = rStats.getMonthlyRange()
     print(f"Tomato Daily range: {fmtTimeStamp(dMin)} - {fmtTimeStamp(dMax)}")
     print(f"Tomato Month range: {fmtTimeStamp(mMin)} - {fmtTimeStamp(mMax)}")
 
-    #Create an insert based on whether we've got new data to load:
-    #NB: There can be multi-insert issues where a "partial record" is stored
-    #    in influx that's been later updated on disk. So we actually need to
-    #    pretty much always put the few rows of each type of data in.
+    if opt['rstatsMode'] == 'upsert':
+        #Only what's new or has changed since the last successful write
+        state = RStatsState(opt['rstatsStateFile'])
+        dailyKey = checkpointKey(opt['rstatsDailyM'])
+        monthKey = checkpointKey(opt['rstatsMonthM'])
+        daily = state.changed(dailyKey, rStats.getDaily())
+        monthly = state.changed(monthKey, rStats.getMonthly())
+    else :
+        #Create an insert based on whether we've got new data to load:
+        #NB: There can be multi-insert issues where a "partial record" is stored
+        #    in influx that's been later updated on disk. So we actually need to
+        #    pretty much always put the few rows of each type of data in.
+        daily = sorted(rStats.getDaily(), key=lambda k: k['date'], reverse=True)[:3]
+        monthly = sorted(rStats.getMonthly(), key=lambda k: k['date'], reverse=True)[:3]
     newRows = []
-    for r in sorted(rStats.getDaily(), key=lambda k: k['date'], reverse=True)[:3]:
+    for r in daily:
         newRows.append(fmtRstatDataPoint(r, opt['rstatsDailyM']))
-    for r in sorted(rStats.getMonthly(), key=lambda k: k['date'], reverse=True)[:3]:
+    for r in monthly:
         newRows.append(fmtRstatDataPoint(r, opt['rstatsMonthM']))
     print(f"Rows to insert/update: {len(newRows)}")
     if len(newRows)>0 :
         try:
-            dbconn.write_points(newRows, time_precision='s', batch_size=1000, protocol='line')
-        except InfluxDBClientError as e:
+            with stats.stage("write", len(newRows)):
+                writer.write(newRows)
+                if opt['rstatsMode'] == 'upsert':
+                    def commit():
+                        state.update(dailyKey, daily)
+                        state.update(monthKey, monthly)
+                    writer.mark(commit)
+                writer.flush()
+        except InfluxWriteError as e:
             print(f"ERROR writing RStats datapoints: {e}")
+            return False
 
-    return
+    return True
+
+#################################################################################
+def updateFromArchives(archiveSpec, dbconn, writer, reconcile=False):
+    """Ingest everything from a router backup archive, or a directory/glob of
+       them, one archive at a time (oldest name first). Archives already
+       ingested, by content, are skipped."""
+    archives = listSnapshots(archiveSpec, opt['archivePattern'])
+    if len(archives) < 1 :
+        print(f"No archives found matching {archiveSpec}")
+        return
+    checkpoint = IngestCheckpoint(opt['checkpointFile'])
+    ledger = ArchiveLedger(opt['archiveLedger'])
+    #Successive backups are copies of the same databases, so share a checkpoint
+    source = f"archive:{opt['routerTag'] or 'default'}"
+    done = 0
+    skipped = 0
+    failed = 0
+    for archive in archives:
+        with stats.stage("archive_hash"):
+            digest = SnapshotArchive.sha256(archive)
+        if ledger.get(checkpointKey(digest)) is not None:
+            print(f"Archive:            {archive} already ingested, skipping")
+            skipped += 1
+            continue
+        print(f"Archive:            {archive}")
+        try:
+            with stats.stage("archive_unpack"):
+                arc = SnapshotArchive(archive, opt['archiveSpoolDir'])
+        except TypeError as e:
+            print(f"ERROR {e}")
+            failed += 1
+            continue
+        with arc:
+            ok = True
+            if arc.trafficDB is not None:
+                #Names from whichever sources the archive has, or if it has
+                #none, the ones configured
+                try:
+                    if arc.clientList is None and arc.ntCenterDB is None:
+                        macNameList = loadMacNameList()
+                    else :
+                        macNameList = loadMacNameList(arc.clientList if arc.clientList is not None else False,
+                                                      arc.ntCenterDB if arc.ntCenterDB is not None else False)
+                except (TypeError, ValueError) as e:
+                    #(left out of the ledger, so it's tried again next time)
+                    print(f"WARN Skipping {archive}, its name sources can't be read: {e}")
+                    failed += 1
+                    continue
+                ok = updateInfluxTrafficHistory(arc.trafficDB, dbconn, writer, checkpoint, reconcile,
+                                                macNameList, source)
+            else :
+                print(f"WARN No TrafficAnalyzer.db in {archive}")
+            if arc.rstats is not None:
+                ok = updateRStatsMeasurement(arc.rstats, writer, f"{archive}:{arc.rstatsName}") and ok
+        #Both of the above have flushed, so if all's well it's all been written
+        #(a dry run to stdout doesn't count)
+        if ok and opt['sink'] != 'stdout':
+            ledger.record(checkpointKey(digest), archive)
+            done += 1
+        elif not ok:
+            failed += 1
+    print(f"Archives:           {done} ingested, {skipped} skipped, {failed} failed")
+
+#################################################################################
+def orchestratedRun(tDataFile, snapshotSpec, writer, reconcile=False):
+    """--parallel: the normal run, but with the independent parts overlapped
+       on a thread pool. The Influx bootstrap, name sources and traffic
+       metadata load side by side; the traffic update starts as soon as all
+       three are ready, and RStats as soon as the Influx database is. Each task's errors
+       are its own. Returns the Influx connection (or None)."""
+    if opt['sink'] == 'influx':
+        #A failed batch fails the flush of the writer it went through, so
+        #RStats gets a writer of its own (sharing the spool) rather than be
+        #blamed for the traffic's batches, or vice versa
+        rstatsWriter = setupInfluxWriter(writer.spool)
+    else :
+        writer = LockedSink(writer)
+        rstatsWriter = writer
+    timings = {}
+    def task(name, fn, *args, **kwargs):
+        tS = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            print(f"ERROR in {name}: {e}")
+            timings[name] = (time.perf_counter() - tS, e)
+            raise
+        finally:
+            timings.setdefault(name, (time.perf_counter() - tS, None))
+
+    def loadMetadata():
+        with stats.stage("metadata") as st:
+            tdata = TrafficAnalyzerExtractor(tDataFile, opt['trafMetaCache'])
+            st['count'] = tdata.numrows
+        return tdata
+
+    def trafficTask(dbconnF, namesF, metaF):
+        tdata = metaF.result() if metaF is not None else None
+        dbconn = dbconnF.result() if dbconnF is not None else None
+        macNameList = namesF.result()
+        if snapshotSpec is not None:
+            return updateInfluxTrafficSnapshots(snapshotSpec, dbconn, writer, reconcile=reconcile, macNameList=macNameList)
+        return updateInfluxTrafficHistory(tDataFile, dbconn, writer, reconcile=reconcile, macNameList=macNameList, tdata=tdata)
+
+    def rstatsTask(dbconnF):
+        #Nothing's written until the database exists (a 404 isn't retried,
+        #so the batch would be spooled as rejected and the state moved on)
+        if dbconnF is not None:
+            dbconnF.result()
+        return updateRStatsMeasurement(opt['rstatsfile'], rstatsWriter)
+
+    sT = time.perf_counter()
+    #(one thread per task; they're waiting on I/O far more than computing)
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        dbconnF = pool.submit(task, "influx", connectInflux) if opt['sink'] == 'influx' else None
+        namesF = pool.submit(task, "names", loadMacNameList)
+        metaF = None
+        if snapshotSpec is None and opt['trafficMirror'] is None:
+            metaF = pool.submit(task, "metadata", loadMetadata)
+        tasks = {'traffic': pool.submit(task, "traffic", trafficTask, dbconnF, namesF, metaF),
+                 'rstats' : pool.submit(task, "rstats", rstatsTask, dbconnF)}
+        for name, f in tasks.items():
+            try:
+                if f.result() is False:
+                    timings[name] = (timings[name][0], "not written")
+            except Exception:
+                pass
+    if rstatsWriter is not writer:
+        try:
+            rstatsWriter.close()
+        except InfluxWriteError as e:
+            print(f"ERROR writing RStats data: {e}")
+    wall = time.perf_counter() - sT
+    print(f"Parallel run:       " + ", ".join(f"{name} {secs:.2f}s" + ("" if err is None else " (FAILED)")
+                                               for name, (secs, err) in timings.items()))
+    print(f"                    {wall:.2f}s wall clock against {sum(t[0] for t in timings.values()):.2f}s of tasks")
+    return dbconnF.result() if dbconnF is not None and dbconnF.exception() is None else None
+
+#################################################################################
+def emitIngestStats(writer):
+    """Send the stage timings so far to the statsMeasurement, then start afresh"""
+    if opt['statsMeasurement'] is not None and len(stats.stages) > 0:
+        try:
+            writer.write(stats.encode(opt['statsMeasurement'], routerTags(opt['routerTag'])))
+            writer.flush()
+        except InfluxWriteError as e:
+            print(f"ERROR writing ingest stats: {e}")
+    stats.reset()
+
+#################################################################################
+def finishRun(writer, dbconn, profiler=None):
+    """End of the run: report/send the stage timings and close everything down"""
+    if profiler is not None:
+        profiler.disable()
+        stats.report()
+        print(f"Router databases:   {routerDB.summary()}")
+        profiler.dump_stats(opt['profileFile'])
+        print(f"Profile saved to {opt['profileFile']}; the top of it:")
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(25)
+    emitIngestStats(writer)
+    writer.close()
+    if dbconn is not None:
+        dbconn.close()
+    routerDB.closeAll()
+
+#################################################################################
+def fileState(path):
+    """(mtime, size) of a file, or None if it isn't there (yet)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+#################################################################################
+def watchAndIngest(tDataFile, snapshotSpec, dbconn, writer, reconcile=False):
+    """Daemon mode: poll the staging files and ingest whatever has changed.
+       The Influx connection, writer, checkpoints and name maps stay warm
+       between passes; the name sources are only re-parsed when they change."""
+    checkpoint = IngestCheckpoint(opt['checkpointFile'])
+    macNameList = None
+    seen = {}
+    print(f"Watching for changes every {opt['watchInterval']}s (Ctrl-C to stop)")
+    while True:
+        #The traffic "file" may be a whole directory of snapshots
+        trafficFiles = listTrafficSnapshots(snapshotSpec, opt['snapshotPattern']) if snapshotSpec is not None else [tDataFile]
+        watched = {'traffic': trafficFiles,
+                   'names'  : [opt['clientJSONfile'], opt['ntDBFile']],
+                   'rstats' : [opt['rstatsfile']]}
+        #kind -> {path: state} of what's changed since it was last ingested
+        changed = {}
+        now = time.time()
+        for kind in watched:
+            for path in watched[kind]:
+                state = fileState(path)
+                #Leave anything touched very recently alone; it may still be
+                #being copied in.
+                if state is None or state == seen.get(path) or now - state[0] < opt['watchSettle']:
+                    continue
+                changed.setdefault(kind, {})[path] = state
+        done = set()
+        try:
+            if len(changed) > 0 and getattr(writer, 'spool', None) is not None:
+                #Anything a lost connection left behind goes first
+                writer.replaySpool()
+            if 'names' in changed or macNameList is None:
+                macNameList = loadMacNameList()
+                done.add('names')
+            if 'traffic' in changed:
+                sT = time.perf_counter()
+                if snapshotSpec is not None:
+                    ok = updateInfluxTrafficSnapshots(snapshotSpec, dbconn, writer, checkpoint, reconcile, macNameList)
+                else :
+                    ok = updateInfluxTrafficHistory(tDataFile, dbconn, writer, checkpoint, reconcile, macNameList)
+                print(f"Traffic pass took {time.perf_counter()-sT:.2f}s")
+                if ok is not False:
+                    done.add('traffic')
+                    #Only reconcile against Influx on the first pass
+                    reconcile = False
+            if 'rstats' in changed:
+                if updateRStatsMeasurement(opt['rstatsfile'], writer) is not False:
+                    done.add('rstats')
+            if len(changed) > 0:
+                emitIngestStats(writer)
+        except Exception as e:
+            #A bad file this time round is no reason to stop watching
+            print(f"ERROR during ingest pass: {e}")
+        #Files are only taken as seen once they've gone through; anything
+        #that failed is tried again next pass, changed or not
+        for kind in done:
+            seen.update(changed.get(kind, {}))
+        time.sleep(opt['watchInterval'])
 
 #################################################################################
 #################################################################################
 #################################################################################
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load ASUS router traffic data into Influx")
+    parser.add_argument("trafficdb", nargs="?",
+                        help="TrafficAnalyzer.db to load (default: trafDataDB option), or a "
+                             "directory/glob of snapshots to load in parallel")
+    parser.add_argument("--router", help="tag every traffic point with router=ROUTER")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="re-check the local ingest checkpoint against Influx before loading")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, ingesting the staging files whenever they change")
+    parser.add_argument("--archives", action="store_true",
+                        help="trafficdb is a router backup archive (tar/tar.gz), or a directory/glob of them")
+    parser.add_argument("--series-report", action="store_true",
+                        help="print the series count the series options give for trafficdb, and exit")
+    parser.add_argument("--backfill", action="store_true",
+                        help="load trafficdb in time windows across a pool of processes (for big initial loads)")
+    parser.add_argument("--parallel", action="store_true",
+                        help="load the sources and run the traffic/RStats updates concurrently")
+    parser.add_argument("--profile", action="store_true",
+                        help="print per-stage timings and save cProfile output (see profileFile)")
+    parser.add_argument("--sink", choices=["influx", "lpfile", "stdout", "parquet", "arrow"],
+                        help="where to send the data (overrides the sink option)")
+    args = parser.parse_args()
+    if args.parallel and (args.watch or args.archives):
+        parser.error("--parallel is for a single run, not --watch or --archives")
+    if args.backfill and (args.watch or args.archives or args.parallel):
+        parser.error("--backfill is for a single run, not --watch, --archives or --parallel")
+
     #Override options from pref file
     scriptPath = os.path.dirname(os.path.realpath(__file__))
     fqOptionsFile = scriptPath + "/" + optionsFile
+    #(anything not in the file keeps the default above)
+    fileOpt=loadParseJSONFile(fqOptionsFile)
+    if fileOpt is not None:
+        opt.update(fileOpt)
+    if args.sink is not None:
+        opt['sink'] = args.sink
+    routerDB.configure(opt['routerDBMmapMB'], opt['routerDBCacheMB'], opt['routerDBCopy'], opt['routerDBLiveSeconds'])
+
+    #When the data itself is going to stdout, the chatter goes to stderr
+    realStdout = sys.stdout.buffer
+    if opt['sink'] == 'stdout':
+        sys.stdout = sys.stderr
     print(f"fqOptionsFile {fqOptionsFile}")
-    opt=loadParseJSONFile(fqOptionsFile)
 
-    #Handle being passed a traffic database on the command line:
-    if len(argv) != 2 or not isfile(argv[1]):
+    if args.router is not None:
+        opt['routerTag'] = args.router
+
+    #Handle being passed a traffic database (or several) on the command line:
+    snapshotSpec = None
+    if args.trafficdb is not None and (isdir(args.trafficdb) or glob.has_magic(args.trafficdb)):
+        snapshotSpec = args.trafficdb
+    if args.trafficdb is None or not isfile(args.trafficdb):
         tDataFile = opt['trafDataDB']
     else :
-        tDataFile = argv[1]
+        tDataFile = args.trafficdb
+
+    if args.series_report:
+        seriesReport(tDataFile)
+        sys.exit(0)
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    stats.reset()
+
+    #Connect to the database (if that's where we're writing)
+    dbconn = None
+    if opt['sink'] == 'influx' and not args.parallel:
+        dbconn=connectInflux()
+    writer=setupOutputSink(realStdout)
+
+    if args.watch:
+        try:
+            watchAndIngest(tDataFile,snapshotSpec,dbconn,writer,args.reconcile)
+        except KeyboardInterrupt:
+            print("Stopping")
+        finishRun(writer,dbconn,profiler)
+        sys.exit(0)
+
+    if args.archives:
+        if args.trafficdb is None:
+            parser.error("--archives needs the archive(s) to read")
+        updateFromArchives(args.trafficdb,dbconn,writer,args.reconcile)
+        finishRun(writer,dbconn,profiler)
+        sys.exit(0)
+
+    if args.parallel:
+        dbconn = orchestratedRun(tDataFile,snapshotSpec,writer,args.reconcile)
+        finishRun(writer,dbconn,profiler)
+        sys.exit(0)
 
-    #Connect to the database
-    dbconn=setupInfluxConnection()
     #Run the update process based on extracted data:
-    updateInfluxTrafficHistory(tDataFile,dbconn)
+    if snapshotSpec is not None:
+        updateInfluxTrafficSnapshots(snapshotSpec,dbconn,writer,reconcile=args.reconcile)
+    elif args.backfill:
+        if opt['trafficMirror'] is not None:
+            parser.error("--backfill reads the traffic database directly; set trafficMirror to null for it")
+        updateInfluxTrafficBackfill(tDataFile,dbconn,writer,reconcile=args.reconcile)
+    else :
+        updateInfluxTrafficHistory(tDataFile,dbconn,writer,reconcile=args.reconcile)
 
     #Update the overall (rStats) Statistics
-    updateRStatsMeasurement(opt['rstatsfile'],dbconn)
+    updateRStatsMeasurement(opt['rstatsfile'],writer)
 
     #End of script
-    dbconn.close()
+    finishRun(writer,dbconn,profiler)